@@ -0,0 +1,106 @@
+"""Async versions of the helper_server functions, for the asyncio server (async_server.py).
+
+Weather calls go through async_http_client and share helper_server's caches and response
+parsing, so the sync functions the collector and the WSGI server use stay as they are. SQLite calls
+run the sync functions on a small thread pool, one thread per pooled reader connection, so the
+event loop never waits on the database.
+"""
+import asyncio
+import contextvars
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import async_http_client
+import db
+import helper_server
+import providers
+from helper_server import WEATHER_URL_PATH, WEATHER_HEADERS, weather_cache
+
+log = logging.getLogger('async_helpers')
+
+DB_WORKERS = db.READ_POOL_SIZE  # More threads than reader connections would only queue on the pool
+
+_db_executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix="async-db")
+
+
+async def run_db(func, *args):
+    """Runs a blocking database function off the event loop, in the caller's context (its trace)."""
+    call = functools.partial(contextvars.copy_context().run, func, *args)
+    return await asyncio.get_running_loop().run_in_executor(_db_executor, call)
+
+
+# --- Shelly plug ---
+# The fleet polls the devices on its own threads and serves a cached snapshot, so these only wait
+# on the network for the first snapshot and for relay commands.
+async def toggle_shelly_relay(turn_on):
+    """Switches the charger plug on or off."""
+    return await asyncio.get_running_loop().run_in_executor(None, helper_server.toggle_shelly_relay, turn_on)
+
+async def get_shelly_status():
+    """Returns the charger plug's status from the fleet snapshot."""
+    return await asyncio.get_running_loop().run_in_executor(None, helper_server.get_shelly_status)
+
+async def get_shelly_plug_data():
+    return await asyncio.get_running_loop().run_in_executor(None, helper_server.get_shelly_plug_data)
+
+
+# --- Weather ---
+async def get_weather_linkoping():
+    """Returns the Linköping nowcast from the shared cache, refreshing it from met.no when expired."""
+    return await weather_cache.get_async("linkoping", fetch_weather_linkoping)
+
+async def fetch_weather_linkoping():
+    try:
+        data = await async_http_client.get_json(providers.url("met-no", WEATHER_URL_PATH),
+                                                headers=WEATHER_HEADERS, timeout=5)
+        return helper_server.parse_weather(data)
+    except async_http_client.HTTPError as e:
+        log.warning("Error fetching weather data: %s", e)
+        return {"success": False, "error": str(e)}
+
+
+# --- Local sources ---
+async def get_battery_status():
+    return await asyncio.get_running_loop().run_in_executor(None, helper_server.get_battery_status)
+
+async def get_latest_server_data():
+    return await run_db(helper_server.get_latest_server_data)
+
+async def get_recent_server_data(limit=100):
+    return await run_db(helper_server.get_recent_server_data, limit)
+
+async def get_server_data_since(last_id, limit=100):
+    return await run_db(helper_server.get_server_data_since, last_id, limit)
+
+async def fetch_electricity_data_from_database(start=None, end=None):
+    return await run_db(helper_server.fetch_electricity_data_from_database, start, end)
+
+async def fetch_solar_data_from_database(start=None, end=None):
+    return await run_db(helper_server.fetch_solar_data_from_database, start, end)
+
+
+# --- Concurrent source gathering ---
+async def gather_sources(sources):
+    """helper_server.gather_sources() for coroutines: `sources` maps a name to an
+    (async function, deadline_seconds, fallback) tuple, and every deadline counts from the same
+    start. A source that misses its deadline keeps running in the background (it may be filling a
+    cache) and is reported as stale. Returns (results, stale)."""
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    tasks = {name: asyncio.ensure_future(func()) for name, (func, _, _) in sources.items()}
+    results = {}
+    stale = []
+    for name, (_, deadline, fallback) in sources.items():
+        remaining = max(0.0, start + deadline - loop.time())
+        try:
+            results[name] = await asyncio.wait_for(asyncio.shield(tasks[name]), remaining)
+        except asyncio.TimeoutError:
+            log.warning("Source '%s' missed its %ss deadline, rendering as stale.", name, deadline)
+            results[name] = fallback
+            stale.append(name)
+        except Exception as e:
+            log.warning("Source '%s' failed: %s", name, e)
+            results[name] = fallback
+            stale.append(name)
+    return results, stale
@@ -0,0 +1,101 @@
+import asyncio
+import json
+
+try:
+    import aiohttp
+except ImportError:  # Only the asyncio server needs it; the fixtures backend works without
+    aiohttp = None
+
+import providers
+from http_client import (HTTP_POOL_CONNECTIONS, HTTP_POOL_MAXSIZE, HTTP_RETRIES, HTTP_BACKOFF_FACTOR,
+                         HTTP_RETRY_STATUSES, DEFAULT_TIMEOUT_SECONDS, UPSTREAM_SECONDS, UPSTREAM_ERRORS)
+
+# The asyncio counterpart of http_client: one pooled aiohttp session per event loop with the same
+# pool sizes, retries and backoff, and the same provider backends (fixtures are answered in-process,
+# record saves every provider response).
+
+_session = None
+_session_loop = None
+
+
+class HTTPError(Exception):
+    """Connection error, timeout or error status of an async request."""
+
+
+def get_session():
+    """Returns the shared aiohttp session of the running event loop, creating it on first use."""
+    global _session, _session_loop
+    if aiohttp is None:
+        raise HTTPError("aiohttp is not installed")
+    loop = asyncio.get_running_loop()
+    if _session is None or _session.closed or _session_loop is not loop:
+        connector = aiohttp.TCPConnector(limit=HTTP_POOL_CONNECTIONS * HTTP_POOL_MAXSIZE,
+                                         limit_per_host=HTTP_POOL_MAXSIZE)
+        _session = aiohttp.ClientSession(connector=connector)
+        _session_loop = loop
+    return _session
+
+
+async def close():
+    """Closes every pooled connection, e.g. on shutdown."""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+async def _fixture_response(url):
+    name, path, query = providers.provider_for(url)
+    if name is None:
+        return None
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, providers.fixture_store().respond, name, path, query)
+
+
+async def _fetch(url, headers, timeout):
+    """(status, headers, body) with retries and exponential backoff like the sync session."""
+    session = get_session()
+    for attempt in range(HTTP_RETRIES + 1):
+        try:
+            async with session.get(url, headers=headers, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                body = await response.read()
+                if response.status not in HTTP_RETRY_STATUSES or attempt == HTTP_RETRIES:
+                    return response.status, dict(response.headers), body
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if attempt == HTTP_RETRIES:
+                raise HTTPError(f"{url}: {e or type(e).__name__}") from e
+        await asyncio.sleep(HTTP_BACKOFF_FACTOR * 2 ** attempt)
+
+
+async def get(url, headers=None, timeout=DEFAULT_TIMEOUT_SECONDS):
+    """GET under the current provider backend. Returns the body; raises HTTPError on failure or
+    an error status, like response.raise_for_status()."""
+    provider = providers.name_of(url) or 'other'
+    try:
+        with UPSTREAM_SECONDS.labels(provider).time(f"http {provider}"):
+            return await _get(url, headers, timeout)
+    except HTTPError:
+        UPSTREAM_ERRORS.inc(provider)
+        raise
+
+
+async def _get(url, headers, timeout):
+    response = await _fixture_response(url) if providers.PROVIDER_BACKEND == 'fixtures' else None
+    if response is None:
+        response = await _fetch(url, headers, timeout)
+        if providers.PROVIDER_BACKEND == 'record' and response[0] == 200:
+            name, path, query = providers.provider_for(url)
+            if name is not None:
+                providers.save_fixture(name, path, query, *response)
+    status, _, body = response
+    if status >= 400:
+        raise HTTPError(f"{status} error for {url}")
+    return body
+
+
+async def get_json(url, headers=None, timeout=DEFAULT_TIMEOUT_SECONDS):
+    body = await get(url, headers, timeout)
+    try:
+        return json.loads(body)
+    except ValueError as e:
+        raise HTTPError(f"Invalid JSON from {url}: {e}") from e
@@ -0,0 +1,263 @@
+"""asyncio variant of the web server, for many concurrent dashboards and live streams in one process.
+
+The I/O-bound routes (dashboard, provider data, server data, the live stream) are coroutines: an
+in-flight request waiting on the Shelly plug, met.no or SQLite costs a task, not a thread, and an
+open /stream costs a queue. Every other route is served by the Flask app from small_server.py on a
+small thread pool, so both servers answer the same URLs with the same templates and session state.
+
+    pip install aiohttp
+    python async_server.py --bind 0.0.0.0:80
+
+Background services start and stop exactly like under wsgi.py; SIGINT/SIGTERM shut down gracefully.
+"""
+import argparse
+import asyncio
+import io
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote
+
+from aiohttp import web
+
+import async_helpers
+import async_http_client
+import history
+import metrics
+import small_server
+import structured_log
+from helper_server import SERVER_DATA_COLUMNS, electricity_price_payload, solar_data_payload
+from small_server import (app as flask_app, live_hub, start_background_services, stop_background_services,
+                          REQUEST_SECONDS, DASHBOARD_UNAVAILABLE, DB_SOURCE_DEADLINE_SECONDS, HTTP_SOURCE_DEADLINE_SECONDS,
+                          BATTERY_SOURCE_DEADLINE_SECONDS)
+
+# --- Server Configuration ---
+ASYNC_BIND = '0.0.0.0:80'
+FLASK_THREADS = 8  # Threads for the routes still served by the Flask app
+SHUTDOWN_TIMEOUT_SECONDS = 30  # Time running requests get to finish on shutdown
+
+_flask_executor = ThreadPoolExecutor(max_workers=FLASK_THREADS, thread_name_prefix="flask")
+
+
+def json_response(data, status=200):
+    return web.json_response(data, status=status, dumps=lambda value: json.dumps(value, default=str))
+
+
+# --- WSGI bridge to the Flask app ---
+def wsgi_environ(request, body):
+    """WSGI environ for an aiohttp request, so the Flask app can render or answer it."""
+    host, _, port = (request.host or '').partition(':')
+    environ = {
+        'REQUEST_METHOD': request.method,
+        'SCRIPT_NAME': '',
+        'PATH_INFO': unquote(request.raw_path.split('?', 1)[0]),
+        'QUERY_STRING': request.query_string,
+        'CONTENT_TYPE': request.headers.get('Content-Type', ''),
+        'CONTENT_LENGTH': str(len(body)),
+        'SERVER_NAME': host or 'localhost',
+        'SERVER_PORT': port or ('443' if request.secure else '80'),
+        'SERVER_PROTOCOL': f"HTTP/{request.version.major}.{request.version.minor}",
+        'REMOTE_ADDR': request.remote or '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': request.scheme,
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in request.headers.items():
+        key = 'HTTP_' + name.upper().replace('-', '_')
+        if key not in ('HTTP_CONTENT_TYPE', 'HTTP_CONTENT_LENGTH'):
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+def call_wsgi(environ):
+    """Runs the Flask app for one request; returns (status, headers, body)."""
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started['status'], started['headers'] = int(status.split(' ', 1)[0]), headers
+    result = flask_app(environ, start_response)
+    try:
+        body = b''.join(result)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    return started['status'], started['headers'], body
+
+
+async def flask_fallback(request):
+    body = await request.read()
+    loop = asyncio.get_running_loop()
+    status, headers, payload = await loop.run_in_executor(_flask_executor, call_wsgi, wsgi_environ(request, body))
+    response = web.Response(status=status, body=payload)
+    for name, value in headers:
+        if name.lower() not in ('content-length', 'transfer-encoding'):
+            response.headers.add(name, value)
+    return response
+
+
+# --- Request metrics and traces ---
+@web.middleware
+async def request_metrics(request, handler):
+    """small_server's request timing and tracing for the async routes; requests bridged to the
+    Flask app are timed by its own hooks."""
+    route = request.match_info.route
+    if route.handler is flask_fallback:
+        return await handler(request)
+    name = route.resource.canonical if route.resource is not None else 'unmatched'
+    started = time.perf_counter()
+    trace = metrics.start_trace(f"{request.method} {request.path}", force='X-Trace' in request.headers)
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        if trace is not None and not response.prepared:
+            response.headers['X-Trace-Id'] = trace.trace_id
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        REQUEST_SECONDS.labels(name, request.method, str(status)).observe(time.perf_counter() - started)
+        if trace is not None:
+            metrics.finish_trace(trace, route=name, status=status)
+
+
+# --- Async routes ---
+async def dashboard(request):
+    if not small_server.logged_in:
+        raise web.HTTPFound('/login')
+    sources, stale_sources = await async_helpers.gather_sources({
+        'latest_server_info': (async_helpers.get_latest_server_data, DB_SOURCE_DEADLINE_SECONDS, None),
+        'shelly_status': (async_helpers.get_shelly_status, HTTP_SOURCE_DEADLINE_SECONDS, {"ison": None, **DASHBOARD_UNAVAILABLE}),
+        'weather_data': (async_helpers.get_weather_linkoping, HTTP_SOURCE_DEADLINE_SECONDS, DASHBOARD_UNAVAILABLE),
+        'recent_server_data': (async_helpers.get_recent_server_data, DB_SOURCE_DEADLINE_SECONDS, None),
+        'battery_status': (async_helpers.get_battery_status, BATTERY_SOURCE_DEADLINE_SECONDS, DASHBOARD_UNAVAILABLE),
+        'electricity_price': (async_helpers.fetch_electricity_data_from_database, DB_SOURCE_DEADLINE_SECONDS, []),
+    })
+    # Templates use url_for, which needs a Flask request context; rendering itself is CPU only.
+    with flask_app.request_context(wsgi_environ(request, b'')):
+        html = small_server.render_dashboard(sources, stale_sources)
+    return web.Response(text=html, content_type='text/html')
+
+
+def payload_response(request, payload):
+    """small_server.cached_json_response() for aiohttp: 304, or the (compressed) cached body."""
+    status, headers, body = payload.respond(request.headers.get('If-None-Match'),
+                                            request.headers.get('Accept-Encoding'))
+    return web.Response(status=status, headers=headers, body=body)
+
+
+def time_window(request):
+    """small_server.time_window_args() for aiohttp; raises HTTPBadRequest on invalid times."""
+    try:
+        return tuple(history.to_epoch(request.query[name]) if name in request.query else None
+                     for name in ('from', 'to'))
+    except ValueError:
+        raise web.HTTPBadRequest(text=json.dumps({'error': 'Invalid from/to'}), content_type='application/json')
+
+
+async def electricity_price(request):
+    start, end = time_window(request)
+    if start is not None or end is not None:
+        return json_response(await async_helpers.fetch_electricity_data_from_database(start or 0, end))
+    payload = await async_helpers.run_db(electricity_price_payload.get)
+    return payload_response(request, payload) if payload else json_response({'error': '500'}, 500)
+
+
+async def shelly_plug_data(request):
+    data = await async_helpers.get_shelly_plug_data()
+    return json_response(data) if data else json_response({'error': '500'}, 500)
+
+
+async def solar_data(request):
+    start, end = time_window(request)
+    if start is not None or end is not None:
+        return json_response(await async_helpers.fetch_solar_data_from_database(start or 0, end))
+    payload = await async_helpers.run_db(solar_data_payload.get)
+    return payload_response(request, payload) if payload else json_response({'error': '500'}, 500)
+
+
+async def server_info(request):
+    data = await async_helpers.get_latest_server_data()
+    if data:
+        return json_response(data)
+    return json_response({'cpu': 'N/A', 'memory_percent': 'N/A', 'disk_percent': 'N/A'}, 500)
+
+
+async def recent_server_data(request):
+    since = request.query.get('since')
+    if since is not None and since.lstrip('-').isdigit():
+        since = int(since)
+        data = await async_helpers.get_server_data_since(since)
+        return json_response(data or {**{column: [] for column in SERVER_DATA_COLUMNS}, 'last_id': since})
+    data = await async_helpers.get_recent_server_data()
+    if data:
+        return json_response(data)
+    return json_response({'error': 'Could not retrieve recent server data'}, 500)
+
+
+async def live_stream(request):
+    """Server-Sent Events stream; the same hub as the Flask /stream, without a thread per client."""
+    response = web.StreamResponse(headers={'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache',
+                                           'X-Accel-Buffering': 'no'})
+    await response.prepare(request)
+    subscriber = live_hub.subscribe_async()
+    try:
+        async for message in live_hub.stream_async(subscriber):
+            await response.write(message.encode())
+    except (ConnectionResetError, asyncio.CancelledError):
+        pass
+    finally:
+        live_hub.unsubscribe(subscriber)
+    return response
+
+
+# --- Application ---
+async def on_startup(application):
+    await asyncio.get_running_loop().run_in_executor(None, start_background_services)
+
+
+async def on_shutdown(application):
+    live_hub.close()  # Ends open streams so shutdown doesn't wait for them
+
+
+async def on_cleanup(application):
+    await asyncio.get_running_loop().run_in_executor(None, stop_background_services)
+    await async_http_client.close()
+    _flask_executor.shutdown(wait=False)
+
+
+def create_app():
+    application = web.Application(middlewares=[request_metrics])
+    application.add_routes([
+        web.get('/dashboard', dashboard),
+        web.get('/electricity_price', electricity_price),
+        web.get('/shelly_plug_data', shelly_plug_data),
+        web.get('/solar_data', solar_data),
+        web.get('/server_info', server_info),
+        web.get('/recent_server_data', recent_server_data),
+        web.get('/stream', live_stream),
+        web.route('*', '/{tail:.*}', flask_fallback),
+    ])
+    application.on_startup.append(on_startup)
+    application.on_shutdown.append(on_shutdown)
+    application.on_cleanup.append(on_cleanup)
+    return application
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs the asyncio web server.")
+    parser.add_argument('--bind', default=ASYNC_BIND, help='host:port')
+    args = parser.parse_args()
+    structured_log.configure(metrics.PROCESS_NAME)
+    host, _, port = args.bind.rpartition(':')
+    web.run_app(create_app(), host=host or '0.0.0.0', port=int(port), shutdown_timeout=SHUTDOWN_TIMEOUT_SECONDS)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,468 @@
+import json
+import logging
+import socket
+import sqlite3
+import threading
+import time
+
+import charge_planner
+import db
+import metrics
+
+log = logging.getLogger('battery_controller')
+CHECK_SECONDS = metrics.histogram('battery_check_duration_seconds', 'Battery controller control steps')
+
+PLUG_RETRY_SECONDS = 300  # Re-send "on" if the battery is still low and not charging after this long
+RATE_SMOOTHING = 0.3  # Weight of the newest reading in the charge/discharge rate estimate
+# Manual switches from workers that don't run the controller are queued in battery_commands; a
+# datagram to COMMAND_NOTIFY_ADDRESS wakes the worker that runs it to apply them.
+COMMAND_NOTIFY_ADDRESS = ('127.0.0.1', 47632)
+COMMAND_TIMEOUT_SECONDS = 10  # A queued switch the controller hasn't taken within this long is cancelled
+COMMAND_POLL_SECONDS = 0.1  # How often the requesting worker looks for the result
+COMMAND_FALLBACK_SECONDS = 5  # Queue check interval when the wake-up socket can't be bound
+
+
+class BatteryController:
+    """Keeps the battery between two thresholds by switching the charger plug.
+
+    All state lives on this object behind one lock and is persisted in SQLite (battery_state), so
+    a restart resumes an open charge cycle. Every finished cycle is appended to the charge_cycles
+    ledger and the energy total is the ledger's sum. Instead of polling at a fixed rate, the loop
+    sleeps about half the time the battery needs, at its observed rate, to come near the threshold
+    it is moving towards, and is woken early by manual plug changes. With a plan_provider it also
+    follows the charge planner's schedule between the thresholds; the thresholds always win.
+
+    In a multi-process server only one worker runs the loop (start()). The others hand manual
+    switches to it with request_plug() and serve the persisted state from snapshot(), so only the
+    running controller ever writes battery_state and the charge_cycles ledger.
+    """
+
+    def __init__(self, read_battery, switch_plug, low_threshold, high_threshold, energy_per_cycle_wh,
+                 min_interval_seconds, max_interval_seconds, margin_percent=3, automatic=True, plan_provider=None,
+                 clock=time.time, notify_address=COMMAND_NOTIFY_ADDRESS):
+        self.read_battery = read_battery  # () -> {"success", "percent", "is_charging"}
+        self.switch_plug = switch_plug  # (turn_on) -> {"success", ...}
+        self.low_threshold = low_threshold
+        self.high_threshold = high_threshold
+        self.energy_per_cycle_wh = energy_per_cycle_wh  # Measured for one low -> high cycle
+        self.min_interval_seconds = min_interval_seconds
+        self.max_interval_seconds = max_interval_seconds
+        self.margin_percent = margin_percent
+        self.automatic = automatic
+        self.plan_provider = plan_provider  # Optional () -> charge plan, see charge_planner
+        self.clock = clock  # Simulated time in replays
+        self.notify_address = notify_address
+        self._lock = threading.RLock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._loaded = False
+        self._thread = None
+        self._listening = False
+        # Persisted state
+        self.plug_state = None  # Last commanded plug state, "on" / "off"
+        self.plug_changed_at = None
+        self.cycle_start_time = None  # Set while a charge cycle is open
+        self.cycle_start_percent = None
+        # Derived / in-memory state
+        self.total_energy_wh = 0.0
+        self.last_percent = None
+        self.last_is_charging = None
+        self.last_check_time = None
+        self.rate_percent_per_second = None
+        self.observed_rates = {'charge_rate': None, 'discharge_rate': None}  # %/h, for the planner
+        self.plan_slot_applied = None  # Start of the plan slot whose decision was last applied
+        self.next_check_in = None
+
+    # --- Persistence ---
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        try:
+            row = db.query_one('SELECT state FROM battery_state WHERE id = 1')
+            self.total_energy_wh = db.query_one('SELECT COALESCE(SUM(energy_wh), 0) FROM charge_cycles')[0]
+        except sqlite3.Error as e:
+            log.error("SQLite Error while loading battery state: %s", e)
+            return
+        if row:
+            state = json.loads(row[0])
+            self.plug_state = state.get('plug_state')
+            self.plug_changed_at = state.get('plug_changed_at')
+            self.cycle_start_time = state.get('cycle_start_time')
+            self.cycle_start_percent = state.get('cycle_start_percent')
+            for key in self.observed_rates:
+                self.observed_rates[key] = state.get(key)
+
+    @staticmethod
+    def _persisted_snapshot():
+        """snapshot() from what the running controller last saved, for the other workers."""
+        try:
+            row = db.query_one('SELECT state FROM battery_state WHERE id = 1')
+            total = db.query_one('SELECT COALESCE(SUM(energy_wh), 0) FROM charge_cycles')[0]
+        except sqlite3.Error as e:
+            log.error("SQLite Error while loading battery state: %s", e)
+            row, total = None, 0.0
+        state = json.loads(row[0]) if row else {}
+        return {"plug_state": state.get('plug_state'), "cycle_start_time": state.get('cycle_start_time'),
+                "cycle_start_percent": state.get('cycle_start_percent'), "total_energy_wh": round(total, 2),
+                "last_percent": state.get('level'), "rate_percent_per_hour": None, "next_check_in": None}
+
+    def _save(self, conn):
+        state = {'plug_state': self.plug_state, 'plug_changed_at': self.plug_changed_at,
+                 'cycle_start_time': self.cycle_start_time, 'cycle_start_percent': self.cycle_start_percent,
+                 # Read by the charge planner in the collector process
+                 'low': self.low_threshold, 'high': self.high_threshold,
+                 'energy_per_cycle_wh': self.energy_per_cycle_wh, 'level': self.last_percent,
+                 **self.observed_rates}
+        conn.execute('''
+            INSERT INTO battery_state (id, state, updated_at) VALUES (1, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(id) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at
+        ''', (json.dumps(state),))
+
+    def _persist(self, cycle=None):
+        """Saves the state, and a finished cycle if given, in one transaction."""
+        try:
+            with db.transaction() as conn:
+                if cycle is not None:
+                    conn.execute('''
+                        INSERT INTO charge_cycles (started_at, ended_at, start_percent, end_percent, energy_wh, reason)
+                        VALUES (?, ?, ?, ?, ?, ?)
+                    ''', cycle)
+                self._save(conn)
+        except sqlite3.Error as e:
+            log.error("SQLite Error while saving battery state: %s", e)
+
+    # --- Charge cycles ---
+    def cycle_energy_wh(self, start_percent, end_percent):
+        """Energy of a (possibly partial) cycle, scaled from the measured low -> high cycle."""
+        gained = max(0.0, end_percent - start_percent)
+        return self.energy_per_cycle_wh * gained / (self.high_threshold - self.low_threshold)
+
+    def _open_cycle(self, percent, now):
+        self.cycle_start_time = now
+        self.cycle_start_percent = percent
+
+    def _close_cycle(self, percent, now, reason):
+        """Ends the open cycle and returns the ledger row, or None if nothing was charged."""
+        start_time, start_percent = self.cycle_start_time, self.cycle_start_percent
+        self.cycle_start_time = None
+        self.cycle_start_percent = None
+        if start_time is None or start_percent is None or percent <= start_percent:
+            return None
+        energy = self.cycle_energy_wh(start_percent, percent)
+        self.total_energy_wh += energy
+        return (int(start_time), int(now), start_percent, percent, round(energy, 3), reason)
+
+    def _set_plug_state(self, turn_on, now):
+        self.plug_state = "on" if turn_on else "off"
+        self.plug_changed_at = now
+
+    def _switch(self, turn_on, now):
+        """Switches the plug and records its new state; returns False (and records nothing) if
+        the switch failed."""
+        result = self.switch_plug(turn_on)
+        if not result["success"]:
+            log.warning("Could not turn the charger %s: %s", "ON" if turn_on else "OFF", result.get('error'))
+            return False
+        self._set_plug_state(turn_on, now)
+        return True
+
+    # --- Control ---
+    def check(self):
+        """One control step; returns the number of seconds until the next one."""
+        battery_info = self.read_battery()
+        if not battery_info["success"]:
+            log.warning("Error getting battery status for automatic charging: %s", battery_info.get('error'))
+            return self.max_interval_seconds
+        percent = battery_info["percent"]
+        is_charging = battery_info["is_charging"]
+        now = self.clock()
+        with self._lock:
+            self._ensure_loaded()
+            self._update_rate(percent, is_charging, now)
+            changed, cycle = False, None
+            plug_pending = self.plug_state == "on" and now - (self.plug_changed_at or 0) < PLUG_RETRY_SECONDS
+            # The plan is followed between the thresholds, once per slot, so a manual toggle holds
+            # until the next slot starts.
+            slot = self._planned_slot(now)
+            plan_due = (self.automatic and slot is not None and slot['start'] != self.plan_slot_applied
+                        and self.low_threshold <= percent <= self.high_threshold)
+            if plan_due:
+                self.plan_slot_applied = slot['start']
+            if self.automatic and percent < self.low_threshold and not is_charging and not plug_pending:
+                log.info("Battery low (%s%%), turning charger ON.", percent)
+                # On failure nothing is recorded, so the next check tries again.
+                if self._switch(True, now):
+                    self._open_cycle(percent, now)
+                    changed = True
+            elif (self.automatic and percent > self.high_threshold and is_charging
+                  and self.cycle_start_percent is not None and self.cycle_start_percent < self.high_threshold):
+                log.info("Battery high (%s%%), turning charger OFF.", percent)
+                if self._switch(False, now):
+                    cycle = self._close_cycle(percent, now, "auto")
+                    log.info("Charger OFF at %s%%. Adding %.2f Wh.", percent, cycle[4] if cycle else 0)
+                    changed = True
+            elif plan_due and slot['charge'] and self.plug_state != "on":
+                log.info("Charge plan: charging until %s (%s%%).", time.strftime('%H:%M', time.localtime(slot['end'])), percent)
+                if self._switch(True, now):
+                    if self.cycle_start_time is None:
+                        self._open_cycle(percent, now)
+                    changed = True
+                else:
+                    self.plan_slot_applied = None  # Retried by the next check
+            elif plan_due and not slot['charge'] and self.plug_state == "on":
+                log.info("Charge plan: charger OFF at %s%%.", percent)
+                if self._switch(False, now):
+                    cycle = self._close_cycle(percent, now, "plan")
+                    changed = True
+                else:
+                    self.plan_slot_applied = None
+            elif is_charging and self.cycle_start_time is None:
+                self._open_cycle(percent, now)
+                changed = True
+            elif not is_charging and self.cycle_start_time is not None and not plug_pending:
+                # Charging stopped without the controller, e.g. the charger was unplugged.
+                cycle = self._close_cycle(percent, now, "external")
+                changed = True
+            if changed:
+                self._persist(cycle)
+            self.last_check_time = now
+            interval = self.next_interval(percent, is_charging)
+            if slot is not None:
+                interval = min(interval, max(1, slot['end'] - now + 1))  # Wake for the next slot
+            self.next_check_in = interval
+            log.debug("Battery: %s%%, Charging: %s, Plug state: %s, Energy charged: %.2f Wh, next check in %.0f s",
+                      percent, is_charging, self.plug_state, self.total_energy_wh, interval)
+        return interval
+
+    def set_plug(self, turn_on):
+        """Manual plug switch: opens or closes the charge cycle and wakes the control loop."""
+        result = self._set_plug(turn_on)
+        self.wake()
+        return result
+
+    def _set_plug(self, turn_on):
+        with self._lock:
+            self._ensure_loaded()
+            result = self.switch_plug(turn_on)
+            if not result["success"]:
+                return result
+            now = self.clock()
+            self._set_plug_state(turn_on, now)
+            battery_info = self.read_battery()
+            cycle = None
+            if battery_info["success"]:
+                if turn_on and self.cycle_start_time is None:
+                    self._open_cycle(battery_info["percent"], now)
+                elif not turn_on and self.cycle_start_time is not None:
+                    cycle = self._close_cycle(battery_info["percent"], now, "manual")
+                    if cycle:
+                        log.info("Manual turn off at %s%%. Adding %.2f Wh.", battery_info['percent'], cycle[4])
+            self._persist(cycle)
+        return result
+
+    # --- Manual switches from other workers ---
+    @property
+    def running(self):
+        """Whether the control loop runs in this process."""
+        return self._thread is not None and self._thread.is_alive() and not self._stop.is_set()
+
+    def request_plug(self, turn_on, timeout=COMMAND_TIMEOUT_SECONDS):
+        """Manual plug switch from any worker: applied here if the loop runs in this process,
+        otherwise queued for the worker that runs it. Waits up to `timeout` for the controller to
+        take the switch, which is cancelled if it hasn't, and as long again for its result."""
+        if self.running:
+            return self.set_plug(turn_on)
+        try:
+            with db.transaction() as conn:
+                command_id = conn.execute('INSERT INTO battery_commands (turn_on, requested_at) VALUES (?, ?)',
+                                          (int(turn_on), time.time())).lastrowid
+            self._notify()
+            deadline = time.monotonic() + timeout
+            while True:
+                row = db.query_one('SELECT result FROM battery_commands WHERE id = ? AND done_at IS NOT NULL',
+                                   (command_id,))
+                if row is None and time.monotonic() >= deadline:
+                    with db.transaction() as conn:
+                        cancelled = conn.execute(
+                            'UPDATE battery_commands SET done_at = ?, result = ? '
+                            'WHERE id = ? AND claimed_at IS NULL AND done_at IS NULL',
+                            (time.time(), json.dumps({"success": False, "error": "Battery controller not responding"}),
+                             command_id)).rowcount
+                    if cancelled:
+                        row = db.query_one('SELECT result FROM battery_commands WHERE id = ?', (command_id,))
+                    elif time.monotonic() >= deadline + timeout:
+                        # Claimed but never finished, e.g. the controller's worker died mid-switch.
+                        # The row is left for apply_commands to prune.
+                        log.warning("Charger switch %d was taken by the battery controller but not reported", command_id)
+                        return {"success": False, "error": "Battery controller did not report the result"}
+                if row is not None:
+                    db.execute('DELETE FROM battery_commands WHERE id = ?', (command_id,))
+                    return json.loads(row[0])
+                time.sleep(COMMAND_POLL_SECONDS)
+        except sqlite3.Error as e:
+            log.error("SQLite Error while passing a charger switch to the battery controller: %s", e)
+            return {"success": False, "error": str(e)}
+
+    def apply_commands(self):
+        """Applies the queued manual switches in order; run by the control loop. Each switch is
+        claimed before the plug is touched, so its requester can no longer cancel it, and its
+        result is left for the requester, which deletes the row. Returns the number applied."""
+        applied = 0
+        try:
+            pending = db.query_all('SELECT id, turn_on, requested_at FROM battery_commands '
+                                   'WHERE claimed_at IS NULL AND done_at IS NULL ORDER BY id')
+            for command_id, turn_on, requested_at in pending:
+                now = time.time()  # Earlier switches in the batch may have taken seconds each
+                if now - requested_at > COMMAND_TIMEOUT_SECONDS:
+                    db.execute('UPDATE battery_commands SET done_at = ?, result = ? '
+                               'WHERE id = ? AND claimed_at IS NULL AND done_at IS NULL',
+                               (now, json.dumps({"success": False, "error": "Expired before the battery controller ran"}),
+                                command_id))
+                    continue
+                claimed = db.execute('UPDATE battery_commands SET claimed_at = ? '
+                                     'WHERE id = ? AND claimed_at IS NULL AND done_at IS NULL', (now, command_id))
+                if not claimed:
+                    continue  # Cancelled by its requester in the meantime
+                log.info("Manual switch from another worker: charger %s.", "ON" if turn_on else "OFF")
+                result = self._set_plug(bool(turn_on))
+                db.execute('UPDATE battery_commands SET done_at = ?, result = ? WHERE id = ?',
+                           (time.time(), json.dumps(result), command_id))
+                applied += 1
+            # Results nobody collected (e.g. the requesting worker was restarted) and claims whose
+            # switch never finished (the previous controller's worker died)
+            stale = time.time() - 2 * COMMAND_TIMEOUT_SECONDS
+            db.execute('DELETE FROM battery_commands WHERE done_at < ? OR (done_at IS NULL AND claimed_at < ?)',
+                       (stale, stale))
+        except sqlite3.Error as e:
+            log.error("SQLite Error while applying charger commands: %s", e)
+        return applied
+
+    def _notify(self):
+        try:
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+                sock.sendto(b'battery-command', self.notify_address)
+        except OSError:
+            pass  # The controller still finds the command at its next queue check
+
+    def _listen(self):
+        """Wakes the loop on every datagram to notify_address. Returns False if the address can't
+        be bound; the loop then checks the queue every COMMAND_FALLBACK_SECONDS."""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.bind(self.notify_address)
+        except OSError as e:
+            sock.close()
+            log.warning("Charger command notifications unavailable on %s: %s", self.notify_address, e)
+            return False
+
+        def receive():
+            with sock:
+                while not self._stop.is_set():
+                    try:
+                        sock.recv(64)
+                    except OSError:
+                        return
+                    self.wake()
+        threading.Thread(target=receive, name="battery-commands", daemon=True).start()
+        return True
+
+    def _planned_slot(self, now):
+        if self.plan_provider is None:
+            return None
+        try:
+            plan = self.plan_provider()
+        except Exception as e:
+            log.warning("Could not load the charge plan: %s", e)
+            return None
+        return charge_planner.planned_slot(plan, now)
+
+    # --- Adaptive polling ---
+    def _update_rate(self, percent, is_charging, now):
+        """Smoothed %/s since the last check; reset when the battery switches direction."""
+        if self.last_is_charging is not None and is_charging != self.last_is_charging:
+            self.rate_percent_per_second = None
+        elif self.last_check_time is not None and now > self.last_check_time:
+            rate = (percent - self.last_percent) / (now - self.last_check_time)
+            previous = self.rate_percent_per_second
+            self.rate_percent_per_second = rate if previous is None else previous + RATE_SMOOTHING * (rate - previous)
+            key, sign = ('charge_rate', 1) if is_charging else ('discharge_rate', -1)
+            if sign * self.rate_percent_per_second > 0:
+                self.observed_rates[key] = round(sign * self.rate_percent_per_second * 3600, 2)
+        self.last_percent = percent
+        self.last_is_charging = is_charging
+
+    def next_interval(self, percent, is_charging):
+        """Seconds until the next check: the minimum near the threshold the battery is moving
+        towards, otherwise half the time it needs to get there at the observed rate."""
+        distance = (self.high_threshold - percent if is_charging else percent - self.low_threshold) - self.margin_percent
+        if distance <= 0 or self.rate_percent_per_second is None:
+            return self.min_interval_seconds
+        towards = self.rate_percent_per_second if is_charging else -self.rate_percent_per_second
+        if towards <= 0:
+            return self.max_interval_seconds
+        return min(self.max_interval_seconds, max(self.min_interval_seconds, distance / towards / 2))
+
+    # --- Loop ---
+    def run(self):
+        """Control loop: apply queued manual switches and check, then sleep until the adaptive
+        deadline or an early wake-up."""
+        while not self._stop.is_set():
+            try:
+                self.apply_commands()
+                with CHECK_SECONDS.labels().time():
+                    interval = self.check()
+            except Exception as e:
+                log.exception("Battery controller error: %s", e)
+                interval = self.max_interval_seconds
+            if not self._listening:
+                interval = min(interval, COMMAND_FALLBACK_SECONDS)
+            self._wake.wait(interval)
+            self._wake.clear()
+
+    def start(self):
+        if self._thread is None:
+            with self._lock:
+                self._loaded = False  # Another worker may have run the controller until now
+            self._listening = self._listen()
+            self._thread = threading.Thread(target=self.run, name="battery-controller", daemon=True)
+            self._thread.start()
+        return self._thread
+
+    def stop(self, timeout=None):
+        """Ends the loop and waits up to `timeout` for a check in progress (e.g. a plug switch) to finish."""
+        self._stop.set()
+        self._wake.set()
+        if self._listening:
+            self._notify()  # Ends the listener's recv()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+
+    def wake(self):
+        self._wake.set()
+
+    def snapshot(self):
+        """The controller's state: live where the loop runs, as last persisted in other workers."""
+        if not self.running:
+            return self._persisted_snapshot()
+        with self._lock:
+            self._ensure_loaded()
+            return {"plug_state": self.plug_state, "cycle_start_time": self.cycle_start_time,
+                    "cycle_start_percent": self.cycle_start_percent,
+                    "total_energy_wh": round(self.total_energy_wh, 2), "last_percent": self.last_percent,
+                    "rate_percent_per_hour": round(self.rate_percent_per_second * 3600, 2)
+                    if self.rate_percent_per_second is not None else None,
+                    "next_check_in": self.next_check_in}
+
+    def recent_cycles(self, limit=20):
+        """The newest entries of the charge-cycle ledger."""
+        try:
+            rows = db.query_all('''
+                SELECT started_at, ended_at, start_percent, end_percent, energy_wh, reason
+                FROM charge_cycles ORDER BY id DESC LIMIT ?
+            ''', (limit,))
+        except sqlite3.Error as e:
+            log.error("SQLite Error while fetching charge cycles: %s", e)
+            return []
+        columns = ('started_at', 'ended_at', 'start_percent', 'end_percent', 'energy_wh', 'reason')
+        return [dict(zip(columns, row)) for row in rows]
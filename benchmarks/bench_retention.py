@@ -0,0 +1,89 @@
+"""Benchmark: cost of one store_server_data() call plus raw retention as the table grows.
+
+Fills a scratch database to each size with samples 10 s apart, sets the raw retention window to
+that size so every insert also expires one row, and times a batch of store + apply_retention
+calls. With range deletes on the time index the cost should stay flat; pass --legacy to also
+time the old NOT IN (... ORDER BY timestamp) prune.
+
+    python benchmarks/bench_retention.py --sizes 10000 100000 1000000 3000000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+import database_script
+import history
+
+SAMPLE = {'cpu_percent': 12.5, 'memory_total': 8467419136, 'memory_available': 1699262464,
+          'memory_percent': 79.9, 'disk_total': 95865159680, 'disk_used': 38014885888, 'disk_percent': 39.7}
+
+LEGACY_PRUNE = '''
+    DELETE FROM server_data
+    WHERE id NOT IN (SELECT id FROM server_data ORDER BY timestamp DESC LIMIT ?)
+'''
+
+
+INTERVAL = 10  # Seconds between synthetic samples
+
+
+def fill(rows, end):
+    """Replaces server_data with `rows` synthetic samples, INTERVAL seconds apart up to `end`."""
+    values = tuple(SAMPLE.values())
+    with db.transaction() as conn:
+        conn.execute('DELETE FROM server_data')
+        conn.executemany('''
+            INSERT INTO server_data (timestamp, cpu_percent, memory_total, memory_available, memory_percent,
+                                     disk_total, disk_used, disk_percent)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', ((history._utc_text(end - i * INTERVAL), *values) for i in range(rows)))
+
+
+def time_store(rows, iterations, now):
+    history.RETENTION_SECONDS['server_data'] = rows * INTERVAL
+    start = time.perf_counter()
+    for i in range(1, iterations + 1):
+        database_script.store_server_data(SAMPLE, now=now + i * INTERVAL)
+        history.apply_retention(now + i * INTERVAL)
+    return (time.perf_counter() - start) / iterations
+
+
+def time_legacy(rows, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        with db.transaction() as conn:
+            conn.execute('''
+                INSERT INTO server_data (cpu_percent, memory_total, memory_available, memory_percent,
+                                         disk_total, disk_used, disk_percent)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', tuple(SAMPLE.values()))
+            conn.execute(LEGACY_PRUNE, (rows,))
+    return (time.perf_counter() - start) / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000, 1000000])
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--legacy', action='store_true', help='also time the old NOT IN prune (slow)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DATABASE_NAME = os.path.join(tmp, 'bench.db')
+        database_script.init_database()
+        print(f"{'rows':>10} {'store+retain (ms)':>18}" + (f" {'legacy (ms)':>12}" if args.legacy else ""))
+        now = int(time.time())
+        for rows in sorted(args.sizes):
+            fill(rows, now)
+            line = f"{rows:>10} {time_store(rows, args.iterations, now) * 1000:>18.3f}"
+            if args.legacy:
+                line += f" {time_legacy(rows, max(1, args.iterations // 20)) * 1000:>12.3f}"
+            print(line, flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+"""Benchmark: the solar production model over a year of hourly forecast data.
+
+Builds `--days` (default 365) of synthetic hourly GHI and temperatures for Linköping and times
+  - the original scalar GHI model (a list comprehension),
+  - solar_model.predict_power() for one horizontal array (same result as the scalar model) and
+    for `--arrays` tilted arrays, vectorized over the whole year,
+  - the same model called hour by hour, i.e. what the vectorization saves,
+  - recompute_solar_predictions() on a scratch database holding all those hours, once with
+    changed arrays (every daylight row updated) and once unchanged (no writes).
+
+    python benchmarks/bench_solar_model.py --days 365 --arrays 3
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+import database_script
+import solar_model
+
+START_EPOCH = 1735689600  # 2025-01-01 00:00 UTC
+TILTED_ARRAYS = [
+    {"name": "south", "area": 30, "efficiency": 0.2, "tilt": 35, "azimuth": 180, "noct": 45},
+    {"name": "east", "area": 15, "efficiency": 0.2, "tilt": 25, "azimuth": 90, "noct": 45},
+    {"name": "west", "area": 15, "efficiency": 0.2, "tilt": 25, "azimuth": 270, "noct": 45},
+    {"name": "carport", "area": 20, "efficiency": 0.18, "tilt": 10, "azimuth": 200},
+]
+
+
+def synthetic_year(hours, seed=1):
+    """Hourly epochs, GHI (clear sky times random cloud cover) and air temperatures."""
+    rng = np.random.default_rng(seed)
+    epochs = START_EPOCH + 3600 * np.arange(hours)
+    zenith, _ = solar_model.sun_position(epochs - 1800, database_script.latitude, database_script.longitude)
+    clear_sky = np.maximum(0.0, 1000 * np.cos(np.radians(zenith))) ** 1.15 / 1000 ** 0.15
+    ghi = np.round(clear_sky * rng.uniform(0.2, 1.0, hours), 1)
+    season = -np.cos(2 * np.pi * solar_model.days_into_year(epochs) / 365)
+    temperature = np.round(7 + 11 * season + 4 * np.sin(2 * np.pi * (epochs % 86400) / 86400 - 2)
+                           + rng.normal(0, 2, hours), 1)
+    return epochs, ghi, temperature
+
+
+def best_of(repeat, func):
+    """Fastest of `repeat` runs, in seconds, and the last result."""
+    best, result = float('inf'), None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - started)
+    return best, result
+
+
+def legacy_model(ghi, temperature):
+    return [50 * 0.15 * g * (1 + -0.004 * (t - 25)) if g > 0 else 0 for g, t in zip(ghi, temperature)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--days', type=float, default=365)
+    parser.add_argument('--arrays', type=int, default=3, choices=range(1, len(TILTED_ARRAYS) + 1))
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--dir', default=None, help='directory for the scratch database (default: a temp dir)')
+    args = parser.parse_args()
+
+    hours = int(args.days * 24)
+    epochs, ghi, temperature = synthetic_year(hours)
+    ghi_list, temperature_list, epoch_list = ghi.tolist(), temperature.tolist(), epochs.tolist()
+    flat = solar_model.parse_arrays(solar_model.DEFAULT_ARRAYS)
+    tilted = solar_model.parse_arrays(TILTED_ARRAYS[:args.arrays])
+    lat, lon = database_script.latitude, database_script.longitude
+
+    def vectorized(arrays):
+        return lambda: solar_model.predict_power(epoch_list, ghi_list, temperature_list, arrays, lat, lon)
+
+    def per_hour():
+        return [solar_model.predict_power([e], [g], [t], tilted, lat, lon)[0]
+                for e, g, t in zip(epoch_list, ghi_list, temperature_list)]
+
+    print(f"{hours} hours ({args.days:g} days), best of {args.repeat}")
+    legacy_seconds, legacy = best_of(args.repeat, lambda: legacy_model(ghi_list, temperature_list))
+    print(f"  scalar GHI model:                 {legacy_seconds * 1000:8.2f} ms")
+    flat_seconds, flat_power = best_of(args.repeat, vectorized(flat))
+    print(f"  vectorized, 1 flat array:         {flat_seconds * 1000:8.2f} ms"
+          f"  (matches scalar: {np.allclose(flat_power, legacy)})")
+    tilted_seconds, tilted_power = best_of(args.repeat, vectorized(tilted))
+    print(f"  {f'vectorized, {args.arrays} tilted arrays:':<34}{tilted_seconds * 1000:8.2f} ms"
+          f"  ({tilted_power.sum() / 1000:.0f} kWh vs {sum(legacy) / 1000:.0f} kWh flat)")
+    loop_seconds, _ = best_of(1, per_hour)
+    print(f"  same model hour by hour:          {loop_seconds * 1000:8.2f} ms"
+          f"  ({loop_seconds / tilted_seconds:.0f}x the vectorized run)")
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        db.DATABASE_NAME = os.path.join(tmp, 'bench.db')
+        database_script.init_database()
+        with db.transaction() as conn:
+            conn.executemany('''
+                INSERT INTO solar_data (time_utc, time_local, ghi, temperature, predicted_power, time_epoch)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', [(f"t{epoch}", None, g, t, p, epoch)
+                  for epoch, g, t, p in zip(epoch_list, ghi_list, temperature_list, legacy)])
+        started = time.perf_counter()
+        changed = database_script.recompute_solar_predictions(tilted)
+        recompute_seconds = time.perf_counter() - started
+        started = time.perf_counter()
+        unchanged = database_script.recompute_solar_predictions(tilted)
+        noop_seconds = time.perf_counter() - started
+    print(f"  bulk recompute of stored rows:    {recompute_seconds * 1000:8.2f} ms ({changed} rows updated)")
+    print(f"  bulk recompute, arrays unchanged: {noop_seconds * 1000:8.2f} ms ({unchanged} rows updated)")
+
+
+if __name__ == '__main__':
+    main()
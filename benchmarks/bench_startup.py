@@ -0,0 +1,71 @@
+"""Benchmark: cold import time of the web server and the collector, with a regression gate.
+
+Each module is imported in a fresh interpreter several times and the median is compared with
+its budget; the script exits non-zero if any module is over budget, so it can run in CI.
+
+    python benchmarks/bench_startup.py --runs 7 --budget small_server=400 --budget database_script=250
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Median cold-import budgets in milliseconds
+DEFAULT_BUDGETS_MS = {
+    'database_script': 250,
+    'small_server': 450,
+}
+
+IMPORT_SNIPPET = "import time; t = time.perf_counter(); import {module}; print((time.perf_counter() - t) * 1000)"
+
+# Used only when there is no key.py, which holds the real secrets and is not in the repository.
+KEY_STUB = '''
+from cryptography.fernet import Fernet
+ENCRYPTION_KEY = Fernet.generate_key()
+USERS = {}
+DATABASE_NAME = 'server_data.db'
+SHELLY_PLUG_SERVER_IP = '127.0.0.1'
+'''
+
+
+def import_time_ms(module, env):
+    result = subprocess.run([sys.executable, '-c', IMPORT_SNIPPET.format(module=module)],
+                            cwd=REPO_DIR, env=env, capture_output=True, text=True, check=True)
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--budget', action='append', default=[], metavar='MODULE=MS',
+                        help='override the budget of one module')
+    args = parser.parse_args()
+    budgets = dict(DEFAULT_BUDGETS_MS)
+    for item in args.budget:
+        module, ms = item.split('=')
+        budgets[module] = float(ms)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ)
+        if not os.path.exists(os.path.join(REPO_DIR, 'key.py')):
+            with open(os.path.join(tmp, 'key.py'), 'w') as f:
+                f.write(KEY_STUB)
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [REPO_DIR, tmp, env.get('PYTHONPATH')]))
+        env['PYTHONDONTWRITEBYTECODE'] = '1'
+
+        failed = False
+        print(f"{'module':<18} {'median (ms)':>12} {'budget (ms)':>12}")
+        for module, budget in budgets.items():
+            median = statistics.median(import_time_ms(module, env) for _ in range(args.runs))
+            over = median > budget
+            failed |= over
+            print(f"{module:<18} {median:>12.1f} {budget:>12.0f}{'  OVER BUDGET' if over else ''}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""Benchmark: write amplification and disk usage of tiered server_data storage.
+
+Replays `--days` of 10 s samples at simulated time through store_server_data(), applying the
+retention policies every RETENTION_INTERVAL_SECONDS of simulated time like the collector does,
+then reports bytes written per sample and the size of every tier. Once the simulated span is
+longer than the 1 minute tier's retention the file size is at its steady state, so
+
+    python benchmarks/bench_storage.py --days 365
+
+shows what a year of samples costs on disk.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+import database_script
+import history
+
+INTERVAL = 10  # Seconds between samples, like SERVER_DATA_INTERVAL_SECONDS
+PAYLOAD_BYTES = 7 * 8  # One sample as seven 8-byte numbers, the logical size of a write
+
+
+def bytes_written():
+    """Bytes this process has passed to write() so far (Linux), or None."""
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('wchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+
+
+def synthetic_sample(rng, step):
+    cpu = max(0.0, min(100.0, 15 + 10 * rng.random() + (40 if step % 360 < 30 else 0)))
+    return {'cpu_percent': round(cpu, 1), 'memory_total': 8467419136, 'memory_available': 1699262464,
+            'memory_percent': round(60 + 20 * rng.random(), 1), 'disk_total': 95865159680,
+            'disk_used': 38014885888, 'disk_percent': round(39 + step / 1e6, 1)}
+
+
+def table_sizes(path):
+    rows = {table: db.query_one(f'SELECT COUNT(*) FROM {table}')[0]
+            for table in ['server_data', *(t for t, _ in history.ROLLUP_TIERS)]}
+    page_size = db.query_one('PRAGMA page_size')[0]
+    pages = db.query_one('PRAGMA page_count')[0]
+    free = db.query_one('PRAGMA freelist_count')[0]
+    wal = path + '-wal'
+    return rows, {'file': os.path.getsize(path), 'wal': os.path.getsize(wal) if os.path.exists(wal) else 0,
+                  'used': (pages - free) * page_size, 'free': free * page_size}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--days', type=float, default=30)
+    parser.add_argument('--dir', default=None, help='directory for the scratch database (default: a temp dir)')
+    args = parser.parse_args()
+
+    samples = int(args.days * 86400 / INTERVAL)
+    rng = random.Random(1)
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        path = os.path.join(tmp, 'bench.db')
+        db.DATABASE_NAME = path
+        database_script.init_database()
+
+        now = int(time.time()) - samples * INTERVAL
+        next_retention = now + database_script.RETENTION_INTERVAL_SECONDS
+        written_before = bytes_written()
+        started = time.perf_counter()
+        for step in range(samples):
+            database_script.store_server_data(synthetic_sample(rng, step), now=now)
+            if now >= next_retention:
+                history.apply_retention(now)
+                next_retention += database_script.RETENTION_INTERVAL_SECONDS
+            now += INTERVAL
+            if step and step % 100000 == 0:
+                print(f"  {step}/{samples} samples ({step * INTERVAL / 86400:.0f} days)", flush=True)
+        elapsed = time.perf_counter() - started
+        written_after = bytes_written()
+        with db.transaction() as conn:
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        rows, sizes = table_sizes(path)
+
+    print(f"simulated: {args.days:g} days, {samples} samples, {elapsed / samples * 1e6:.1f} us per sample")
+    if written_before is not None:
+        written = written_after - written_before
+        print(f"written:   {written / 2**20:.1f} MiB, {written / samples:.0f} bytes per sample,"
+              f" write amplification {written / (samples * PAYLOAD_BYTES):.0f}x")
+    for table, count in rows.items():
+        print(f"  {table:<16} {count:>9} rows (retention {history.RETENTION_SECONDS[table] / 86400:g} days)")
+    print(f"file:      {sizes['file'] / 2**20:.2f} MiB ({sizes['used'] / 2**20:.2f} MiB used,"
+          f" {sizes['free'] / 2**20:.2f} MiB free pages), wal {sizes['wal'] / 2**20:.2f} MiB")
+
+
+if __name__ == '__main__':
+    main()
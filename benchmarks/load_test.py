@@ -0,0 +1,161 @@
+"""Load test: requests/s and latency percentiles of the web server's hot endpoints.
+
+Runs `--concurrency` client threads, each with its own keep-alive session, against /server_info,
+/recent_server_data and /dashboard for `--duration` seconds per endpoint. Either point it at a
+running server or let it start one per mode on a free port and compare:
+
+    python benchmarks/load_test.py --url http://127.0.0.1:80 --user admin --password secret
+    python benchmarks/load_test.py --mode dev --mode production --user admin --password secret
+
+`dev` is small_server.py's app.run(debug=True) (without the reloader), `production` is wsgi.py
+with its default server and `--workers`/`--threads`, `async` is async_server.py (needs aiohttp).
+/dashboard needs a login; without credentials it is skipped.
+"""
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import requests
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENDPOINTS = ('/server_info', '/recent_server_data', '/dashboard')
+STARTUP_TIMEOUT_SECONDS = 60
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(mode, port, workers, threads):
+    if mode == 'dev':
+        command = [sys.executable, '-c',
+                   f"import small_server; small_server.start_background_services(); "
+                   f"small_server.app.run(host='127.0.0.1', port={port}, debug=True, use_reloader=False)"]
+    elif mode == 'async':
+        command = [sys.executable, os.path.join(REPO_DIR, 'async_server.py'), '--bind', f"127.0.0.1:{port}"]
+    else:
+        command = [sys.executable, os.path.join(REPO_DIR, 'wsgi.py'), '--bind', f"127.0.0.1:{port}",
+                   '--workers', str(workers), '--threads', str(threads)]
+    env = {**os.environ, 'PYTHONPATH': os.pathsep.join(filter(None, [REPO_DIR, os.environ.get('PYTHONPATH')]))}
+    process = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + STARTUP_TIMEOUT_SECONDS
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{mode} server exited with code {process.returncode}")
+        try:
+            requests.get(url + '/uptime', timeout=1)
+            return process, url
+        except requests.RequestException:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f"{mode} server did not start within {STARTUP_TIMEOUT_SECONDS} s")
+
+
+def stop_server(process):
+    process.terminate()  # SIGTERM, the graceful shutdown path
+    try:
+        process.wait(15)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def login(session, url, user, password):
+    response = session.post(url + '/login', data={'username': user, 'password': password}, allow_redirects=False)
+    return response.status_code in (302, 303) and 'dashboard' in response.headers.get('Location', '')
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def hammer(url, path, concurrency, duration):
+    """Runs the clients against one endpoint; returns latencies in seconds, errors and elapsed time."""
+    latencies, errors = [], [0]
+    lock = threading.Lock()
+    start = threading.Barrier(concurrency + 1)
+    stop_at = []
+
+    def client():
+        session = requests.Session()
+        own, failed = [], 0
+        start.wait()
+        while time.perf_counter() < stop_at[0]:
+            began = time.perf_counter()
+            try:
+                response = session.get(url + path, timeout=30, allow_redirects=False)
+                ok = response.status_code == 200
+            except requests.RequestException:
+                ok = False
+            if ok:
+                own.append(time.perf_counter() - began)
+            else:
+                failed += 1
+        with lock:
+            latencies.extend(own)
+            errors[0] += failed
+
+    workers = [threading.Thread(target=client, daemon=True) for _ in range(concurrency)]
+    for worker in workers:
+        worker.start()
+    began = time.perf_counter()
+    stop_at.append(began + duration)
+    start.wait()
+    for worker in workers:
+        worker.join()
+    return latencies, errors[0], time.perf_counter() - began
+
+
+def run(url, label, args):
+    session = requests.Session()
+    logged_in = bool(args.user) and login(session, url, args.user, args.password)
+    if args.user and not logged_in:
+        print(f"  Login as {args.user} failed; /dashboard is skipped.")
+    for path in ENDPOINTS:
+        if path == '/dashboard' and not logged_in:
+            continue
+        session.get(url + path, timeout=30)  # Warm caches and connections
+        latencies, errors, elapsed = hammer(url, path, args.concurrency, args.duration)
+        latencies.sort()
+        p50, p99 = percentile(latencies, 0.50), percentile(latencies, 0.99)
+        print(f"  {label:<11} {path:<20} {len(latencies) / elapsed:8.1f} req/s"
+              f"  p50 {p50 * 1000 if p50 is not None else float('nan'):7.1f} ms"
+              f"  p99 {p99 * 1000 if p99 is not None else float('nan'):7.1f} ms  errors {errors}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', help='test a running server instead of starting one')
+    parser.add_argument('--mode', action='append', choices=('dev', 'production', 'async'),
+                        help='server to start; repeat to compare (default: both)')
+    parser.add_argument('--workers', type=int, default=2, help='production server processes')
+    parser.add_argument('--threads', type=int, default=8, help='production server threads per process')
+    parser.add_argument('--concurrency', type=int, default=16, help='concurrent clients')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per endpoint')
+    parser.add_argument('--user')
+    parser.add_argument('--password')
+    args = parser.parse_args()
+
+    print(f"{args.concurrency} clients, {args.duration:g} s per endpoint")
+    if args.url:
+        run(args.url.rstrip('/'), 'server', args)
+        return
+    for mode in args.mode or ['dev', 'production']:
+        process, url = start_server(mode, free_port(), args.workers, args.threads)
+        try:
+            run(url, mode, args)
+        finally:
+            stop_server(process)
+
+
+if __name__ == '__main__':
+    main()
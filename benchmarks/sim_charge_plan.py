@@ -0,0 +1,138 @@
+"""Simulation: cost of threshold-only charging vs following the charge planner.
+
+Replays hourly prices and solar forecasts, either the historical rows of a database or a
+synthetic series, through a simple battery model and two policies:
+
+- threshold: plug in below the low threshold, unplug at the high one (the old controller)
+- planner:   re-plan every hour with only the data known at that time (tomorrow's prices from
+             13:00, a 72 h solar forecast) and follow the current slot; thresholds still win
+
+and reports the grid energy and cost of both, and the planner's run time.
+
+    python benchmarks/sim_charge_plan.py --db server_data.db
+    python benchmarks/sim_charge_plan.py --synthetic-days 60 --mode solar
+"""
+import argparse
+import math
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+import charge_planner as cp
+
+LOCAL_ZONE = ZoneInfo('Europe/Stockholm')
+PRICE_PUBLISH_HOUR = 13
+SOLAR_HORIZON_HOURS = 72
+
+
+def synthetic_series(days, seed=1):
+    """Hourly prices with morning/evening peaks and solar power on a clear/cloudy daily curve."""
+    rng = random.Random(seed)
+    start = datetime.now(LOCAL_ZONE).replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=days)
+    prices, solar = {}, {}
+    for day in range(days):
+        clouds = rng.uniform(0.1, 1.0)
+        level = rng.uniform(0.3, 1.2)
+        for hour in range(24):
+            moment = start + timedelta(days=day, hours=hour)
+            epoch = int(moment.timestamp())
+            peaks = math.exp(-((hour - 8) / 2) ** 2) + math.exp(-((hour - 18) / 2.5) ** 2)
+            prices[epoch] = round(max(0.01, level * (0.4 + 0.8 * peaks) + rng.gauss(0, 0.05)), 4)
+            daylight = math.sin(math.pi * (hour - 5) / 16) if 5 < hour < 21 else 0.0
+            solar[epoch] = round(max(0.0, 900 * daylight * clouds), 1)
+    return prices, solar
+
+
+def known_prices(prices, now):
+    """Prices published by `now`: today's, and tomorrow's from PRICE_PUBLISH_HOUR."""
+    local = datetime.fromtimestamp(now, LOCAL_ZONE)
+    days = 2 if local.hour >= PRICE_PUBLISH_HOUR else 1
+    until = (local.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=days)).timestamp()
+    return {h: p for h, p in prices.items() if h < until}
+
+
+def simulate(prices, solar, policy, args):
+    hours = sorted(prices)
+    level = args.start_level
+    plugged = False
+    wh_per_percent = cp.DEFAULT_ENERGY_PER_CYCLE_WH / (args.high - args.low)
+    totals = {'cost': 0.0, 'grid_wh': 0.0, 'solar_wh': 0.0, 'min_level': level, 'max_level': level,
+              'plans': 0, 'plan_seconds': 0.0}
+    for now in hours:
+        if policy == 'threshold':
+            if level < args.low:
+                plugged = True
+            elif level >= args.high:
+                plugged = False
+        else:
+            visible_solar = {h: w for h, w in solar.items() if now <= h < now + SOLAR_HORIZON_HOURS * 3600}
+            slots = cp.build_slots(known_prices(prices, now), visible_solar, now, args.mode)
+            started = time.perf_counter()
+            plan = cp.plan_charging(slots, level, args.low, args.high, args.charge_rate, args.discharge_rate,
+                                    cp.DEFAULT_ENERGY_PER_CYCLE_WH, args.mode) if slots else None
+            totals['plan_seconds'] += time.perf_counter() - started
+            totals['plans'] += 1
+            plugged = plan['slots'][0]['charge'] if plan else plugged
+            if level < args.low:
+                plugged = True
+            elif level >= args.high:
+                plugged = False
+
+        if plugged:
+            gained = min(args.charge_rate, max(0.0, args.high - level))
+            energy = (gained + args.discharge_rate) * wh_per_percent
+            grid = energy * cp.grid_fraction(solar.get(now, 0.0))
+            totals['grid_wh'] += grid
+            totals['solar_wh'] += energy - grid
+            totals['cost'] += grid / 1000 * prices[now]
+            level += gained
+        else:
+            level -= args.discharge_rate
+        totals['min_level'] = min(totals['min_level'], level)
+        totals['max_level'] = max(totals['max_level'], level)
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--db', help='replay electricity_prices and solar_data from this database')
+    parser.add_argument('--synthetic-days', type=int, default=30)
+    parser.add_argument('--mode', choices=cp.PLAN_MODES, default='cost')
+    parser.add_argument('--low', type=float, default=cp.DEFAULT_LOW_PERCENT)
+    parser.add_argument('--high', type=float, default=cp.DEFAULT_HIGH_PERCENT)
+    parser.add_argument('--charge-rate', type=float, default=cp.DEFAULT_CHARGE_RATE_PERCENT_PER_HOUR)
+    parser.add_argument('--discharge-rate', type=float, default=cp.DEFAULT_DISCHARGE_RATE_PERCENT_PER_HOUR)
+    parser.add_argument('--start-level', type=float, default=60)
+    args = parser.parse_args()
+
+    if args.db:
+        db.DATABASE_NAME = args.db
+        prices, solar = cp.load_prices(0), cp.load_solar(0)
+        source = args.db
+    else:
+        prices, solar = synthetic_series(args.synthetic_days)
+        source = f"synthetic, {args.synthetic_days} days"
+    if not prices:
+        sys.exit("No prices to replay.")
+
+    print(f"Replaying {len(prices)} hours ({source}), mode {args.mode}")
+    results = {policy: simulate(prices, solar, policy, args) for policy in ('threshold', 'planner')}
+    for policy, totals in results.items():
+        print(f"  {policy:<9} cost {totals['cost']:8.4f} SEK  grid {totals['grid_wh']:8.1f} Wh"
+              f"  solar {totals['solar_wh']:7.1f} Wh  level {totals['min_level']:.0f}-{totals['max_level']:.0f}%")
+    baseline, planned = results['threshold'], results['planner']
+    if baseline['cost'] > 0:
+        print(f"savings: {(1 - planned['cost'] / baseline['cost']) * 100:.1f}% of cost,"
+              f" {baseline['grid_wh'] - planned['grid_wh']:.1f} Wh less grid energy")
+    if planned['plans']:
+        print(f"planner: {planned['plans']} plans, {planned['plan_seconds'] / planned['plans'] * 1000:.2f} ms each")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,498 @@
+"""Benchmark suite: routes, SQLite layer, collector and startup, as JSON for comparing commits.
+
+Runs offline: the providers are answered by stub_server.py (PROVIDER_BACKEND=stub) from the
+recorded fixtures, and everything runs in a scratch directory with a synthetic server_data.db of
+`--server-rows` 10 s samples (plus their rollups and system samples), `--price-days` of hourly
+prices and `--solar-days` of forecast hours. Sections (`--only` picks some):
+
+  startup    cold import time of the collector and the web server, see bench_startup.py
+  db         every helper_server read and database_script write, called directly
+  routes     latency and throughput of each GET route through Flask's test client
+  server     the same routes against wsgi.py on a real socket, concurrent clients (load_test.py)
+  collector  each collector job and one full cycle of all of them
+
+    python benchmarks/suite.py --server-rows 200000 --output before.json
+    python benchmarks/suite.py --server-rows 200000 --output after.json
+    python benchmarks/suite.py --compare before.json after.json --threshold 0.2
+
+--compare lists every median/p50 that got slower (and throughput that dropped) by more than the
+threshold and exits non-zero if there is any, so it can gate CI.
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+import requests
+
+import bench_startup
+import load_test
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+SECTIONS = ('startup', 'db', 'routes', 'server', 'collector')
+STARTUP_MODULES = ('database_script', 'small_server')
+INTERVAL = 10  # Seconds between synthetic samples, like SERVER_DATA_INTERVAL_SECONDS
+BENCH_USER, BENCH_PASSWORD = 'bench', 'bench'  # Added to the key.py stub; a real key.py needs --user/--password
+ROUTES = (
+    '/server_info',
+    '/recent_server_data',
+    '/recent_server_data?since={since}',
+    '/system_sample',
+    '/server_history',
+    '/server_history?mode=lttb',
+    '/electricity_price',
+    '/solar_data',
+    '/energy_summary',
+    '/charge_plan',
+    '/shelly_plug_data',
+    '/solar_arrays',
+    '/cache_stats',
+    '/collector_stats',
+    '/metrics',
+    '/uptime',
+    '/dashboard',
+)
+SERVER_ROUTES = ('/server_info', '/recent_server_data', '/recent_server_data?since={since}',
+                 '/electricity_price', '/energy_summary', '/dashboard')
+COMPARED = {'p50_ms': 1, 'median_ms': 1, 'per_second': -1}  # Metric -> 1 if higher is worse, -1 if lower is
+TILTED_ARRAYS = [{"name": "south", "area": 30, "efficiency": 0.2, "tilt": 35, "azimuth": 180}]
+
+
+# --- Measurements ---
+def summarize(durations, elapsed=None):
+    """Latency statistics of call durations in seconds. per_second is calls over the total time,
+    or over `elapsed` for concurrent clients."""
+    if not durations:
+        return {'count': 0}
+    ordered = sorted(durations)
+    total = elapsed if elapsed is not None else sum(ordered)
+    return {
+        'count': len(ordered),
+        'mean_ms': round(statistics.fmean(ordered) * 1000, 4),
+        'p50_ms': round(load_test.percentile(ordered, 0.50) * 1000, 4),
+        'p95_ms': round(load_test.percentile(ordered, 0.95) * 1000, 4),
+        'max_ms': round(ordered[-1] * 1000, 4),
+        'per_second': round(len(ordered) / total, 1) if total > 0 else None,
+    }
+
+
+def time_calls(func, iterations, warmup=1):
+    """Calls func `warmup` times untimed, then `iterations` times; returns summarize()."""
+    for _ in range(warmup):
+        func()
+    durations = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - started)
+    return summarize(durations)
+
+
+def guarded(label, func, *args):
+    """func(*args), or {"error"} if it raised, so one broken entry doesn't end the run."""
+    try:
+        return func(*args)
+    except Exception as e:
+        print(f"  {label} failed: {e}", file=sys.stderr)
+        return {'error': f"{type(e).__name__}: {e}"}
+
+
+# --- Environment ---
+def prepare_environment(workdir, stub_port):
+    """Points every provider at the stub server and makes key.py importable. Must run before the
+    first repo module is imported: providers read the backend at import time."""
+    os.environ['PROVIDER_BACKEND'] = 'stub'
+    os.environ['PROVIDER_STUB_URL'] = f"http://127.0.0.1:{stub_port}"
+    os.environ['LOG_DIR'] = os.path.join(workdir, 'logs')
+    stubbed = not os.path.exists(os.path.join(REPO_DIR, 'key.py'))
+    if stubbed:
+        with open(os.path.join(workdir, 'key.py'), 'w') as f:
+            f.write(bench_startup.KEY_STUB.replace('USERS = {}', f"USERS = {{{BENCH_USER!r}: {BENCH_PASSWORD!r}}}"))
+        sys.path.insert(1, workdir)
+    os.environ['PYTHONPATH'] = os.pathsep.join(filter(None, [REPO_DIR, workdir if stubbed else None,
+                                                             os.environ.get('PYTHONPATH')]))
+    return stubbed
+
+
+def synthetic_sample(rng, step):
+    cpu = max(0.0, min(100.0, 15 + 10 * rng.random() + (40 if step % 360 < 30 else 0)))
+    return {'cpu_percent': round(cpu, 1), 'memory_total': 8467419136, 'memory_available': 1699262464,
+            'memory_percent': round(60 + 20 * rng.random(), 1), 'disk_total': 95865159680,
+            'disk_used': 38014885888, 'disk_percent': round(39 + step / 1e6, 1)}
+
+
+def synthetic_prices(start_epoch, hours, seed=0):
+    """elprisetjustnu items for `hours` hours from start_epoch (a full hour)."""
+    import energy_views
+    rng = random.Random(seed)
+    items = []
+    for hour in range(hours):
+        start = datetime.fromtimestamp(start_epoch + hour * 3600, energy_views.LOCAL_ZONE)
+        price = round(0.4 + 0.3 * math.sin(hour / 24 * 2 * math.pi) + 0.2 * rng.random(), 5)
+        items.append({'SEK_per_kWh': price, 'EUR_per_kWh': round(price / 11, 5), 'EXR': 11.0,
+                      'time_start': start.isoformat(), 'time_end': (start + timedelta(hours=1)).isoformat()})
+    return items
+
+
+def synthetic_forecast(start_epoch, hours, seed=0):
+    """An Open-Meteo hourly response for `hours` hours from start_epoch, in local wall-clock time."""
+    import database_script
+    import energy_views
+    import solar_model
+    rng = random.Random(seed)
+    epochs = [start_epoch + hour * 3600 for hour in range(hours)]
+    zenith, _ = solar_model.sun_position(epochs, database_script.latitude, database_script.longitude)
+    ghi = [round(max(0.0, 900 * math.cos(math.radians(z))) * rng.uniform(0.3, 1.0), 1) for z in zenith.tolist()]
+    return {'timezone': 'Europe/Stockholm', 'hourly': {
+        'time': [datetime.fromtimestamp(epoch, energy_views.LOCAL_ZONE).strftime('%Y-%m-%dT%H:%M') for epoch in epochs],
+        'shortwave_radiation': ghi,
+        'temperature_2m': [round(8 + 6 * math.sin((epoch % 86400) / 86400 * 2 * math.pi - 2) + rng.gauss(0, 1), 1)
+                           for epoch in epochs],
+    }}
+
+
+def build_database(path, server_rows, price_days, solar_days, now):
+    """A fresh database at `path` with the synthetic data; returns the row count per table."""
+    import db
+    import database_script
+    import history
+    db.DATABASE_NAME = path
+    database_script.init_database()
+    rng = random.Random(1)
+    first = int(now) - (server_rows - 1) * INTERVAL
+    rows = []
+    for step in range(server_rows):
+        sample = synthetic_sample(rng, step)
+        epoch = first + step * INTERVAL
+        rows.append((step + 1, datetime.fromtimestamp(epoch, timezone.utc).strftime('%Y-%m-%d %H:%M:%S'),
+                     *(sample[field] for field in ('cpu_percent', 'memory_total', 'memory_available', 'memory_percent',
+                                                   'disk_total', 'disk_used', 'disk_percent'))))
+    columns = ", ".join(f"{m}_min, {m}_max, {m}_sum" for m in history.METRICS)
+    aggregates = ", ".join(f"MIN({m}), MAX({m}), SUM({m})" for m in history.METRICS)
+    scaled = ", ".join(f"CAST(ROUND({history.RAW_COLUMNS[m]} * {history.SCALE}) AS INTEGER) AS {m}"
+                       for m in history.METRICS)
+    with db.transaction() as conn:
+        conn.executemany('''
+            INSERT INTO server_data (id, timestamp, cpu_percent, memory_total, memory_available, memory_percent,
+                                     disk_total, disk_used, disk_percent)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', rows)
+        # The rollups and system samples the collector would have written along with the samples
+        for table, width in history.ROLLUP_TIERS:
+            conn.execute(f'''
+                INSERT INTO {table} (bucket, samples, {columns})
+                SELECT bucket, COUNT(*), {aggregates}
+                FROM (SELECT CAST(strftime('%s', timestamp) AS INTEGER) / {width} * {width} AS bucket, {scaled}
+                      FROM server_data)
+                GROUP BY bucket
+            ''')
+        conn.execute('''
+            INSERT INTO system_samples (sample_id, time_epoch, samples, cpu_max_percent, load_1, load_5, load_15,
+                                        net_sent_bps, net_recv_bps, net_peak_bps,
+                                        disk_read_bps, disk_write_bps, disk_peak_bps, details)
+            SELECT id, CAST(strftime('%s', timestamp) AS INTEGER), 10, MIN(100, cpu_percent * 1.5), 0.6, 0.5, 0.4,
+                   2400, 5100, 9800, 0, 41000, 120000, '{"cpu_per_core": null, "temperatures": null, "top_processes": null}'
+            FROM server_data
+        ''')
+    hour = int(now) - int(now) % 3600
+    start = datetime.fromtimestamp(hour)
+    database_script.store_electricity_data(synthetic_prices(hour - (price_days - 2) * 86400, price_days * 24), now=start)
+    database_script.store_solar_data(synthetic_forecast(hour - (solar_days - 3) * 86400, solar_days * 24), now=start)
+    return {table: db.query_one(f'SELECT COUNT(*) FROM {table}')[0]
+            for table in ('server_data', *(t for t, _ in history.ROLLUP_TIERS), 'system_samples',
+                          'electricity_prices', 'solar_data')}
+
+
+# --- Sections ---
+def bench_startup_section(args):
+    env = {**os.environ, 'PYTHONDONTWRITEBYTECODE': '1'}
+    results = {}
+    for module in STARTUP_MODULES:
+        def measure():
+            runs = [round(bench_startup.import_time_ms(module, env), 2) for _ in range(args.startup_runs)]
+            return {'median_ms': round(statistics.median(runs), 2), 'runs_ms': runs}
+        results[module] = guarded(module, measure)
+    return results
+
+
+def bench_db_section(args):
+    """Each read with SQLite as its only source (no sample ring yet), then each write."""
+    import charge_planner
+    import database_script
+    import helper_server
+    import history
+    import sample_ring
+    import solar_model
+    now = time.time()
+    last_id = helper_server.get_latest_server_data_id()
+    reads = {
+        'helper_server.get_latest_server_data': helper_server.get_latest_server_data,
+        'helper_server.get_recent_server_data': helper_server.get_recent_server_data,
+        'helper_server.get_server_data_since': lambda: helper_server.get_server_data_since(last_id - 5),
+        'helper_server.get_latest_server_data_id': helper_server.get_latest_server_data_id,
+        'helper_server.get_latest_system_sample': helper_server.get_latest_system_sample,
+        'helper_server.fetch_electricity_data_from_database': helper_server.fetch_electricity_data_from_database,
+        'helper_server.fetch_solar_data_from_database': helper_server.fetch_solar_data_from_database,
+        'helper_server.get_energy_summary': helper_server.get_energy_summary,
+        'helper_server.get_table_generation': lambda: helper_server.get_table_generation('solar_data'),
+        'database_script.get_latest_electricity_prices': database_script.get_latest_electricity_prices,
+        'database_script.get_collector_stats': database_script.get_collector_stats,
+        'history.get_bucketed_history (24 h)': lambda: history.get_bucketed_history(now - 86400, now, 200),
+        'history.get_lttb_history (24 h)': lambda: history.get_lttb_history(now - 86400, now, 200),
+    }
+    results = {'reads': {}, 'writes': {}}
+    for name, func in reads.items():
+        results['reads'][name] = guarded(name, time_calls, func, args.iterations)
+
+    rng = random.Random(2)
+    state = {'epoch': int(now), 'seq': last_id, 'step': 0}
+
+    def store_server_data():
+        state['epoch'] += INTERVAL
+        state['step'] += 1
+        database_script.store_server_data(synthetic_sample(rng, state['step']), now=state['epoch'])
+
+    def store_server_samples():
+        records = []
+        for _ in range(database_script.SERVER_DATA_BATCH_SIZE):
+            state['seq'] += 1
+            state['epoch'] += INTERVAL
+            sample = synthetic_sample(rng, state['seq'])
+            records.append((state['seq'], state['epoch'], *(sample[f] for f in sample_ring.SAMPLE_FIELDS), state['seq']))
+        database_script.store_server_samples(records)
+
+    hour = int(now) - int(now) % 3600
+    prices = synthetic_prices(hour, 48)
+    forecast = synthetic_forecast(hour, 72)
+    revisions = iter(range(1, 10 ** 9))
+
+    def revised_prices():
+        revision = next(revisions)
+        return [{**item, 'SEK_per_kWh': item['SEK_per_kWh'] + revision * 1e-4} for item in prices]
+
+    def revised_forecast():
+        revision = next(revisions)
+        hourly = forecast['hourly']
+        return {**forecast, 'hourly': {**hourly, 'temperature_2m': [t + revision * 0.01 for t in hourly['temperature_2m']]}}
+
+    arrays = [solar_model.parse_arrays(solar_model.DEFAULT_ARRAYS), solar_model.parse_arrays(TILTED_ARRAYS)]
+    writes = {
+        'database_script.store_server_data': store_server_data,
+        'database_script.store_server_samples (batch)': store_server_samples,
+        'database_script.store_electricity_data (unchanged)': lambda: database_script.store_electricity_data(prices),
+        'database_script.store_electricity_data (revised)': lambda: database_script.store_electricity_data(revised_prices()),
+        'database_script.store_solar_data (unchanged)': lambda: database_script.store_solar_data(forecast),
+        'database_script.store_solar_data (revised)': lambda: database_script.store_solar_data(revised_forecast()),
+        'database_script.recompute_solar_predictions (unchanged)': lambda: database_script.recompute_solar_predictions(arrays[0]),
+        'database_script.recompute_solar_predictions (changed)':
+            lambda: database_script.recompute_solar_predictions(arrays[next(revisions) % 2]),
+        'charge_planner.update_charge_plan': lambda: charge_planner.update_charge_plan('cost', level=60),
+        'history.apply_retention': history.apply_retention,
+    }
+    for name, func in writes.items():
+        results['writes'][name] = guarded(name, time_calls, func, args.write_iterations)
+    return results
+
+
+def route_paths(routes, since):
+    return {path.replace('{since}', 'last_id-5'): path.format(since=since) for path in routes}
+
+
+def bench_routes_section(args, since):
+    import small_server
+    small_server.logged_in = True  # /dashboard, as after a login
+    client = small_server.app.test_client()
+    results = {}
+    for label, path in route_paths(ROUTES, since).items():
+        def measure():
+            status = client.get(path).status_code
+            if status >= 400:
+                raise RuntimeError(f"HTTP {status}")
+            return time_calls(lambda: client.get(path), args.iterations)
+        results[label] = guarded(label, measure)
+    return results
+
+
+def bench_server_section(args, since):
+    process, url = load_test.start_server('production', load_test.free_port(), args.workers, args.threads)
+    results = {'concurrency': args.concurrency, 'duration_seconds': args.duration, 'routes': {}}
+    try:
+        session = requests.Session()
+        logged_in = load_test.login(session, url, args.user, args.password) if args.user else False
+        for label, path in route_paths(SERVER_ROUTES, since).items():
+            if path == '/dashboard' and not logged_in:
+                results['routes'][label] = {'skipped': 'login failed or no --user'}
+                continue
+            session.get(url + path, timeout=30)  # Warm caches and connections
+            latencies, errors, elapsed = load_test.hammer(url, path, args.concurrency, args.duration)
+            results['routes'][label] = {**summarize(latencies, elapsed), 'errors': errors}
+    finally:
+        load_test.stop_server(process)
+    return results
+
+
+def bench_collector_section(args):
+    """Each job on its own, then whole cycles. The first server_data call opens the sample ring,
+    later ones append to it and flush a batch to SQLite every SERVER_DATA_BATCH_SIZE samples."""
+    import database_script
+    jobs = {
+        'server_data': database_script.collect_server_data,
+        'electricity_prices': database_script.collect_electricity_prices,
+        'solar_forecast': database_script.collect_solar_forecast,
+        'charge_plan': database_script.collect_charge_plan,
+        'retention': database_script.collect_retention,
+    }
+    results = {name: guarded(name, time_calls, job, args.collector_iterations) for name, job in jobs.items()}
+
+    def cycle():
+        for job in jobs.values():
+            job()
+    results['cycle'] = guarded('cycle', time_calls, cycle, args.collector_iterations, 0)
+    database_script.flush_server_samples()
+    return results
+
+
+# --- Reports ---
+def git_revision():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=REPO_DIR,
+                                    capture_output=True, text=True, check=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+
+def flatten(results, prefix=()):
+    """(path, metric, value) of every compared metric in a report."""
+    for key, value in results.items():
+        if isinstance(value, dict):
+            yield from flatten(value, prefix + (key,))
+        elif key in COMPARED and isinstance(value, (int, float)):
+            yield ' / '.join(prefix), key, value
+
+
+def compare(old_path, new_path, threshold, min_ms):
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    before = {(path, metric): value for path, metric, value in flatten(old['results'])}
+    print(f"{old['meta'].get('commit') or old_path} -> {new['meta'].get('commit') or new_path}, "
+          f"threshold {threshold:.0%}")
+    regressions = 0
+    for path, metric, value in flatten(new['results']):
+        previous = before.get((path, metric))
+        if not previous:
+            continue
+        change = (value - previous) / previous
+        worse = change * COMPARED[metric] > threshold
+        if worse and metric.endswith('_ms') and value - previous < min_ms:
+            worse = False  # Within timer noise however large the ratio
+        if worse or abs(change) > threshold:
+            regressions += worse
+            print(f"  {'REGRESSION' if worse else 'improved  '} {path} {metric}: {previous:g} -> {value:g} ({change:+.0%})")
+    print(f"{regressions} regression(s)")
+    return regressions
+
+
+def run(args):
+    sections = args.only or list(SECTIONS)
+    started = time.time()
+    commit, dirty = git_revision()
+    report = {'meta': {
+        'commit': commit, 'dirty': dirty, 'python': platform.python_version(), 'platform': platform.platform(),
+        'cpus': os.cpu_count(), 'started_at': datetime.fromtimestamp(started).isoformat(timespec='seconds'),
+        'config': {key: value for key, value in vars(args).items() if key not in ('output', 'compare', 'password')},
+    }, 'results': {}}
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(dir=args.dir) as workdir:
+        port = load_test.free_port()
+        stubbed = prepare_environment(workdir, port)
+        import stub_server
+        stub = stub_server.start_stub_server(port)
+        if stubbed and args.user is None:
+            args.user, args.password = BENCH_USER, BENCH_PASSWORD
+        os.chdir(workdir)  # settings.json, logs and the database are relative to the working directory
+        try:
+            if 'startup' in sections:
+                print("startup ...", file=sys.stderr)
+                report['results']['startup'] = bench_startup_section(args)
+            print(f"building a database of {args.server_rows} samples ...", file=sys.stderr)
+            database = os.path.join(workdir, 'server_data.db')
+            build_started = time.perf_counter()
+            report['meta']['rows'] = build_database(database, args.server_rows, args.price_days, args.solar_days, started)
+            report['meta']['build_seconds'] = round(time.perf_counter() - build_started, 2)
+            import helper_server
+            since = helper_server.get_latest_server_data_id() - 5
+            if 'db' in sections:
+                print("db ...", file=sys.stderr)
+                report['results']['db'] = bench_db_section(args)
+            if 'routes' in sections:
+                print("routes ...", file=sys.stderr)
+                report['results']['routes'] = bench_routes_section(args, since)
+            if 'server' in sections:
+                print("server ...", file=sys.stderr)
+                report['results']['server'] = guarded('server', bench_server_section, args, since)
+            if 'collector' in sections:
+                print("collector ...", file=sys.stderr)
+                report['results']['collector'] = bench_collector_section(args)
+        finally:
+            os.chdir(cwd)
+            stub.shutdown()
+            import sample_ring
+            ring = sample_ring.ring_path(os.path.join(workdir, 'server_data.db'))
+            if os.path.exists(ring):
+                os.remove(ring)
+    report['meta']['seconds'] = round(time.time() - started, 1)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two reports instead of running')
+    parser.add_argument('--threshold', type=float, default=0.25, help='relative change counted as a regression')
+    parser.add_argument('--min-ms', type=float, default=0.05, help='smaller latency increases are never regressions')
+    parser.add_argument('--only', action='append', choices=SECTIONS, help='section to run; repeat for several')
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    parser.add_argument('--dir', default=None, help='directory for the scratch files (default: a temp dir)')
+    parser.add_argument('--server-rows', type=int, default=17280, help='synthetic samples (default: two days)')
+    parser.add_argument('--price-days', type=int, default=8)
+    parser.add_argument('--solar-days', type=int, default=8)
+    parser.add_argument('--iterations', type=int, default=200, help='calls per read and per test client route')
+    parser.add_argument('--write-iterations', type=int, default=50, help='calls per write')
+    parser.add_argument('--collector-iterations', type=int, default=20, help='runs per collector job')
+    parser.add_argument('--startup-runs', type=int, default=5)
+    parser.add_argument('--concurrency', type=int, default=8, help='real server: concurrent clients')
+    parser.add_argument('--duration', type=float, default=3, help='real server: seconds per route')
+    parser.add_argument('--workers', type=int, default=2, help='real server: processes')
+    parser.add_argument('--threads', type=int, default=8, help='real server: threads per process')
+    parser.add_argument('--user', help='login for /dashboard (default: the stub user without a key.py)')
+    parser.add_argument('--password')
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(*args.compare, args.threshold, args.min_ms) else 0)
+    report = run(args)
+    text = json.dumps(report, indent=1)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+        print(f"Wrote {args.output}", file=sys.stderr)
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
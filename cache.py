@@ -0,0 +1,198 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+
+log = logging.getLogger('cache')
+
+# --- Registry of all caches, used by the /cache_stats endpoint ---
+CACHES = {}
+
+
+class _Flight:
+    """A single in-progress upstream load that concurrent callers can wait on, from threads or coroutines."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+    def finish(self, value):
+        with self._lock:
+            self.value = value
+            self.done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(value)
+
+    async def wait_async(self):
+        """Waits for the load without blocking the event loop or holding a thread."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def resolve(value):
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(value))
+        with self._lock:
+            if self.done.is_set():
+                return self.value
+            self._callbacks.append(resolve)
+        return await future
+
+
+class TTLCache:
+    """Small in-process cache with a TTL, LRU size bound, single-flight loads and stale-while-revalidate.
+
+    A fresh entry is returned directly. An expired entry is still returned (stale) while one
+    background thread refreshes it. A missing entry is loaded once, and every concurrent caller
+    for the same key waits for that one load instead of calling upstream itself.
+    Only values accepted by `is_good` are stored, so a failed refresh keeps the last good value.
+    """
+
+    def __init__(self, name, ttl_seconds, max_entries=32, is_good=None):
+        self.name = name
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.is_good = is_good or (lambda value: value is not None)
+        self._entries = OrderedDict()  # key -> (value, stored_at)
+        self._inflight = {}  # key -> _Flight
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "stale_hits": 0, "misses": 0, "coalesced": 0,
+                       "upstream_calls": 0, "upstream_errors": 0, "evictions": 0}
+        CACHES[name] = self
+
+    def get(self, key, loader):
+        """Returns the cached value for key, calling loader() upstream only when needed."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, stored_at = entry
+                self._entries.move_to_end(key)
+                if time.monotonic() - stored_at < self.ttl_seconds:
+                    self._stats["hits"] += 1
+                    return value
+                self._stats["stale_hits"] += 1
+                if key not in self._inflight:
+                    flight = self._inflight[key] = _Flight()
+                    threading.Thread(target=self._load, args=(key, loader, flight),
+                                     name=f"cache-refresh-{self.name}", daemon=True).start()
+                return value
+            flight = self._inflight.get(key)
+            if flight is not None:
+                self._stats["coalesced"] += 1
+                owner = False
+            else:
+                self._stats["misses"] += 1
+                flight = self._inflight[key] = _Flight()
+                owner = True
+        if owner:
+            return self._load(key, loader, flight)
+        flight.done.wait()
+        return flight.value
+
+    async def get_async(self, key, loader):
+        """get() for the asyncio server: `loader` is an async function and waiting never blocks
+        the event loop. Entries, single-flight loads and stats are shared with get()."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, stored_at = entry
+                self._entries.move_to_end(key)
+                if time.monotonic() - stored_at < self.ttl_seconds:
+                    self._stats["hits"] += 1
+                    return value
+                self._stats["stale_hits"] += 1
+                if key not in self._inflight:
+                    flight = self._inflight[key] = _Flight()
+                    asyncio.ensure_future(self._load_async(key, loader, flight))
+                return value
+            flight = self._inflight.get(key)
+            if flight is not None:
+                self._stats["coalesced"] += 1
+                owner = False
+            else:
+                self._stats["misses"] += 1
+                flight = self._inflight[key] = _Flight()
+                owner = True
+        if owner:
+            return await self._load_async(key, loader, flight)
+        return await flight.wait_async()
+
+    def _load(self, key, loader, flight):
+        """Calls upstream once, stores a good result and wakes every waiter."""
+        value = None
+        try:
+            value = loader()
+        except Exception as e:
+            log.warning("Cache '%s' refresh failed: %s", self.name, e)
+        return self._store(key, value, flight)
+
+    async def _load_async(self, key, loader, flight):
+        value = None
+        try:
+            value = await loader()
+        except Exception as e:
+            log.warning("Cache '%s' refresh failed: %s", self.name, e)
+        return self._store(key, value, flight)
+
+    def _store(self, key, value, flight):
+        with self._lock:
+            self._stats["upstream_calls"] += 1
+            if self.is_good(value):
+                self._entries[key] = (value, time.monotonic())
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+                    self._stats["evictions"] += 1
+            else:
+                self._stats["upstream_errors"] += 1
+                # Serve the last good value to waiters rather than the failure, if we have one.
+                if key in self._entries:
+                    value = self._entries[key][0]
+            self._inflight.pop(key, None)
+        flight.finish(value)
+        return value
+
+    def invalidate(self, key=None):
+        """Drops one key, or every key when none is given."""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["size"] = len(self._entries)
+            stats["max_entries"] = self.max_entries
+            stats["ttl_seconds"] = self.ttl_seconds
+        lookups = stats["hits"] + stats["stale_hits"] + stats["misses"] + stats["coalesced"]
+        stats["hit_rate"] = round((stats["hits"] + stats["stale_hits"]) / lookups, 3) if lookups else None
+        return stats
+
+
+def cache_stats():
+    """Returns the hit/miss counters of every registered cache."""
+    return {name: cache.stats() for name, cache in CACHES.items()}
+
+
+def _cache_metrics():
+    stats = cache_stats()
+    hits = {name: s["hits"] + s.get("stale_hits", 0) for name, s in stats.items()}
+    # Lookups that had to wait for a load: TTLCache misses and coalesced waits, payload rebuilds.
+    misses = {name: s.get("misses", s.get("rebuilds", 0)) + s.get("coalesced", 0) for name, s in stats.items()}
+    return [
+        ('cache_hits_total', 'counter', 'Cache lookups answered from the cache (fresh or stale)',
+         [({'cache': name}, value) for name, value in hits.items()]),
+        ('cache_misses_total', 'counter', 'Cache lookups that waited for a load',
+         [({'cache': name}, value) for name, value in misses.items()]),
+        ('cache_hit_ratio', 'gauge', 'Share of cache lookups answered from the cache',
+         [({'cache': name}, s["hit_rate"]) for name, s in stats.items()]),
+    ]
+
+
+metrics.add_collector(_cache_metrics)
@@ -0,0 +1,216 @@
+import json
+import logging
+import sqlite3
+import time
+
+import psutil
+
+import db
+
+log = logging.getLogger('charge_planner')
+
+# --- Planner Configuration ---
+# Defaults until the battery controller has persisted its own thresholds and observed rates.
+DEFAULT_LOW_PERCENT = 35
+DEFAULT_HIGH_PERCENT = 80
+DEFAULT_ENERGY_PER_CYCLE_WH = 27.47  # Measured energy per full charge cycle low -> high
+DEFAULT_CHARGE_RATE_PERCENT_PER_HOUR = 40
+DEFAULT_DISCHARGE_RATE_PERCENT_PER_HOUR = 8
+CHARGER_POWER_W = 65  # Grid draw while plugged in; predicted solar power above this covers it fully
+PLAN_MODES = ('cost', 'solar')  # Cheapest grid energy, or most solar-covered charging
+SLOT_SECONDS = 3600  # Prices and forecasts are hourly
+LEVEL_STEPS_PER_PERCENT = 2  # Resolution of the battery level in the search
+
+
+def hour_start(epoch):
+    return int(epoch) - int(epoch) % SLOT_SECONDS
+
+
+def build_slots(prices, solar, now, mode='cost'):
+    """Hourly slots from the current hour to the end of the data the mode needs.
+
+    prices / solar map hour-start epochs to SEK/kWh and predicted W. A cost plan ends with the
+    last known price, a solar plan with the last forecast hour. The first slot starts at `now`.
+    """
+    needed = prices if mode == 'cost' else solar
+    first = hour_start(now)
+    hours = [h for h in needed if h >= first]
+    if not hours:
+        return []
+    slots = []
+    for h in range(first, max(hours) + SLOT_SECONDS, SLOT_SECONDS):
+        slots.append({'start': max(h, int(now)), 'end': h + SLOT_SECONDS,
+                      'price': prices.get(h), 'solar_w': solar.get(h, 0.0)})
+    return slots
+
+
+def grid_fraction(solar_w):
+    """Share of the charger's draw that the predicted solar power does not cover."""
+    return max(0.0, 1.0 - (solar_w or 0.0) / CHARGER_POWER_W)
+
+
+def slot_cost_per_wh(slot, mode):
+    """What one Wh drawn while plugged in costs in this slot, in the unit the mode minimises."""
+    price = slot['price'] if slot['price'] is not None else 0.0
+    if mode == 'solar':
+        return grid_fraction(slot['solar_w']) + price * 1e-6  # Price only breaks ties
+    return price / 1000 * grid_fraction(slot['solar_w'])
+
+
+def plan_charging(slots, level, low, high, charge_rate, discharge_rate, energy_per_cycle_wh, mode='cost'):
+    """Chooses which slots to charge in so the battery stays within [low, high] at minimum cost.
+
+    A dynamic program over (slot, battery level): each slot either discharges at discharge_rate
+    or is plugged in, which adds charge_rate (capped at high, where the controller stops) and
+    runs the machine from the grid. That is O(slots x levels) instead of the 2^slots schedules
+    a brute-force search would try, so a 72 h horizon plans in milliseconds. The plan must end
+    no lower than it started (or at high), so it cannot look cheap by leaving the battery empty.
+
+    Returns {'slots': [... with 'charge' and predicted 'level'], 'cost'} or None if no schedule
+    keeps the battery within its limits.
+    """
+    steps = LEVEL_STEPS_PER_PERCENT
+    wh_per_step = energy_per_cycle_wh / (high - low) / steps
+    floor = round(min(low, level) * steps)
+    ceiling = round(high * steps)
+    start = min(round(level * steps), ceiling)
+    best = {start: 0.0}
+    back = []
+    for slot in slots:
+        hours = (slot['end'] - slot['start']) / SLOT_SECONDS
+        up = round(charge_rate * hours * steps)
+        down = round(discharge_rate * hours * steps)
+        price = slot_cost_per_wh(slot, mode)
+        candidates = {}
+        for idx, cost in best.items():
+            idle = idx - down
+            if idle >= floor and cost < candidates.get(idle, (float('inf'),))[0]:
+                candidates[idle] = (cost, idx, False)
+            charged = min(ceiling, idx + up)
+            # Plugged in, the grid both charges the battery and runs the machine.
+            charge_cost = cost + ((charged - idx) + down) * wh_per_step * price
+            if charge_cost < candidates.get(charged, (float('inf'),))[0]:
+                candidates[charged] = (charge_cost, idx, True)
+        if not candidates:
+            return None
+        best = {idx: entry[0] for idx, entry in candidates.items()}
+        back.append(candidates)
+
+    target = min(start, ceiling)
+    finals = [idx for idx in best if idx >= target] or list(best)
+    idx = min(finals, key=lambda i: (best[i], -i))
+    total = best[idx]
+    planned = []
+    for slot, candidates in zip(reversed(slots), reversed(back)):
+        _, previous, charge = candidates[idx]
+        planned.append({**slot, 'charge': charge, 'level': idx / steps})
+        idx = previous
+    planned.reverse()
+    return {'slots': planned, 'cost': total}
+
+
+def charge_windows(planned_slots):
+    """Merges consecutive charging slots into [start, end] windows."""
+    windows = []
+    for slot in planned_slots:
+        if not slot['charge']:
+            continue
+        if windows and windows[-1][1] == slot['start']:
+            windows[-1][1] = slot['end']
+        else:
+            windows.append([slot['start'], slot['end']])
+    return windows
+
+
+# --- Database inputs and the stored plan ---
+def load_prices(since):
+    """Hourly mean price per hour-start epoch from electricity_prices (which may be quarter-hourly)."""
+    sums = {}
+    for start_epoch, price in db.query_all(
+            'SELECT start_epoch, SEK_per_kWh FROM electricity_prices WHERE start_epoch >= ?',
+            (hour_start(since),)):
+        hour = hour_start(start_epoch)
+        total, count = sums.get(hour, (0.0, 0))
+        sums[hour] = (total + price, count + 1)
+    return {hour: total / count for hour, (total, count) in sums.items()}
+
+
+def load_solar(since):
+    """Predicted solar power per hour-start epoch from solar_data."""
+    rows = db.query_all('SELECT time_epoch, predicted_power FROM solar_data WHERE time_epoch >= ?',
+                        (hour_start(since),))
+    return {hour_start(time_epoch): power or 0.0 for time_epoch, power in rows}
+
+
+def load_battery_parameters():
+    """Thresholds and observed rates persisted by the battery controller, with defaults."""
+    parameters = {'low': DEFAULT_LOW_PERCENT, 'high': DEFAULT_HIGH_PERCENT,
+                  'energy_per_cycle_wh': DEFAULT_ENERGY_PER_CYCLE_WH,
+                  'charge_rate': DEFAULT_CHARGE_RATE_PERCENT_PER_HOUR,
+                  'discharge_rate': DEFAULT_DISCHARGE_RATE_PERCENT_PER_HOUR, 'level': None}
+    try:
+        row = db.query_one('SELECT state FROM battery_state WHERE id = 1')
+    except sqlite3.Error:
+        row = None
+    if row:
+        state = json.loads(row[0])
+        for key in parameters:
+            if state.get(key) is not None:
+                parameters[key] = state[key]
+    battery = psutil.sensors_battery()
+    if battery is not None:
+        parameters['level'] = battery.percent
+    return parameters
+
+
+def update_charge_plan(mode='cost', now=None, level=None):
+    """Re-plans from the stored prices, forecast and battery state and stores the plan.
+
+    Called by the collector after every changed price or forecast ingest. Returns the plan, or
+    None when there is nothing to plan (no data or no battery level). `now` and `level` override
+    the clock and the measured battery level, e.g. in replays.
+    """
+    now = now if now is not None else time.time()
+    parameters = load_battery_parameters()
+    if level is not None:
+        parameters['level'] = level
+    if parameters['level'] is None:
+        return None
+    slots = build_slots(load_prices(now - SLOT_SECONDS), load_solar(now - SLOT_SECONDS), now, mode)
+    if not slots:
+        return None
+    started = time.perf_counter()
+    result = plan_charging(slots, parameters['level'], parameters['low'], parameters['high'],
+                           parameters['charge_rate'], parameters['discharge_rate'],
+                           parameters['energy_per_cycle_wh'], mode)
+    if result is None:
+        log.warning("No charge plan keeps the battery within %s-%s%%.", parameters['low'], parameters['high'])
+        return None
+    plan = {'created_at': int(now), 'mode': mode, 'start_level': parameters['level'],
+            'cost': round(result['cost'], 6), 'windows': charge_windows(result['slots']),
+            'slots': result['slots'], 'plan_seconds': round(time.perf_counter() - started, 4)}
+    db.execute('''
+        INSERT INTO charge_plan (id, created_at, plan) VALUES (1, ?, ?)
+        ON CONFLICT(id) DO UPDATE SET created_at = excluded.created_at, plan = excluded.plan
+    ''', (plan['created_at'], json.dumps(plan)))
+    return plan
+
+
+def get_charge_plan():
+    """The last stored plan, or None."""
+    try:
+        row = db.query_one('SELECT plan FROM charge_plan WHERE id = 1')
+    except sqlite3.Error as e:
+        log.error("SQLite Error while fetching the charge plan: %s", e)
+        return None
+    return json.loads(row[0]) if row else None
+
+
+def planned_slot(plan, now):
+    """The slot of the plan that covers `now`, or None."""
+    if not plan:
+        return None
+    for slot in plan['slots']:
+        if slot['start'] <= now < slot['end']:
+            return slot
+    return None
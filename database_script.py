@@ -1,28 +1,47 @@
 import sqlite3
+import logging
+import threading
 import time
-import psutil
 import datetime
 import requests
+import http_client
 import json
+import re
 from datetime import datetime, timedelta, timezone
-import pandas as pd
-
-DATABASE_NAME = 'server_data.db'
-MAX_ENTRIES = 200
+import db
+import history
+import metrics
+import migrations
+import settings
+import solar_model
+import charge_planner
+import energy_views
+import providers
+import sample_ring
+import structured_log
+import system_sampler
+from db import DATABASE_NAME
+from scheduler import Scheduler
+
+log = logging.getLogger('database_script')
+
+UNCHANGED = "unchanged"  # Returned by the fetchers when the upstream payload did not change
+ELPRIS_PROVIDER = "elprisetjustnu"
+OPEN_METEO_PROVIDER = "open-meteo"
+OPEN_METEO_VOLATILE = re.compile(rb'"generationtime_ms":[0-9.eE+-]+,?')  # Differs on every response
+PRICE_RETENTION_DAYS = 8  # Hourly prices older than this are deleted
+SOLAR_RETENTION_DAYS = 8  # Forecast hours older than this are deleted
 PRICE_AREA = "SE3"  # Define the price area
 
+LOCAL_ZONE = energy_views.LOCAL_ZONE
+
 latitude = 58.41  # Latitude of Linköping
 longitude = 15.62  # Longitude of Linköping
-panel_area = 50  # square meters
-panel_efficiency = 0.15  # 15% efficiency
-beta = -0.004
-T_reference = 25
+# Panel arrays are the 'solar_arrays' setting, see solar_model.DEFAULT_ARRAYS for the format.
 
 def create_table():
     """Creates the server_data table if it doesn't exist."""
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
-    cursor.execute('''
+    db.execute('''
         CREATE TABLE IF NOT EXISTS server_data (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
@@ -35,66 +54,94 @@ def create_table():
             disk_percent REAL
         )
     ''')
-    conn.commit()
-    conn.close()
 
-def fetch_server_info():
-    """Fetches current server information using psutil."""
-    cpu_percent = psutil.cpu_percent()
-    mem = psutil.virtual_memory()
-    disk = psutil.disk_usage('/')
-    return {
-        'cpu_percent': cpu_percent,
-        'memory_total': mem.total,
-        'memory_available': mem.available,
-        'memory_percent': mem.percent,
-        'disk_total': disk.total,
-        'disk_used': disk.used,
-        'disk_percent': disk.percent
-    }
+def init_database():
+    """Creates all tables and applies pending schema migrations."""
+    create_table()
+    create_electricity_table()
+    create_solar_table()
+    version = migrations.migrate()
+    energy_views.backfill_daily_stats(int(time.time()))
+    return version
+
+def prune_before(cursor, table, column, cutoff):
+    """Deletes rows whose indexed time column sorts before cutoff (a range scan on its index)."""
+    cursor.execute(f'DELETE FROM {table} WHERE {column} < ?', (cutoff,))
+    return cursor.rowcount
 
-def store_server_data(data):
-    """Stores the provided server data into the SQLite database and keeps only the last MAX_ENTRIES."""
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
+sampler = system_sampler.SystemSampler()
+
+def fetch_server_info():
+    """Server information aggregated over the samples taken since the previous call, see
+    system_sampler.py; a single sample against the previous call when the sampler isn't running."""
+    return sampler.collect()
+
+SYSTEM_SAMPLE_DETAILS = ('cpu_per_core', 'temperatures', 'top_processes')  # Stored as JSON
+
+def store_system_sample(cursor, sample_id, epoch, data):
+    """Stores the sampler's extra fields of a server_data row, when the sample has them (samples
+    recorded by replay traces or benchmarks may not)."""
+    if 'samples' not in data:
+        return
+    load = data.get('load_average') or (None, None, None)
     cursor.execute('''
-        INSERT INTO server_data (cpu_percent, memory_total, memory_available, memory_percent,
-                                    disk_total, disk_used, disk_percent)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-    ''', (data['cpu_percent'], data['memory_total'], data['memory_available'],
-          data['memory_percent'], data['disk_total'], data['disk_used'], data['disk_percent']))
-    conn.commit()
-
-    # Delete older entries if the number of rows exceeds MAX_ENTRIES
-    cursor.execute(f'''
-        DELETE FROM server_data
-        WHERE id NOT IN (SELECT id FROM server_data ORDER BY timestamp DESC LIMIT {MAX_ENTRIES})
-    ''')
-    conn.commit()
-    conn.close()
+        INSERT OR REPLACE INTO system_samples (sample_id, time_epoch, samples, cpu_max_percent,
+                                               load_1, load_5, load_15, net_sent_bps, net_recv_bps, net_peak_bps,
+                                               disk_read_bps, disk_write_bps, disk_peak_bps, details)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (sample_id, int(epoch), data['samples'], data.get('cpu_max_percent'), *load,
+          data.get('net_sent_bps'), data.get('net_recv_bps'), data.get('net_peak_bps'),
+          data.get('disk_read_bps'), data.get('disk_write_bps'), data.get('disk_peak_bps'),
+          json.dumps({key: data.get(key) for key in SYSTEM_SAMPLE_DETAILS})))
+
+def store_server_data(data, now=None):
+    """Stores the provided server data into the SQLite database and folds it into the rollup
+    tiers. `now` (epoch seconds) defaults to the current time. Old rows are removed by the
+    retention job, see history.apply_retention()."""
+    now = now if now is not None else time.time()
+    with db.transaction() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO server_data (timestamp, cpu_percent, memory_total, memory_available, memory_percent,
+                                        disk_total, disk_used, disk_percent)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (datetime.fromtimestamp(now, timezone.utc).strftime('%Y-%m-%d %H:%M:%S'),
+              data['cpu_percent'], data['memory_total'], data['memory_available'],
+              data['memory_percent'], data['disk_total'], data['disk_used'], data['disk_percent']))
+        store_system_sample(cursor, cursor.lastrowid, now, data)
+        history.update_rollups(cursor, data, now)
+
+def store_server_samples(records, details=None):
+    """Persists sample ring records (seq, epoch, *sample_ring.SAMPLE_FIELDS) in one transaction,
+    keeping their sequence numbers as ids, and folds them into the rollup tiers. `details` maps
+    sequence numbers to the full samples, whose sampler fields the ring doesn't hold."""
+    with db.transaction() as conn:
+        cursor = conn.cursor()
+        cursor.executemany('''
+            INSERT OR IGNORE INTO server_data (id, timestamp, cpu_percent, memory_percent, disk_percent,
+                                               memory_total, memory_available, disk_total, disk_used)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', [(seq, sample_ring.timestamp_text(epoch), *values) for seq, epoch, *values, _ in records])
+        for seq, epoch, *values, _ in records:
+            if details and seq in details:
+                store_system_sample(cursor, seq, epoch, details[seq])
+            history.update_rollups(cursor, dict(zip(sample_ring.SAMPLE_FIELDS, values)), epoch)
 
 
 
 def get_latest_electricity_prices():
     """Retrieves the latest electricity prices from the database."""
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
-    cursor.execute('''
+    return db.query_all('''
         SELECT time_start, SEK_per_kWh
         FROM electricity_prices
-        ORDER BY time_start DESC
+        ORDER BY start_epoch DESC
         LIMIT 2
     ''')
-    results = cursor.fetchall()
-    conn.close()
-    return results
 
 
 def create_electricity_table():
     """Creates the electricity_prices table if it doesn't exist."""
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
-    cursor.execute('''
+    db.execute('''
         CREATE TABLE IF NOT EXISTS electricity_prices (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
@@ -102,44 +149,53 @@ def create_electricity_table():
             SEK_per_kWh REAL
         )
     ''')
-    conn.commit()
-    conn.close()
+
+_price_payloads = {}  # url -> parsed prices from the last changed response
+
+def fetch_price_day(url, label):
+    """Returns (prices, changed) for one day. An unchanged payload is not parsed again; the
+    prices parsed from the last changed response are reused instead."""
+    try:
+        response = http_client.get_if_changed(url, ELPRIS_PROVIDER)
+        if response is None:
+            return _price_payloads.get(url, []), False
+        _price_payloads[url] = response.json()
+        return _price_payloads[url], True
+    except requests.exceptions.RequestException as e:
+        log.warning("Error fetching %s's electricity data: %s", label, e)
+    except json.JSONDecodeError as e:
+        log.warning("Error decoding %s's electricity JSON: %s", label, e)
+    return [], False
 
 def fetch_electricity_price():
     """Fetches and merges electricity prices for the next 24 hours,
-    respecting the API's data availability for the next day."""
+    respecting the API's data availability for the next day.
+    Returns UNCHANGED when neither day's payload changed since the last fetch."""
     now = datetime.now()
     today_str = now.strftime("%Y/%m-%d")
     tomorrow = now + timedelta(days=1)
     tomorrow_str = tomorrow.strftime("%Y/%m-%d")
 
-    today_url = f"https://www.elprisetjustnu.se/api/v1/prices/{today_str}_{PRICE_AREA}.json"
-    tomorrow_url = f"https://www.elprisetjustnu.se/api/v1/prices/{tomorrow_str}_{PRICE_AREA}.json"
+    today_url = providers.url(ELPRIS_PROVIDER, f"/api/v1/prices/{today_str}_{PRICE_AREA}.json")
+    tomorrow_url = providers.url(ELPRIS_PROVIDER, f"/api/v1/prices/{tomorrow_str}_{PRICE_AREA}.json")
 
-    today_data = []
     tomorrow_data = []
+    tomorrow_changed = False
 
-    try:
-        today_response = requests.get(today_url)
-        today_response.raise_for_status()
-        today_data = today_response.json()
-    except requests.exceptions.RequestException as e:
-        print(f"Error fetching today's electricity data: {e}")
-    except json.JSONDecodeError as e:
-        print(f"Error decoding today's electricity JSON: {e}")
+    today_data, today_changed = fetch_price_day(today_url, "today")
 
     # Only fetch tomorrow's data if the current time is past 1 PM
     if now.hour >= 13:
-        try:
-            tomorrow_response = requests.get(tomorrow_url)
-            tomorrow_response.raise_for_status()
-            tomorrow_data = tomorrow_response.json()
-        except requests.exceptions.RequestException as e:
-            print(f"Error fetching tomorrow's electricity data: {e}")
-        except json.JSONDecodeError as e:
-            print(f"Error decoding tomorrow's electricity JSON: {e}")
+        tomorrow_data, tomorrow_changed = fetch_price_day(tomorrow_url, "tomorrow")
     else:
-        print("Tomorrow's electricity prices might not be available yet.")
+        log.debug("Tomorrow's electricity prices might not be available yet.")
+
+    if (today_data or tomorrow_data) and not (today_changed or tomorrow_changed):
+        return UNCHANGED
+
+    # Drop payloads of past days so the reuse cache stays bounded
+    for url in [url for url in _price_payloads if url not in (today_url, tomorrow_url)]:
+        del _price_payloads[url]
 
     merged_data = []
     current_hour = now.hour
@@ -157,44 +213,68 @@ def fetch_electricity_price():
 
     return merged_data
 
-def store_electricity_data(data):
-    """Stores the fetched electricity price data into the SQLite database, avoiding duplicates and keeping only the last MAX_ENTRIES."""
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
-    entries_added = 0
-    if data:
-        for item in data:
-            time_start = item.get("time_start")
-            sek_per_kwh = item.get("SEK_per_kWh")
-            if time_start is not None and sek_per_kwh is not None:
-                try:
-                    cursor.execute('''
-                        INSERT OR IGNORE INTO electricity_prices (time_start, SEK_per_kWh)
-                        VALUES (?, ?)
-                    ''', (time_start, sek_per_kwh))
-                    conn.commit()
-                    entries_added += 1
-                except sqlite3.IntegrityError:
-                    # Ignore duplicate entries
-                    pass
-
-        # Delete older entries if the number of rows exceeds MAX_ENTRIES
-        cursor.execute(f'''
-            DELETE FROM electricity_prices
-            WHERE id NOT IN (SELECT id FROM electricity_prices ORDER BY timestamp DESC LIMIT {MAX_ENTRIES})
-        ''')
-        conn.commit()
-    conn.close()
-    return entries_added
+def upsert_rows(cursor, table, key_column, value_columns, rows):
+    """Bulk-upserts rows of (key, *values) into table and returns inserted/updated/unchanged counts.
+
+    Existing values are read with one query so unchanged rows are skipped entirely, and new or
+    revised rows are written with a single executemany upsert in the caller's transaction.
+    """
+    counts = {"inserted": 0, "updated": 0, "unchanged": 0}
+    if not rows:
+        return counts
+    columns = ", ".join(value_columns)
+    placeholders = ", ".join("?" for _ in rows)
+    cursor.execute(f'SELECT {key_column}, {columns} FROM {table} WHERE {key_column} IN ({placeholders})',
+                   [row[0] for row in rows])
+    existing = {row[0]: tuple(row[1:]) for row in cursor.fetchall()}
+
+    changed = []
+    for row in rows:
+        current = existing.get(row[0])
+        if current is None:
+            counts["inserted"] += 1
+        elif current != tuple(row[1:]):
+            counts["updated"] += 1
+        else:
+            counts["unchanged"] += 1
+            continue
+        changed.append(row)
+
+    if changed:
+        updates = ", ".join(f"{column} = excluded.{column}" for column in value_columns)
+        cursor.executemany(f'''
+            INSERT INTO {table} ({key_column}, {columns})
+            VALUES (?, {", ".join("?" for _ in value_columns)})
+            ON CONFLICT({key_column}) DO UPDATE SET {updates}
+        ''', changed)
+    return counts
+
+def store_electricity_data(data, now=None):
+    """Upserts the fetched electricity prices in one transaction and keeps only the last PRICE_RETENTION_DAYS
+    before `now` (a datetime, default the current time). Returns a dict with inserted/updated/unchanged counts.
+    """
+    items = [item for item in data or [] if item.get("time_start") is not None and item.get("SEK_per_kWh") is not None]
+    rows = [(item["time_start"], item["SEK_per_kWh"], *energy_views.price_epochs(item)) for item in items]
+    now = now or datetime.now()
+    with db.transaction() as conn:
+        cursor = conn.cursor()
+        counts = upsert_rows(cursor, 'electricity_prices', 'time_start', ['SEK_per_kWh', 'start_epoch', 'end_epoch'], rows)
+        if counts["inserted"] or counts["updated"]:
+            energy_views.update_price_stats(cursor, sorted({energy_views.local_day(row[2]) for row in rows}),
+                                            int(now.timestamp()))
+        if counts["inserted"]:
+            # Delete entries older than the retention window
+            cutoff = int((now - timedelta(days=PRICE_RETENTION_DAYS)).timestamp())
+            prune_before(cursor, 'electricity_prices', 'start_epoch', cutoff)
+            energy_views.prune_daily_stats(cursor, cutoff)
+    return counts
 
 
 
 
 def create_solar_table():
     """Creates the solar_data table if it doesn't exist."""
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
-    cursor.execute('''
+    db.execute('''
         CREATE TABLE IF NOT EXISTS solar_data (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
@@ -205,14 +285,13 @@ def create_solar_table():
             predicted_power REAL
         )
     ''')
-    conn.commit()
-    conn.close()
 
 
 
 def get_solar_and_temp_forecast(lat, lon, num_hours):
-    """Fetches solar irradiance and temperature data from Open-Meteo."""
-    base_url = "https://api.open-meteo.com/v1/forecast"
+    """Fetches solar irradiance and temperature data from Open-Meteo.
+    Returns UNCHANGED when the forecast is identical to the last fetched one."""
+    base_url = providers.url(OPEN_METEO_PROVIDER, "/v1/forecast")
     now_utc = datetime.utcnow()
     end_time_utc = now_utc + timedelta(hours=num_hours)
     params = {
@@ -224,100 +303,341 @@ def get_solar_and_temp_forecast(lat, lon, num_hours):
         "end_date": end_time_utc.strftime('%Y-%m-%d')
     }
     try:
-        response = requests.get(base_url, params=params)
-        response.raise_for_status()  # Raise an exception for HTTP errors
+        response = http_client.get_if_changed(base_url, OPEN_METEO_PROVIDER, params=params, ignore=OPEN_METEO_VOLATILE)
+        if response is None:
+            return UNCHANGED
         data = response.json()
         return data
     except requests.exceptions.RequestException as e:
-        print(f"Error fetching data from Open-Meteo: {e}")
+        log.warning("Error fetching data from Open-Meteo: %s", e)
         return None
     except json.JSONDecodeError as e:
-        print(f"Error decoding JSON from Open-Meteo: {e}")
+        log.warning("Error decoding JSON from Open-Meteo: %s", e)
         return None
 
 
 
-def store_solar_data(data):
-    """Stores the solar data into the SQLite database, avoiding duplicates and keeping only the last MAX_ENTRIES."""
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
-    entries_added = 0
+def solar_arrays():
+    """The configured panel arrays (the 'solar_arrays' setting)."""
+    return solar_model.parse_arrays(settings.get('solar_arrays', solar_model.DEFAULT_ARRAYS))
+
+def predict_solar_power(epochs, ghi, temperature, arrays=None):
+    """Predicted power of every hour with the configured arrays; None where an input is missing."""
+    power = solar_model.predict_power(epochs, ghi, temperature, arrays or solar_arrays(), latitude, longitude)
+    return [None if value != value else value for value in power.tolist()]  # NaN -> NULL
+
+def recompute_solar_predictions(arrays=None, now=None):
+    """Re-evaluates predicted_power of every stored forecast hour, e.g. after the panel arrays
+    changed: one vectorized model run, then one executemany for the rows whose value changed and
+    their days' statistics, in one transaction. Returns the number of rows changed."""
+    now = now if now is not None else time.time()
+    with db.transaction() as conn:
+        cursor = conn.cursor()
+        rows = cursor.execute('SELECT rowid, time_epoch, ghi, temperature, predicted_power FROM solar_data').fetchall()
+        if not rows:
+            return 0
+        rowids, epochs, ghi, temperature, stored = zip(*rows)
+        predicted = predict_solar_power(epochs, ghi, temperature, arrays)
+        changed = [(power, rowid, epoch) for rowid, epoch, power, old in zip(rowids, epochs, predicted, stored)
+                   if power != old]
+        cursor.executemany('UPDATE solar_data SET predicted_power = ? WHERE rowid = ?',
+                           [(power, rowid) for power, rowid, _ in changed])
+        energy_views.update_solar_stats(cursor, sorted({energy_views.local_day(epoch) for _, _, epoch in changed}),
+                                        int(now))
+    return len(changed)
+
+def store_solar_data(data, now=None):
+    """Upserts the solar forecast in one transaction so revised forecast hours replace the old ones,
+    and keeps only the last SOLAR_RETENTION_DAYS before `now` (a datetime, default the current time).
+    Returns a dict with inserted/updated/unchanged counts.
+
+    Open-Meteo's hourly times are wall-clock times in the zone the request asked for (the
+    response's "timezone"); they stay the row key in time_utc, and time_epoch is the real instant.
+    """
+    rows = []
     if data and 'hourly' in data:
         time_utc_data = data['hourly']['time']
-        time_local_data = [pd.to_datetime(t, utc=True).tz_convert('Europe/Stockholm').strftime('%Y-%m-%d %H:%M:%S') for t in time_utc_data]
+        time_epoch_data = energy_views.forecast_epochs(time_utc_data, data.get('timezone'))
+        time_local_data = [energy_views.local_time_text(epoch) for epoch in time_epoch_data]
         ghi_data = data['hourly']['shortwave_radiation']
         temperature_data = data['hourly']['temperature_2m']
-        K = panel_efficiency
-        predicted_power_data = [panel_area * K * g * (1 + beta * (t - T_reference)) if g > 0 else 0 for g, t in zip(ghi_data, temperature_data)]
-
-        for time_utc, time_local, ghi, temp, power in zip(time_utc_data, time_local_data, ghi_data, temperature_data, predicted_power_data):
-            try:
-                cursor.execute('''
-                    INSERT OR IGNORE INTO solar_data (time_utc, time_local, ghi, temperature, predicted_power)
-                    VALUES (?, ?, ?, ?, ?)
-                ''', (time_utc, time_local, ghi, temp, power))
-                conn.commit()
-                entries_added += 1
-            except sqlite3.IntegrityError:
-                # Ignore duplicate entries
-                pass
-
-    # Delete older entries if the number of rows exceeds MAX_ENTRIES
-    cursor.execute(f'''
-        DELETE FROM solar_data
-        WHERE id NOT IN (SELECT id FROM solar_data ORDER BY timestamp DESC LIMIT {MAX_ENTRIES})
-    ''')
-    conn.commit()
-    conn.close()
-    return entries_added
-
+        predicted_power_data = predict_solar_power(time_epoch_data, ghi_data, temperature_data)
+        rows = list(zip(time_utc_data, time_local_data, ghi_data, temperature_data, predicted_power_data, time_epoch_data))
+
+    now = now or datetime.now()
+    with db.transaction() as conn:
+        cursor = conn.cursor()
+        counts = upsert_rows(cursor, 'solar_data', 'time_utc',
+                             ['time_local', 'ghi', 'temperature', 'predicted_power', 'time_epoch'], rows)
+        if counts["inserted"] or counts["updated"]:
+            energy_views.update_solar_stats(cursor, sorted({energy_views.local_day(row[5]) for row in rows}),
+                                            int(now.timestamp()))
+        if counts["inserted"]:
+            # Delete entries older than the retention window
+            cutoff = int((now - timedelta(days=SOLAR_RETENTION_DAYS)).timestamp())
+            prune_before(cursor, 'solar_data', 'time_epoch', cutoff)
+    return counts
+
+
+
+# --- Collectors ---
+SERVER_DATA_INTERVAL_SECONDS = 10
+PRICE_RETRY_INTERVAL_SECONDS = 900  # After 13:00, retry every 15 min until tomorrow's prices are stored
+PRICE_PUBLISH_HOUR = 13  # elprisetjustnu publishes tomorrow's prices in the early afternoon
+SOLAR_INTERVAL_SECONDS = 3600  # Open-Meteo forecasts are updated hourly at most
+CHARGE_PLAN_INTERVAL_SECONDS = 3600  # Re-plan hourly as the battery drifts from the prediction; also after every changed ingest
+RETENTION_INTERVAL_SECONDS = 600  # How often the per-tier retention policies are applied
+COLLECTOR_JITTER_SECONDS = {"server_data": 0.5, "electricity_prices": 30, "solar_forecast": 60, "retention": 30, "charge_plan": 30}
+COLLECTOR_TIMEOUT_SECONDS = {"server_data": 5, "electricity_prices": 30, "solar_forecast": 30, "retention": 60, "charge_plan": 30}
+
+SERVER_DATA_BATCH_SIZE = 6  # Samples written to SQLite per transaction: once a minute at 10 s
+
+_ring = None
+_ring_opened = False
+_ring_lock = threading.Lock()
+_persisted_id = 0  # Highest sample id known to be in SQLite
+_pending_details = {}  # Sequence number -> full sample, for the samples not in SQLite yet
+
+def open_sample_ring():
+    """Opens the shared sample ring, continuing after SQLite's highest server_data id, and first
+    persists samples a killed collector left in the ring only. Returns None (samples then go
+    straight to SQLite) if the ring can't be created."""
+    global _ring, _ring_opened, _persisted_id
+    _ring_opened = True
+    try:
+        ring = sample_ring.writer(db.DATABASE_NAME)
+    except (OSError, ValueError) as e:
+        log.warning("No shared sample ring, storing every sample in SQLite: %s", e)
+        return None
+    stored = db.query_one('SELECT COALESCE(MAX(id), 0) FROM server_data')[0]
+    records, _ = ring.records_after(stored, ring.capacity)
+    if records:
+        store_server_samples(records)
+        log.info("Stored %d samples left in the sample ring.", len(records))
+    ring.continue_after(stored)
+    _ring, _persisted_id = ring, max(stored, ring.last_seq)
+    return ring
+
+def flush_server_samples():
+    """Writes the ring's samples that aren't in SQLite yet as one batch."""
+    global _persisted_id
+    with _ring_lock:
+        if _ring is None:
+            return 0
+        records, lowest = _ring.records_after(_persisted_id, _ring.capacity)
+        if lowest > _persisted_id + 1:
+            log.warning("%d samples were overwritten in the ring before being stored.", lowest - _persisted_id - 1)
+        if records:
+            store_server_samples(records, _pending_details)
+            _persisted_id = records[-1][0]
+        for seq in [seq for seq in _pending_details if seq <= _persisted_id]:
+            del _pending_details[seq]
+        return len(records)
+
+def collect_server_data():
+    server_info = fetch_server_info()
+    ring = _ring if _ring_opened else open_sample_ring()
+    if ring is None:
+        store_server_data(server_info)
+    else:
+        seq = ring.append(server_info)
+        _pending_details[seq] = server_info
+        if seq - _persisted_id >= SERVER_DATA_BATCH_SIZE:
+            # Readers see every sample at once; SQLite gets them in batches.
+            flush_server_samples()
+    log.debug("Stored data: CPU=%s%% (peak %s%%, %d samples), Mem=%s%%, Disk=%s%%",
+              server_info['cpu_percent'], server_info.get('cpu_max_percent'), server_info.get('samples', 1),
+              server_info['memory_percent'], server_info['disk_percent'])
+
+def collect_electricity_prices():
+    electricity_data = fetch_electricity_price()
+    if electricity_data is UNCHANGED:
+        return
+    if not electricity_data:
+        raise RuntimeError("No electricity prices fetched")
+    try:
+        counts = store_electricity_data(electricity_data)
+    except Exception:
+        http_client.forget(ELPRIS_PROVIDER)  # Make sure the next fetch stores these prices again
+        raise
+    if counts["inserted"] or counts["updated"]:
+        log.info("Sparade %d nya och %d uppdaterade elprisposter.", counts['inserted'], counts['updated'])
+        refresh_charge_plan()
+
+def collect_solar_forecast():
+    forecast_data = get_solar_and_temp_forecast(latitude, longitude, 72)
+    if forecast_data is UNCHANGED:
+        return
+    if not forecast_data:
+        raise RuntimeError("Failed to fetch solar data")
+    try:
+        counts = store_solar_data(forecast_data)
+    except Exception:
+        http_client.forget(OPEN_METEO_PROVIDER)
+        raise
+    if counts["inserted"] or counts["updated"]:
+        log.info("Stored %d new and %d revised solar data entries (%d unchanged).",
+                 counts['inserted'], counts['updated'], counts['unchanged'])
+        refresh_charge_plan()
+    else:
+        log.debug("No new solar data to store.")
+
+def collect_charge_plan():
+    mode = settings.get('charge_plan_mode', 'cost')
+    if mode not in charge_planner.PLAN_MODES:
+        raise RuntimeError(f"Unknown charge plan mode '{mode}'")
+    plan = charge_planner.update_charge_plan(mode)
+    if plan is not None:
+        windows = ", ".join(f"{datetime.fromtimestamp(start):%a %H:%M}-{datetime.fromtimestamp(end):%H:%M}"
+                            for start, end in plan['windows'])
+        log.info("Charge plan (%s, %d h, %.1f ms): %s", mode, len(plan['slots']), plan['plan_seconds'] * 1000,
+                 windows or 'no charging')
+
+def refresh_charge_plan():
+    """Re-plans right after new prices or forecasts; a failure must not fail the ingest."""
+    try:
+        collect_charge_plan()
+    except Exception as e:
+        log.warning("Could not update the charge plan: %s", e)
 
+def refresh_solar_predictions():
+    """Applies the current panel arrays to the stored forecast; logs instead of raising."""
+    try:
+        changed = recompute_solar_predictions()
+    except (ValueError, sqlite3.Error) as e:
+        log.error("Could not recompute solar predictions: %s", e)
+        return
+    if changed:
+        log.info("Recomputed %d solar predictions for the current panel arrays.", changed)
+        refresh_charge_plan()
+
+last_retention = {}  # table -> rows deleted by the last retention run
+
+def collect_retention():
+    deleted = history.apply_retention()
+    last_retention.clear()
+    last_retention.update(deleted)
+    if any(deleted.values()):
+        log.info("Retention removed %s.", ', '.join(f'{n} rows from {t}' for t, n in deleted.items() if n))
+
+def has_tomorrows_prices(now=None):
+    now = now or datetime.now()
+    _, tomorrow = energy_views.day_bounds(now.strftime('%Y-%m-%d'))
+    row = db.query_one('SELECT 1 FROM electricity_prices WHERE start_epoch >= ? LIMIT 1', (tomorrow,))
+    return row is not None
+
+def seconds_until_next_price_fetch(now=None):
+    """Prices change hourly: fetch at the next full hour, and after PRICE_PUBLISH_HOUR retry
+    sooner until tomorrow's prices have been stored."""
+    now = now or datetime.now()
+    next_hour = (now + timedelta(hours=1)).replace(minute=0, second=5, microsecond=0)
+    delay = (next_hour - now).total_seconds()
+    if now.hour >= PRICE_PUBLISH_HOUR and not has_tomorrows_prices(now):
+        delay = min(delay, PRICE_RETRY_INTERVAL_SECONDS)
+    return delay
+
+def record_collector_stats(job):
+    """Persists a collector's stats so the web server can expose them."""
+    db.execute('''
+        INSERT INTO collector_stats (name, stats, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP)
+        ON CONFLICT(name) DO UPDATE SET stats = excluded.stats, updated_at = excluded.updated_at
+    ''', (job.name, json.dumps(job.snapshot())))
+    record_metrics_snapshot()
+
+METRICS_PROCESS = "collector"  # `process` label of the collector's series on the web server's /metrics
+METRICS_SNAPSHOT_INTERVAL_SECONDS = 30  # The collector has no HTTP server; its metrics reach /metrics this often
+METRICS_SNAPSHOT_MAX_AGE_SECONDS = 600  # Snapshots of processes that stopped writing are left out
+
+_metrics_snapshot_lock = threading.Lock()
+_last_metrics_snapshot = 0
+
+def record_metrics_snapshot(now=None):
+    """Persists this process's histograms and counters (collector cycles, upstream calls, SQLite
+    queries), at most every METRICS_SNAPSHOT_INTERVAL_SECONDS."""
+    global _last_metrics_snapshot
+    now = now if now is not None else time.time()
+    with _metrics_snapshot_lock:
+        if now - _last_metrics_snapshot < METRICS_SNAPSHOT_INTERVAL_SECONDS:
+            return
+        _last_metrics_snapshot = now
+    db.execute('''
+        INSERT INTO metrics_snapshots (process, snapshot, updated_at) VALUES (?, ?, ?)
+        ON CONFLICT(process) DO UPDATE SET snapshot = excluded.snapshot, updated_at = excluded.updated_at
+    ''', (METRICS_PROCESS, json.dumps(metrics.snapshot()), int(now)))
+
+def get_metrics_snapshots(now=None):
+    """{process: metrics snapshot} of the processes that wrote one recently."""
+    now = now if now is not None else time.time()
+    try:
+        rows = db.query_all('SELECT process, snapshot FROM metrics_snapshots WHERE updated_at >= ?',
+                            (int(now - METRICS_SNAPSHOT_MAX_AGE_SECONDS),))
+    except sqlite3.Error as e:
+        log.error("SQLite Error while fetching metrics snapshots: %s", e)
+        return {}
+    return {process: json.loads(snapshot) for process, snapshot in rows}
+
+def get_collector_stats():
+    """Returns the last persisted stats of every collector."""
+    try:
+        rows = db.query_all('SELECT name, stats, updated_at FROM collector_stats ORDER BY name')
+    except sqlite3.Error as e:
+        log.error("SQLite Error while fetching collector stats: %s", e)
+        return {}
+    return {name: {**json.loads(stats), "updated_at": updated_at} for name, stats, updated_at in rows}
+
+def create_scheduler():
+    """Registers every collector with its own interval, jitter, timeout and backoff."""
+    scheduler = Scheduler(on_run=record_collector_stats)
+    scheduler.add("server_data", collect_server_data, SERVER_DATA_INTERVAL_SECONDS,
+                  jitter_seconds=COLLECTOR_JITTER_SECONDS["server_data"],
+                  timeout_seconds=COLLECTOR_TIMEOUT_SECONDS["server_data"])
+    scheduler.add("electricity_prices", collect_electricity_prices, PRICE_RETRY_INTERVAL_SECONDS,
+                  jitter_seconds=COLLECTOR_JITTER_SECONDS["electricity_prices"],
+                  timeout_seconds=COLLECTOR_TIMEOUT_SECONDS["electricity_prices"],
+                  max_backoff_seconds=SOLAR_INTERVAL_SECONDS,
+                  next_delay=seconds_until_next_price_fetch,
+                  extra_stats=lambda: http_client.conditional_stats(ELPRIS_PROVIDER))
+    scheduler.add("solar_forecast", collect_solar_forecast, SOLAR_INTERVAL_SECONDS,
+                  jitter_seconds=COLLECTOR_JITTER_SECONDS["solar_forecast"],
+                  timeout_seconds=COLLECTOR_TIMEOUT_SECONDS["solar_forecast"],
+                  max_backoff_seconds=SOLAR_INTERVAL_SECONDS * 3,
+                  extra_stats=lambda: http_client.conditional_stats(OPEN_METEO_PROVIDER))
+    scheduler.add("charge_plan", collect_charge_plan, CHARGE_PLAN_INTERVAL_SECONDS,
+                  jitter_seconds=COLLECTOR_JITTER_SECONDS["charge_plan"],
+                  timeout_seconds=COLLECTOR_TIMEOUT_SECONDS["charge_plan"])
+    scheduler.add("retention", collect_retention, RETENTION_INTERVAL_SECONDS,
+                  jitter_seconds=COLLECTOR_JITTER_SECONDS["retention"],
+                  timeout_seconds=COLLECTOR_TIMEOUT_SECONDS["retention"],
+                  extra_stats=lambda: {"last_deleted": dict(last_retention)})
+    return scheduler
 
 def main():
-    """Main function to create the table and continuously store server data, and periodically fetch and print electricity prices."""
-    create_table()
-    create_electricity_table() # Ensure the table exists
-    print(f"Storing server data every 10 seconds in '{DATABASE_NAME}'. Keeping only the last {MAX_ENTRIES} entries. Press Ctrl+C to stop.")
-    create_solar_table() # Create the solar_data table.
-    print(f"Storing solar data every hour in '{DATABASE_NAME}'. Keeping only the last {MAX_ENTRIES} entries. Press Ctrl+C to stop.")
+    """Main function to create the tables and run every collector on its own schedule."""
+    structured_log.configure(METRICS_PROCESS)
+    init_database()
+    # The web server owns the settings; follow its changes without polling the file.
+    settings_store = settings.get_store()
+    settings_store.on_change(lambda changed: log.info("Settings changed: %s", changed))
+    settings_store.on_change(lambda changed: 'charge_plan_mode' in changed and refresh_charge_plan())
+    settings_store.on_change(lambda changed: 'solar_arrays' in changed and refresh_solar_predictions())
+    settings_store.listen()
+    refresh_solar_predictions()  # The arrays may have changed while the collector was stopped
+    log.info("Storing server data every %d seconds in '%s'. Keeping raw samples for %d hours and rollups longer.",
+             SERVER_DATA_INTERVAL_SECONDS, DATABASE_NAME, history.RAW_RETENTION_SECONDS // 3600)
+    log.info("Storing solar data every hour in '%s'. Keeping only the last %d days.", DATABASE_NAME, SOLAR_RETENTION_DAYS)
+    print(f"Collecting; logs are written to {structured_log.LOG_DIR}/{METRICS_PROCESS}.log. Press Ctrl+C to stop.")
+
+    sampler.start()
+    log.info("Sampling %s every %s s.", ", ".join(sorted(sampler.components)), sampler.interval_seconds)
 
     try:
-        while True:
-            server_info = fetch_server_info()
-            store_server_data(server_info)
-
-            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            print(f"[{timestamp}] Stored data: CPU={server_info['cpu_percent']}%,"
-                  f" Mem={server_info['memory_percent']}%,"
-                  f" Disk={server_info['disk_percent']}%", end=" ")
-
-            electricity_data = fetch_electricity_price()
-
-            if electricity_data:
-                stored_count = store_electricity_data(electricity_data)
-                if stored_count > 0:
-                    print(f"| Sparade {stored_count} nya elprisposter.", end=" ")
-        
-
-            forecast_data = get_solar_and_temp_forecast(latitude, longitude, 72)
-            
-            if forecast_data:
-                stored_count = store_solar_data(forecast_data)
-                if stored_count > 0:
-                    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    print(f"[{timestamp}] Stored {stored_count} new solar data entries.")
-                else:
-                    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    print(f"[{timestamp}] No new solar data to store.")
-            else:
-                timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                print(f"[{timestamp}] Failed to fetch solar data.")
-
-
-            time.sleep(10)
+        create_scheduler().run_forever()
     except KeyboardInterrupt:
-        print("\nData collection stopped.")
+        log.info("Data collection stopped.")
+    finally:
+        sampler.stop(timeout=1)
+        flush_server_samples()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,174 @@
+import os
+import queue
+import re
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+import metrics
+
+DATABASE_NAME = 'server_data.db'
+
+# --- Connection Configuration ---
+READ_POOL_SIZE = 4  # Long-lived read connections shared by request threads
+BUSY_TIMEOUT_MS = 5000
+SQLITE_SYNCHRONOUS = "NORMAL"  # Safe with WAL; fsync happens at checkpoints, not on every commit
+SQLITE_CACHE_SIZE_KIB = 8192  # Page cache per connection
+SQLITE_MMAP_SIZE = 64 * 1024 * 1024
+CACHED_STATEMENTS = 128  # Prepared statements kept per connection
+
+# --- Query Metrics ---
+QUERY_SECONDS = metrics.histogram('sqlite_query_duration_seconds', 'SQLite read queries by statement',
+                                  ('statement',))
+TRANSACTION_SECONDS = metrics.histogram('sqlite_transaction_duration_seconds',
+                                        'SQLite write transactions, including the wait for the writer')
+MAX_STATEMENT_LABELS = 256  # Distinct statements labelled individually; later ones share one label
+_statement_labels = {}  # sql -> "operation table"
+_TABLE_PATTERN = re.compile(r'\b(?:FROM|INTO|UPDATE|TABLE)\s+(\w+)', re.IGNORECASE)
+
+
+def statement_label(sql):
+    """Short, low-cardinality name of a statement, e.g. "select server_data"; cached per SQL text."""
+    label = _statement_labels.get(sql)
+    if label is None:
+        words = sql.split(None, 2)
+        operation = words[0].lower() if words else ''
+        table = _TABLE_PATTERN.search(sql)
+        if operation == 'pragma' and len(words) > 1:
+            table = re.match(r'\w+', words[1])
+            label = f"pragma {table.group(0) if table else ''}"
+        else:
+            label = f"{operation} {table.group(1) if table else ''}".strip()
+        if len(_statement_labels) >= MAX_STATEMENT_LABELS:
+            return 'other'
+        _statement_labels[sql] = label
+    return label
+
+
+def _connect(database, read_only):
+    conn = sqlite3.connect(database, timeout=BUSY_TIMEOUT_MS / 1000, check_same_thread=False,
+                           cached_statements=CACHED_STATEMENTS)
+    conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+    conn.execute(f"PRAGMA synchronous = {SQLITE_SYNCHRONOUS}")
+    conn.execute(f"PRAGMA cache_size = -{SQLITE_CACHE_SIZE_KIB}")
+    conn.execute(f"PRAGMA mmap_size = {SQLITE_MMAP_SIZE}")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    if read_only:
+        conn.execute("PRAGMA query_only = ON")
+    return conn
+
+
+class Database:
+    """Data-access layer for one SQLite file: a pool of reader connections and one writer.
+
+    The file is switched to WAL mode so readers never block on the collector's writes and the
+    writer never waits for readers. Connections live for the whole process, so a repeated query
+    only costs a lookup in the connection's prepared-statement cache. Connections are recreated
+    after a fork so pre-fork servers don't share SQLite handles between workers.
+    """
+
+    def __init__(self, database, read_pool_size=READ_POOL_SIZE):
+        self.database = database
+        self.read_pool_size = read_pool_size
+        self._lock = threading.Lock()
+        self._write_lock = threading.RLock()
+        self._pid = None
+        self._readers = None
+        self._reader_count = 0
+        self._writer = None
+
+    def _ensure_open(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._writer = _connect(self.database, read_only=False)
+            self._writer.execute("PRAGMA journal_mode = WAL")
+            self._readers = queue.LifoQueue()
+            self._reader_count = 0
+            self._pid = os.getpid()
+
+    @contextmanager
+    def reader(self):
+        """Borrows a read connection from the pool, opening one if the pool is not full yet."""
+        self._ensure_open()
+        readers = self._readers
+        try:
+            conn = readers.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                can_open = self._reader_count < self.read_pool_size
+                if can_open:
+                    self._reader_count += 1
+            conn = _connect(self.database, read_only=True) if can_open else readers.get()
+        try:
+            yield conn
+        finally:
+            readers.put(conn)
+
+    @contextmanager
+    def transaction(self):
+        """Runs the block in one transaction on the dedicated writer connection."""
+        self._ensure_open()
+        with TRANSACTION_SECONDS.labels().time('sqlite transaction'), self._write_lock:
+            conn = self._writer
+            try:
+                yield conn
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+
+    def query_all(self, sql, params=()):
+        label = statement_label(sql)
+        with QUERY_SECONDS.labels(label).time(label), self.reader() as conn:
+            return conn.execute(sql, params).fetchall()
+
+    def query_one(self, sql, params=()):
+        label = statement_label(sql)
+        with QUERY_SECONDS.labels(label).time(label), self.reader() as conn:
+            return conn.execute(sql, params).fetchone()
+
+    def execute(self, sql, params=()):
+        """Runs a single write statement in its own transaction and returns the row count."""
+        with self.transaction() as conn:
+            return conn.execute(sql, params).rowcount
+
+    def close(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                return
+            while self._readers is not None and not self._readers.empty():
+                self._readers.get_nowait().close()
+            self._writer.close()
+            self._pid = None
+
+
+_databases = {}
+_databases_lock = threading.Lock()
+
+
+def get_database(database=None):
+    """Returns the shared Database for a file (default DATABASE_NAME), creating it on first use."""
+    database = database or DATABASE_NAME
+    with _databases_lock:
+        if database not in _databases:
+            _databases[database] = Database(database)
+        return _databases[database]
+
+
+def query_all(sql, params=()):
+    return get_database().query_all(sql, params)
+
+
+def query_one(sql, params=()):
+    return get_database().query_one(sql, params)
+
+
+def transaction():
+    return get_database().transaction()
+
+
+def execute(sql, params=()):
+    return get_database().execute(sql, params)
@@ -0,0 +1,170 @@
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+
+import db
+
+# --- Electricity and solar views ---
+# Prices and forecasts are stored with epoch-integer time columns (electricity_prices.start_epoch /
+# end_epoch, solar_data.time_epoch), so windows are index range scans. Per-day statistics are
+# computed when an ingest changes a day and stored in daily_energy_stats, so requests only look
+# them up.
+LOCAL_ZONE = ZoneInfo('Europe/Stockholm')  # Days of the statistics are local days
+DEFAULT_PRICE_SLOT_SECONDS = 3600  # When the provider doesn't send time_end
+SOLAR_SLOT_SECONDS = 3600  # The forecast is hourly
+PRICE_STAT_COLUMNS = ('price_min', 'price_max', 'price_avg', 'cheapest_hour', 'priciest_hour')
+SOLAR_STAT_COLUMNS = ('solar_peak_hour', 'solar_peak_w', 'solar_energy_wh')
+
+
+def local_day(epoch):
+    return datetime.fromtimestamp(epoch, LOCAL_ZONE).strftime('%Y-%m-%d')
+
+
+def day_bounds(day):
+    """[start, end) epochs of a local day; 23 or 25 hours long on DST changes."""
+    start = datetime.strptime(day, '%Y-%m-%d').replace(tzinfo=LOCAL_ZONE)
+    return int(start.timestamp()), int((start + timedelta(days=1)).timestamp())
+
+
+def local_time_text(epoch):
+    return datetime.fromtimestamp(epoch, LOCAL_ZONE).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def price_epochs(item):
+    """(start, end) epochs of an elprisetjustnu price item; its times carry a UTC offset."""
+    start = int(datetime.fromisoformat(item['time_start']).timestamp())
+    if item.get('time_end'):
+        return start, int(datetime.fromisoformat(item['time_end']).timestamp())
+    return start, start + DEFAULT_PRICE_SLOT_SECONDS
+
+
+def forecast_epochs(times, zone_name):
+    """Epochs of Open-Meteo's hourly times, which are wall-clock times in the requested zone."""
+    zone = ZoneInfo(zone_name) if zone_name and zone_name not in ('GMT', 'UTC') else ZoneInfo('UTC')
+    return [int(datetime.fromisoformat(t).replace(tzinfo=zone).timestamp()) for t in times]
+
+
+# --- Statistics computed at ingest ---
+def price_stats(rows):
+    """Statistics of one day's (start, end, price) rows: time-weighted mean, extremes, and the
+    start of the cheapest and priciest hour (by hourly mean, so quarter-hour prices work too)."""
+    hours = {}
+    weighted = duration = 0
+    for start, end, price in rows:
+        weighted += price * (end - start)
+        duration += end - start
+        hours.setdefault(start - start % 3600, []).append(price)
+    means = {hour: sum(prices) / len(prices) for hour, prices in hours.items()}
+    return {'price_min': min(price for _, _, price in rows), 'price_max': max(price for _, _, price in rows),
+            'price_avg': round(weighted / duration, 5), 'cheapest_hour': min(means, key=means.get),
+            'priciest_hour': max(means, key=means.get)}
+
+
+def solar_stats(rows):
+    """Statistics of one day's (time, predicted W) rows: peak hour, peak power and energy."""
+    peak_hour, peak_w = max(rows, key=lambda row: row[1])
+    return {'solar_peak_hour': peak_hour if peak_w > 0 else None, 'solar_peak_w': round(peak_w, 1),
+            'solar_energy_wh': round(sum(power for _, power in rows) * SOLAR_SLOT_SECONDS / 3600, 1)}
+
+
+def _store_stats(cursor, day, columns, values, now):
+    updates = ", ".join(f"{column} = excluded.{column}" for column in columns)
+    cursor.execute(f'''
+        INSERT INTO daily_energy_stats (day, {", ".join(columns)}, updated_at)
+        VALUES (?, {", ".join("?" for _ in columns)}, ?)
+        ON CONFLICT(day) DO UPDATE SET {updates}, updated_at = excluded.updated_at
+    ''', (day, *(values[column] for column in columns), now))
+
+
+def update_price_stats(cursor, days, now):
+    """Recomputes the price statistics of local `days` in the ingest's transaction."""
+    for day in days:
+        start, end = day_bounds(day)
+        cursor.execute('''
+            SELECT start_epoch, end_epoch, SEK_per_kWh FROM electricity_prices
+            WHERE start_epoch >= ? AND start_epoch < ? AND SEK_per_kWh IS NOT NULL
+        ''', (start, end))
+        rows = cursor.fetchall()
+        if rows:
+            _store_stats(cursor, day, PRICE_STAT_COLUMNS, price_stats(rows), now)
+
+
+def update_solar_stats(cursor, days, now):
+    """Recomputes the solar statistics of local `days` in the ingest's transaction."""
+    for day in days:
+        start, end = day_bounds(day)
+        cursor.execute('''
+            SELECT time_epoch, COALESCE(predicted_power, 0) FROM solar_data
+            WHERE time_epoch >= ? AND time_epoch < ?
+        ''', (start, end))
+        rows = cursor.fetchall()
+        if rows:
+            _store_stats(cursor, day, SOLAR_STAT_COLUMNS, solar_stats(rows), now)
+
+
+def backfill_daily_stats(now):
+    """Computes the statistics of stored days that have none yet, e.g. right after the migration
+    that introduced them. Returns the number of days computed."""
+    with db.transaction() as conn:
+        cursor = conn.cursor()
+        known = {row[0] for row in cursor.execute('SELECT day FROM daily_energy_stats')}
+        price_days = {local_day(row[0]) for row in cursor.execute('SELECT start_epoch FROM electricity_prices')} - known
+        solar_days = {local_day(row[0]) for row in cursor.execute('SELECT time_epoch FROM solar_data')} - known
+        update_price_stats(cursor, sorted(price_days), now)
+        update_solar_stats(cursor, sorted(solar_days), now)
+    return len(price_days | solar_days)
+
+
+def prune_daily_stats(cursor, before_epoch):
+    cursor.execute('DELETE FROM daily_energy_stats WHERE day < ?', (local_day(before_epoch),))
+
+
+# --- Queries ---
+def get_prices(start, end=None):
+    """[time_start, SEK_per_kWh] rows of the prices starting in [start, end), oldest first."""
+    return db.query_all('''
+        SELECT time_start, SEK_per_kWh FROM electricity_prices
+        WHERE start_epoch >= ? AND start_epoch < ?
+        ORDER BY start_epoch
+    ''', (int(start), int(end) if end is not None else 2 ** 62))
+
+
+def get_solar(start, end=None):
+    """[local time, ghi, temperature, predicted_power] rows of the forecast hours in [start, end)."""
+    rows = db.query_all('''
+        SELECT time_epoch, ghi, temperature, predicted_power FROM solar_data
+        WHERE time_epoch >= ? AND time_epoch < ?
+        ORDER BY time_epoch
+    ''', (int(start), int(end) if end is not None else 2 ** 62))
+    return [(local_time_text(epoch), ghi, temperature, power) for epoch, ghi, temperature, power in rows]
+
+
+def _day_summary(row):
+    if row is None:
+        return None
+    day, price_min, price_max, price_avg, cheapest, priciest, peak_hour, peak_w, energy_wh = row
+    summary = {'day': day, 'price': None, 'solar': None}
+    if price_avg is not None:
+        summary['price'] = {'min': price_min, 'max': price_max, 'avg': price_avg,
+                            'cheapest_hour': local_time_text(cheapest), 'priciest_hour': local_time_text(priciest)}
+    if energy_wh is not None:
+        summary['solar'] = {'peak_hour': local_time_text(peak_hour) if peak_hour is not None else None,
+                            'peak_w': peak_w, 'energy_wh': energy_wh}
+    return summary
+
+
+def get_summary(now):
+    """Current price and the precomputed statistics of today and tomorrow: three index lookups."""
+    current = db.query_one('''
+        SELECT time_start, SEK_per_kWh, end_epoch FROM electricity_prices
+        WHERE start_epoch <= ? ORDER BY start_epoch DESC LIMIT 1
+    ''', (int(now),))
+    today = local_day(now)
+    tomorrow = local_day(day_bounds(today)[1])
+    days = {row[0]: row for row in db.query_all(f'''
+        SELECT day, {", ".join(PRICE_STAT_COLUMNS + SOLAR_STAT_COLUMNS)}
+        FROM daily_energy_stats WHERE day IN (?, ?)
+    ''', (today, tomorrow))}
+    return {'time': local_time_text(now),
+            'current_price': {'time_start': current[0], 'SEK_per_kWh': current[1]}
+            if current and current[2] > now else None,
+            'today': _day_summary(days.get(today)), 'tomorrow': _day_summary(days.get(tomorrow))}
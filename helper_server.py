@@ -1,28 +1,53 @@
-import importlib
+import contextvars
+import logging
 import sqlite3
-from key import DATABASE_NAME
+import db
+import energy_views
 import requests
+import http_client
+import settings
+import providers
+import sample_ring
+import shelly_fleet
 from datetime import *
 import psutil
 from key import *
 import json
 import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from database_script import *
+from cache import TTLCache, cache_stats
+from response_cache import VersionedJSONCache
 import pytz
 
+log = logging.getLogger('helper_server')
+
 LOCAL_TIMEZONE = 'Europe/Stockholm'
+SOURCE_WORKERS = 8  # Threads used to fetch dashboard sources concurrently
+
+_source_executor = ThreadPoolExecutor(max_workers=SOURCE_WORKERS, thread_name_prefix="source")
+
+# --- Provider caches (shared by the dashboard and the polling endpoints) ---
+WEATHER_CACHE_TTL_SECONDS = 600  # met.no nowcast updates every few minutes at most
+PROVIDER_CACHE_MAX_ENTRIES = 16
+
+def _provider_result_ok(result):
+    """Only successful provider results are cached; failures keep the last good value."""
+    return bool(result) and result.get("success", False)
+
+weather_cache = TTLCache("weather", WEATHER_CACHE_TTL_SECONDS, PROVIDER_CACHE_MAX_ENTRIES, _provider_result_ok)
+
+# --- Shelly fleet (the charger plug from key.py plus shelly_fleet.SHELLY_DEVICES_FILE) ---
+shelly_devices = shelly_fleet.load_fleet(SHELLY_PLUG_SERVER_IP)
 
 def toggle_shelly_relay(turn_on):
-    """Toggles the Shelly relay on or off."""
-    try:
-        turn = "on" if turn_on else "off"
-        control_url = f"http://{SHELLY_PLUG_SERVER_IP}/relay/0?turn={turn}"
-        response = requests.get(control_url, timeout=5)
-        response.raise_for_status()
-        return {"success": True}
-    except requests.exceptions.RequestException as e:
-        print(f"Error controlling Shelly: {e}")
-        return {"success": False, "error": str(e)}
+    """Switches the charger plug on or off; the fleet snapshot takes the state the plug reports."""
+    return shelly_devices.set_relay(turn_on)
+
+def switch_shelly_relays(commands):
+    """Switches several relays in one batch, see ShellyFleet.command()."""
+    return shelly_devices.command(commands)
 
 def get_battery_status():
     """Retrieves the current battery status."""
@@ -64,50 +89,45 @@ def format_uptime(seconds):
     return ", ".join(parts)
 
 def get_shelly_status():
-    """Fetches the current status of the Shelly device."""
-    try:
-        status_url = f"http://{SHELLY_PLUG_SERVER_IP}/relay/0"
-        print(status_url)
-        response = requests.get(status_url, timeout=5)
-        response.raise_for_status()
-        data = response.json()
-        return {"ison": data.get("ison"), "success": True}
-    except requests.exceptions.RequestException as e:
-        print(f"Error fetching Shelly status: {e}")
-        return {"ison": None, "success": False, "error": str(e)}
+    """Returns the charger plug's status from the fleet snapshot, which is refreshed in the
+    background when expired."""
+    return shelly_devices.relay_status()
+
+def get_shelly_fleet():
+    """Every Shelly device's last known relay states, power and availability."""
+    return shelly_devices.snapshot()
+
+def get_shelly_plug_data():
+    """/shelly_plug_data: the charger plug's status plus the whole fleet snapshot."""
+    return {**shelly_devices.relay_status(), **get_shelly_fleet()}
 
 
 
 # ------------ constants -----------
 def load_constants():
-    try:
-        import dynamic_constants as dc
-        importlib.reload(dc)  # Ensure we get the latest version
-        return dc.current_temperature
-    except ImportError:
-        return 20  # Default value
+    """Current temperature setpoint, served from the in-memory settings store."""
+    return settings.get('current_temperature', settings.DEFAULT_SETTINGS['current_temperature'])
 
 def write_constants(current_temperature):
-    content = (
-        f"current_temperature = {current_temperature}\n"
-    )
-    with open("dynamic_constants.py", "w") as f:
-        f.write(content)
+    """Updates the setpoint; the settings store persists it in the background."""
+    settings.set_value('current_temperature', current_temperature)
 
 
 
 # ------- Server ----------------
+# The collector's newest samples are read from its shared-memory sample ring; SQLite answers only
+# for older samples, or when no collector is writing the ring.
 def get_latest_server_data():
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
-    cursor.execute('''
+    ring = sample_ring.reader(db.DATABASE_NAME)
+    latest = ring.latest() if ring is not None else None
+    if latest:
+        return {'cpu': latest[2], 'memory_percent': latest[3], 'disk_percent': latest[4]}
+    latest_data = db.query_one('''
         SELECT cpu_percent, memory_percent, disk_percent
         FROM server_data
-        ORDER BY timestamp DESC
+        ORDER BY id DESC
         LIMIT 1
     ''')
-    latest_data = cursor.fetchone()
-    conn.close()
     if latest_data:
         return {
             'cpu': latest_data[0],
@@ -116,92 +136,204 @@ def get_latest_server_data():
         }
     return None
 
+SERVER_DATA_COLUMNS = ('ids', 'timestamps', 'cpu_percent', 'memory_percent', 'disk_percent')
+
+def get_server_rows_after(last_id, limit):
+    """(id, timestamp, cpu, memory, disk) of the newest `limit` samples after id last_id, newest
+    first: from the sample ring, completed from SQLite with the ids the ring no longer holds."""
+    ring = sample_ring.reader(db.DATABASE_NAME)
+    if ring is None:
+        return db.query_all('''
+            SELECT id, timestamp, cpu_percent, memory_percent, disk_percent
+            FROM server_data
+            WHERE id > ?
+            ORDER BY id DESC
+            LIMIT ?
+        ''', (last_id, limit))
+    records, lowest = ring.records_after(last_id, limit)
+    text = sample_ring.timestamp_text
+    rows = [(record[0], text(record[1]), record[2], record[3], record[4]) for record in reversed(records)]
+    if len(rows) < limit and lowest > last_id + 1:
+        rows += db.query_all('''
+            SELECT id, timestamp, cpu_percent, memory_percent, disk_percent
+            FROM server_data
+            WHERE id > ? AND id < ?
+            ORDER BY id DESC
+            LIMIT ?
+        ''', (last_id, lowest, limit - len(rows)))
+    return rows
+
 def get_recent_server_data(limit=100):
-    """Retrieves recent server information from the database."""
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
-    cursor.execute(f'''
-        SELECT timestamp, cpu_percent, memory_percent, disk_percent
-        FROM server_data
-        ORDER BY timestamp DESC
-        LIMIT ?
-    ''', (limit,))
-    recent_data = cursor.fetchall()
-    conn.close()
+    """Retrieves recent server information from the sample ring and the database."""
+    recent_data = get_server_rows_after(0, limit)
     if recent_data:
-        timestamps = [row[0] for row in reversed(recent_data)]
-        cpu_percent = [row[1] for row in reversed(recent_data)]
-        memory_percent = [row[2] for row in reversed(recent_data)]
-        disk_percent = [row[3] for row in reversed(recent_data)]
-        latest = {'cpu': recent_data[0][1], 'memory_percent': recent_data[0][2], 'disk_percent': recent_data[0][3]}
+        ids, timestamps, cpu_percent, memory_percent, disk_percent = zip(*reversed(recent_data))
+        latest = {'cpu': recent_data[0][2], 'memory_percent': recent_data[0][3], 'disk_percent': recent_data[0][4]}
         return {'timestamps': timestamps, 'cpu_percent': cpu_percent,
-                'memory_percent': memory_percent, 'disk_percent': disk_percent, 'latest': latest}
+                'memory_percent': memory_percent, 'disk_percent': disk_percent, 'latest': latest,
+                'last_id': recent_data[0][0]}
     return None
 
+def get_latest_server_data_id():
+    ring = sample_ring.reader(db.DATABASE_NAME)
+    if ring is not None:
+        return ring.last_seq
+    row = db.query_one('SELECT MAX(id) FROM server_data')
+    return row[0] if row and row[0] is not None else 0
+
+def get_server_data_since(last_id, limit=100):
+    """Returns the samples stored after id last_id as compact columns, or None when there are none.
+
+    Only the newest `limit` rows are returned, so a client that fell far behind gets a full
+    window rather than a backlog. New samples come from the sample ring; a lookup in SQLite is a
+    range scan on the rowid, O(new rows).
+    """
+    rows = get_server_rows_after(last_id, limit)
+    if not rows:
+        return None
+    data = dict(zip(SERVER_DATA_COLUMNS, zip(*reversed(rows))))
+    data['last_id'] = rows[0][0]
+    return data
+
+SYSTEM_SAMPLE_COLUMNS = ('id', 'time_epoch', 'samples', 'cpu_max_percent', 'load_1', 'load_5', 'load_15',
+                         'net_sent_bps', 'net_recv_bps', 'net_peak_bps',
+                         'disk_read_bps', 'disk_write_bps', 'disk_peak_bps')
+
+def get_latest_system_sample():
+    """The newest stored system sampler aggregate (per-core CPU, load, I/O rates, temperatures,
+    top processes), or None. It reaches SQLite with the collector's batches, so it may be up to
+    a batch behind the sample ring."""
+    row = db.query_one(f'''
+        SELECT sample_id, {", ".join(SYSTEM_SAMPLE_COLUMNS[1:])}, details
+        FROM system_samples
+        ORDER BY sample_id DESC
+        LIMIT 1
+    ''')
+    if row is None:
+        return None
+    return {**dict(zip(SYSTEM_SAMPLE_COLUMNS, row)), **json.loads(row[-1] or '{}')}
+
 def get_weather_linkoping():
-    url = "https://api.met.no/weatherapi/nowcast/2.0/complete?lat=58.41&lon=15.62"
-    headers = {"User-Agent": "SmartHomeDashboard/1.0 (example@example.com)"}
+    """Returns the Linköping nowcast from the cache, refreshing it from met.no when expired."""
+    return weather_cache.get("linkoping", fetch_weather_linkoping)
+
+WEATHER_URL_PATH = "/weatherapi/nowcast/2.0/complete?lat=58.41&lon=15.62"
+WEATHER_HEADERS = {"User-Agent": "SmartHomeDashboard/1.0 (example@example.com)"}
+
+def fetch_weather_linkoping():
+    url = providers.url("met-no", WEATHER_URL_PATH)
     try:
-        response = requests.get(url, headers=headers, timeout=5)
+        response = http_client.get(url, headers=WEATHER_HEADERS, timeout=5)
         response.raise_for_status()
-        data = response.json()
-        if data and data.get("properties") and data.get("properties").get("timeseries"):
-            current_entry = data["properties"]["timeseries"][0]
-            time_str = current_entry.get("time")
-            details = current_entry.get("data").get("instant").get("details")
-            formatted_time = datetime.fromisoformat(time_str.replace("Z", "+00:00")).strftime('%Y-%m-%d %H:%M:%S')
-            temperature = details.get("air_temperature")
-            wind_speed = details.get("wind_speed")
-            return {
-                "time": formatted_time,
-                "temperature": temperature,
-                "wind_speed": wind_speed,
-                "success": True,
-            }
-        else:
-            return {"success": False, "error": "Could not parse weather data"}
+        return parse_weather(response.json())
     except requests.exceptions.RequestException as e:
-        print(f"Error fetching weather data: {e}")
+        log.warning("Error fetching weather data: %s", e)
         return {"success": False, "error": str(e)}
+
+def parse_weather(data):
+    """met.no nowcast response -> current conditions; shared with the async helpers."""
+    if data and data.get("properties") and data.get("properties").get("timeseries"):
+        current_entry = data["properties"]["timeseries"][0]
+        time_str = current_entry.get("time")
+        details = current_entry.get("data").get("instant").get("details")
+        formatted_time = datetime.fromisoformat(time_str.replace("Z", "+00:00")).strftime('%Y-%m-%d %H:%M:%S')
+        temperature = details.get("air_temperature")
+        wind_speed = details.get("wind_speed")
+        return {
+            "time": formatted_time,
+            "temperature": temperature,
+            "wind_speed": wind_speed,
+            "success": True,
+        }
+    else:
+        return {"success": False, "error": "Could not parse weather data"}
     
 
 
-def fetch_electricity_data_from_database():
-    conn = None
+PRICE_HISTORY_SECONDS = 12 * 3600  # History before the current hour in the default price window
+SOLAR_HISTORY_SECONDS = 12 * 3600  # Likewise for the solar forecast
+
+def default_window_start(history_seconds, now=None):
+    """Start of a default "a little history, then everything ahead" window; moves once per hour."""
+    now = int(now if now is not None else time.time())
+    return now - now % 3600 - history_seconds
+
+def fetch_electricity_data_from_database(start=None, end=None):
+    """[time_start, SEK_per_kWh] rows starting in [start, end) (epochs), by default from
+    PRICE_HISTORY_SECONDS before the current hour onward."""
     try:
-        conn = sqlite3.connect(DATABASE_NAME)
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT time_start, SEK_per_kWh
-            FROM electricity_prices
-            ORDER BY time_start ASC
-        ''')
-        data_points = cursor.fetchall()
-        return data_points
+        return energy_views.get_prices(start if start is not None else default_window_start(PRICE_HISTORY_SECONDS), end)
     except sqlite3.Error as e:
-        print(f"\nSQLite Error while fetching electricity data: {e}")
+        log.error("SQLite Error while fetching electricity data: %s", e)
         return []
-    finally:
-        if conn:
-            conn.close()
 
 
-def fetch_solar_data_from_database():
-    """Fetches solar data from the database, ordered by time_local."""
-    conn = None
+def fetch_solar_data_from_database(start=None, end=None):
+    """[local time, ghi, temperature, predicted_power] forecast hours in [start, end) (epochs), by
+    default from SOLAR_HISTORY_SECONDS before the current hour onward."""
     try:
-        conn = sqlite3.connect(DATABASE_NAME)
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT time_local, ghi, temperature, predicted_power
-            FROM solar_data
-            ORDER BY time_local ASC
-        ''')
-        data_points = cursor.fetchall()
-        return data_points
+        return energy_views.get_solar(start if start is not None else default_window_start(SOLAR_HISTORY_SECONDS), end)
     except sqlite3.Error as e:
-        print(f"\nSQLite Error while fetching solar data: {e}")
+        log.error("SQLite Error while fetching solar data: %s", e)
         return []
-    finally:
-        if conn:
-            conn.close()
+
+
+def get_energy_summary(now=None):
+    """Current price and the precomputed price and solar statistics of today and tomorrow."""
+    try:
+        return energy_views.get_summary(now if now is not None else time.time())
+    except sqlite3.Error as e:
+        log.error("SQLite Error while fetching the energy summary: %s", e)
+        return None
+
+
+def get_table_generation(table):
+    """Change counter of a table, bumped by triggers on every insert, update and delete."""
+    try:
+        row = db.query_one('SELECT generation FROM table_generations WHERE name = ?', (table,))
+    except sqlite3.Error:
+        return None
+    return row[0] if row else None
+
+# Serialized default-window /electricity_price and /solar_data bodies, rebuilt only after an ingest
+# changed the table or the window moved on to the next hour.
+electricity_price_payload = VersionedJSONCache(
+    "electricity_price_json",
+    lambda: (get_table_generation('electricity_prices'), default_window_start(PRICE_HISTORY_SECONDS)),
+    fetch_electricity_data_from_database)
+solar_data_payload = VersionedJSONCache(
+    "solar_data_json",
+    lambda: (get_table_generation('solar_data'), default_window_start(SOLAR_HISTORY_SECONDS)),
+    fetch_solar_data_from_database)
+
+
+
+# ------- Concurrent source gathering ----------------
+def gather_sources(sources):
+    """Runs every source concurrently and waits for each one at most until its own deadline.
+
+    `sources` maps a name to a (function, deadline_seconds, fallback) tuple. All deadlines are
+    measured from the same start, so the total wait is bounded by the largest deadline.
+    Returns (results, stale) where stale lists the names that missed their deadline or failed;
+    those get their fallback value instead of a result.
+    """
+    start = time.monotonic()
+    # Each source runs in a copy of the caller's context, so its spans land in the request's trace.
+    futures = {name: _source_executor.submit(contextvars.copy_context().run, func)
+               for name, (func, _, _) in sources.items()}
+    results = {}
+    stale = []
+    for name, (_, deadline, fallback) in sources.items():
+        remaining = max(0.0, start + deadline - time.monotonic())
+        try:
+            results[name] = futures[name].result(timeout=remaining)
+        except FutureTimeoutError:
+            log.warning("Source '%s' missed its %ss deadline, rendering as stale.", name, deadline)
+            results[name] = fallback
+            stale.append(name)
+        except Exception as e:
+            log.warning("Source '%s' failed: %s", name, e)
+            results[name] = fallback
+            stale.append(name)
+    return results, stale
+
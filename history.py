@@ -0,0 +1,189 @@
+import time
+from datetime import datetime, timezone
+
+import db
+
+# --- Rollup Tiers ---
+# Each tier keeps per-bucket min/max/sum of the server_data metrics, keyed by the bucket's start
+# (UTC epoch seconds). The collector updates them in the same transaction as the raw insert.
+# Values are stored as integer tenths of a percent: SQLite packs them into 2-3 bytes instead of an
+# 8-byte REAL, and a running sum (rather than a running mean) stays exact.
+ROLLUP_TIERS = (
+    ('server_data_1m', 60),
+    ('server_data_1h', 3600),
+)
+METRICS = ('cpu', 'memory', 'disk')
+RAW_COLUMNS = {'cpu': 'cpu_percent', 'memory': 'memory_percent', 'disk': 'disk_percent'}
+SCALE = 10  # Stored integer = percent * SCALE
+MAX_POINTS = 2000
+
+# --- Retention Policies ---
+# How long each tier is kept; the collector's retention job deletes everything older. At 10 s
+# samples this bounds the database to roughly 2 MB of raw rows, 5 MB of minute buckets and
+# 0.4 MB of hour buckets per year kept.
+RAW_RETENTION_SECONDS = 2 * 24 * 3600
+RETENTION_SECONDS = {
+    'server_data': RAW_RETENTION_SECONDS,
+    'server_data_1m': 90 * 24 * 3600,
+    'server_data_1h': 5 * 365 * 24 * 3600,
+}
+
+
+def update_rollups(cursor, data, now=None):
+    """Folds one sample into the current bucket of every tier: running min, max and sum."""
+    now = int(now if now is not None else time.time())
+    values = [round(data[RAW_COLUMNS[m]] * SCALE) for m in METRICS]
+    columns = ", ".join(f"{m}_min, {m}_max, {m}_sum" for m in METRICS)
+    updates = ", ".join(
+        f"{m}_min = MIN({m}_min, excluded.{m}_min), "
+        f"{m}_max = MAX({m}_max, excluded.{m}_max), "
+        f"{m}_sum = {m}_sum + excluded.{m}_sum"
+        for m in METRICS)
+    params = [v for value in values for v in (value, value, value)]
+    for table, width in ROLLUP_TIERS:
+        cursor.execute(f'''
+            INSERT INTO {table} (bucket, samples, {columns})
+            VALUES (?, 1, {", ".join("?" for _ in params)})
+            ON CONFLICT(bucket) DO UPDATE SET {updates}, samples = samples + 1
+        ''', [now - now % width, *params])
+
+
+def apply_retention(now=None):
+    """Deletes the rows each tier's policy no longer keeps and returns the count per table.
+
+    Every delete is a range on the tier's time key (the raw timestamp index, the rollup bucket
+    primary key), so it only touches the expired rows. Freed pages are reused by later inserts,
+    so the file stops growing once every tier has filled its window.
+    """
+    now = int(now if now is not None else time.time())
+    deleted = {}
+    with db.transaction() as conn:
+        deleted['server_data'] = conn.execute(
+            'DELETE FROM server_data WHERE timestamp < ?',
+            (_utc_text(now - RETENTION_SECONDS['server_data']),)).rowcount
+        # Sampler aggregates share the raw rows' ids and go with them.
+        deleted['system_samples'] = conn.execute(
+            'DELETE FROM system_samples WHERE sample_id < (SELECT COALESCE(MIN(id), 0) FROM server_data)').rowcount
+        for table, _ in ROLLUP_TIERS:
+            deleted[table] = conn.execute(
+                f'DELETE FROM {table} WHERE bucket < ?', (now - RETENTION_SECONDS[table],)).rowcount
+    return deleted
+
+
+def to_epoch(value):
+    """Accepts epoch seconds or an ISO-8601 string (naive means UTC)."""
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        moment = datetime.fromisoformat(value)
+        if moment.tzinfo is None:
+            moment = moment.replace(tzinfo=timezone.utc)
+        return int(moment.timestamp())
+
+
+def _utc_text(epoch):
+    return datetime.fromtimestamp(epoch, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def choose_source(start, end, points, now=None):
+    """Picks the coarsest tier that still gives at least one stored bucket per output point, or a
+    coarser one when the range starts before that tier's retention window."""
+    now = now if now is not None else time.time()
+    sources = [('server_data', None), *ROLLUP_TIERS]
+    width = (end - start) / points
+    chosen = max(i for i, (_, tier_width) in enumerate(sources) if tier_width is None or width >= tier_width)
+    while chosen < len(sources) - 1 and start < now - RETENTION_SECONDS[sources[chosen][0]]:
+        chosen += 1
+    return sources[chosen]
+
+
+def get_bucketed_history(start, end, points):
+    """Min/avg/max of every metric in `points` equal buckets between start and end (epoch seconds).
+
+    The aggregation runs in SQL over the coarsest suitable rollup tier, so a long range never
+    scans raw samples. Returns a columnar dict; empty buckets are omitted.
+    """
+    points = max(1, min(points, MAX_POINTS))
+    width = max(1, (end - start + points - 1) // points)
+    source, _ = choose_source(start, end, points)
+    if source == 'server_data':
+        aggregates = ", ".join(f"MIN({c}), AVG({c}), MAX({c})" for c in RAW_COLUMNS.values())
+        rows = db.query_all(f'''
+            SELECT (CAST(strftime('%s', timestamp) AS INTEGER) - ?) / ? AS slot, {aggregates}
+            FROM server_data
+            WHERE timestamp >= ? AND timestamp < ?
+            GROUP BY slot ORDER BY slot
+        ''', (start, width, _utc_text(start), _utc_text(end)))
+    else:
+        aggregates = ", ".join(
+            f"MIN({m}_min) * 1.0 / {SCALE}, SUM({m}_sum) * 1.0 / (SUM(samples) * {SCALE}), MAX({m}_max) * 1.0 / {SCALE}"
+            for m in METRICS)
+        rows = db.query_all(f'''
+            SELECT (bucket - ?) / ? AS slot, {aggregates}
+            FROM {source}
+            WHERE bucket >= ? AND bucket < ?
+            GROUP BY slot ORDER BY slot
+        ''', (start, width, start, end))
+
+    result = {'source': source, 'bucket_seconds': width, 't': [start + row[0] * width for row in rows]}
+    for i, m in enumerate(METRICS):
+        result[f'{m}_min'] = [row[1 + 3 * i] for row in rows]
+        result[f'{m}_avg'] = [round(row[2 + 3 * i], 2) for row in rows]
+        result[f'{m}_max'] = [row[3 + 3 * i] for row in rows]
+    return result
+
+
+def lttb(times, values, threshold):
+    """Largest-Triangle-Three-Buckets downsampling; keeps the visually significant points."""
+    n = len(values)
+    if threshold >= n or threshold < 3:
+        return list(times), list(values)
+    every = (n - 2) / (threshold - 2)
+    sampled = [0]
+    a = 0
+    for i in range(threshold - 2):
+        next_start = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, n)
+        avg_t = sum(times[next_start:next_end]) / (next_end - next_start)
+        avg_v = sum(values[next_start:next_end]) / (next_end - next_start)
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        best, best_area = start, -1.0
+        at, av = times[a], values[a]
+        for j in range(start, end):
+            area = abs((at - avg_t) * (values[j] - av) - (at - times[j]) * (avg_v - av))
+            if area > best_area:
+                best, best_area = j, area
+        sampled.append(best)
+        a = best
+    sampled.append(n - 1)
+    return [times[i] for i in sampled], [values[i] for i in sampled]
+
+
+def get_lttb_history(start, end, points):
+    """LTTB-downsampled series of every metric, taken from the per-bucket means of the same tier
+    get_bucketed_history would use, so the input is at most one tier-width ratio per point."""
+    points = max(3, min(points, MAX_POINTS))
+    source, tier_width = choose_source(start, end, points)
+    if source == 'server_data':
+        columns = ", ".join(RAW_COLUMNS.values())
+        rows = db.query_all(f'''
+            SELECT CAST(strftime('%s', timestamp) AS INTEGER), {columns}
+            FROM server_data WHERE timestamp >= ? AND timestamp < ? ORDER BY id
+        ''', (_utc_text(start), _utc_text(end)))
+    else:
+        columns = ", ".join(f"{m}_sum * 1.0 / (samples * {SCALE})" for m in METRICS)
+        rows = db.query_all(f'''
+            SELECT bucket, {columns} FROM {source}
+            WHERE bucket >= ? AND bucket < ? ORDER BY bucket
+        ''', (start, end))
+    result = {'source': source}
+    if not rows:
+        for m in METRICS:
+            result[m] = {'t': [], 'v': []}
+        return result
+    times = [row[0] for row in rows]
+    for i, m in enumerate(METRICS):
+        t, v = lttb(times, [row[1 + i] for row in rows], points)
+        result[m] = {'t': t, 'v': [round(x, 2) for x in v]}
+    return result
@@ -0,0 +1,138 @@
+import hashlib
+import threading
+import requests
+import metrics
+import providers
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# --- Connection Pool Configuration ---
+HTTP_POOL_CONNECTIONS = 8  # Number of per-host pools kept alive (Shelly, met.no, elpris, Open-Meteo, ...)
+HTTP_POOL_MAXSIZE = 8  # Keep-alive connections per host
+HTTP_RETRIES = 3  # Retries on connection errors and transient HTTP statuses
+HTTP_BACKOFF_FACTOR = 0.5  # Sleeps 0.5 s, 1 s, 2 s between retries
+HTTP_RETRY_STATUSES = (429, 500, 502, 503, 504)
+DEFAULT_TIMEOUT_SECONDS = 5
+
+_session = None
+_session_lock = threading.Lock()
+
+# --- Upstream Metrics ---
+UPSTREAM_SECONDS = metrics.histogram('upstream_request_duration_seconds',
+                                     'Calls to upstream providers (Shelly, met.no, elpris, Open-Meteo)', ('provider',))
+UPSTREAM_ERRORS = metrics.counter('upstream_errors_total', 'Failed upstream calls by provider', ('provider',))
+
+# --- Conditional Request State ---
+_validators = {}  # (provider, url, params) -> {"etag", "last_modified", "hash"}
+_conditional_stats = {}  # provider -> counters
+_conditional_lock = threading.Lock()
+
+
+def create_session(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE,
+                   retries=HTTP_RETRIES, backoff_factor=HTTP_BACKOFF_FACTOR):
+    """Creates a requests session with keep-alive pools per host and retry with backoff."""
+    retry = Retry(
+        total=retries,
+        connect=retries,
+        read=retries,
+        status=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=HTTP_RETRY_STATUSES,
+        allowed_methods=frozenset(["GET", "HEAD"]),
+        respect_retry_after_header=True,
+    )
+    adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    providers.install(session, adapter)  # Fixture or recording transport for the provider hosts
+    return session
+
+
+def get_session():
+    """Returns the process-wide shared session, creating it on first use."""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = create_session()
+    return _session
+
+
+def get(url, timeout=DEFAULT_TIMEOUT_SECONDS, session=None, **kwargs):
+    """GET through the shared pooled session, or `session` (e.g. one without retries). Raises
+    requests exceptions like requests.get."""
+    provider = providers.name_of(url) or 'other'
+    try:
+        with UPSTREAM_SECONDS.labels(provider).time(f"http {provider}"):
+            response = (session or get_session()).get(url, timeout=timeout, **kwargs)
+    except requests.exceptions.RequestException:
+        UPSTREAM_ERRORS.inc(provider)
+        raise
+    if response.status_code >= 400:
+        UPSTREAM_ERRORS.inc(provider)
+    return response
+
+
+def close():
+    """Closes every pooled connection, e.g. on shutdown."""
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
+
+
+def get_if_changed(url, provider, params=None, ignore=None, timeout=DEFAULT_TIMEOUT_SECONDS, **kwargs):
+    """GET that returns None when the payload has not changed since the last changed response.
+
+    Sends If-None-Match / If-Modified-Since when the provider gave an ETag or Last-Modified
+    earlier, and otherwise compares a SHA-256 of the raw body, so an unchanged payload is never
+    parsed. `ignore` is an optional compiled bytes regex for volatile parts of the body (such as a
+    generation time) that should not count as a change. Raises requests exceptions like get().
+    """
+    key = (provider, url, repr(sorted(params.items())) if params else None)
+    with _conditional_lock:
+        known = dict(_validators.get(key, {}))
+        stats = _conditional_stats.setdefault(provider, {"requests": 0, "not_modified": 0, "unchanged_hash": 0, "changed": 0})
+        stats["requests"] += 1
+    headers = dict(kwargs.pop("headers", None) or {})
+    if known.get("etag"):
+        headers["If-None-Match"] = known["etag"]
+    if known.get("last_modified"):
+        headers["If-Modified-Since"] = known["last_modified"]
+
+    response = get(url, timeout=timeout, params=params, headers=headers, **kwargs)
+    if response.status_code == 304:
+        with _conditional_lock:
+            stats["not_modified"] += 1
+        return None
+    response.raise_for_status()
+    body = response.content if ignore is None else ignore.sub(b"", response.content)
+    content_hash = hashlib.sha256(body).hexdigest()
+    with _conditional_lock:
+        if known.get("hash") == content_hash:
+            stats["unchanged_hash"] += 1
+            return None
+        stats["changed"] += 1
+        _validators[key] = {"etag": response.headers.get("ETag"),
+                            "last_modified": response.headers.get("Last-Modified"),
+                            "hash": content_hash}
+    return response
+
+
+def forget(provider):
+    """Drops the stored validators of a provider so its next payloads are processed again,
+    e.g. after storing a changed payload failed."""
+    with _conditional_lock:
+        for key in [key for key in _validators if key[0] == provider]:
+            del _validators[key]
+
+
+def conditional_stats(provider=None):
+    """Returns the skip counters of one provider, or of all of them."""
+    with _conditional_lock:
+        if provider is not None:
+            return dict(_conditional_stats.get(provider, {}))
+        return {name: dict(stats) for name, stats in _conditional_stats.items()}
+
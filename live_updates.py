@@ -0,0 +1,184 @@
+import asyncio
+import json
+import logging
+import queue
+import threading
+import time
+
+log = logging.getLogger('live_updates')
+
+# --- Live Update Configuration ---
+SUBSCRIBER_QUEUE_SIZE = 100  # Events buffered per client before the oldest are dropped
+HEARTBEAT_SECONDS = 15  # Comment line sent on idle streams so proxies keep them open
+
+
+class _Source:
+    def __init__(self, event, fetch, interval_seconds, snapshot):
+        self.event = event
+        self.fetch = fetch
+        self.interval_seconds = interval_seconds
+        self.snapshot = snapshot
+        self.last_payload = None
+
+
+def _offer(events, item):
+    """Queues an item without blocking; a stalled client loses its oldest event rather than blocking everyone else."""
+    try:
+        events.put_nowait(item)
+    except (queue.Full, asyncio.QueueFull):
+        try:
+            events.get_nowait()
+            events.put_nowait(item)
+        except (queue.Empty, queue.Full, asyncio.QueueEmpty, asyncio.QueueFull):
+            pass
+
+
+def _format_event(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+
+class AsyncSubscriber:
+    """Event queue of a client of the asyncio server. The hub publishes from its poller threads,
+    so items are handed to the subscriber's event loop instead of being queued directly."""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.events = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+
+    def put_nowait(self, item):
+        try:
+            self.loop.call_soon_threadsafe(_offer, self.events, item)
+        except RuntimeError:  # Loop already closed
+            pass
+
+
+class LiveHub:
+    """Fans out metric changes to Server-Sent Events subscribers.
+
+    Each source is polled by its own background thread once per interval, no matter how many tabs
+    are connected, and only while at least one subscriber exists, so a slow source (an unreachable
+    plug) never delays the others. Snapshot sources (plug state, battery) publish only
+    when their payload changes and replay the last value to new subscribers; incremental sources
+    (new server_data rows) publish whatever fetch() returns, and None means nothing new.
+    """
+
+    def __init__(self):
+        self._sources = []
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._has_subscribers = threading.Condition(self._lock)
+        self._started = False
+        self._closed = False
+
+    def add_source(self, event, fetch, interval_seconds, snapshot=True):
+        self._sources.append(_Source(event, fetch, interval_seconds, snapshot))
+
+    def subscribe(self, events=None):
+        """Registers a new client and returns its event queue, primed with the current snapshots."""
+        events = events if events is not None else queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        with self._lock:
+            if self._closed:
+                events.put_nowait(None)
+                return events
+            for source in self._sources:
+                if source.snapshot and source.last_payload is not None:
+                    events.put_nowait((source.event, source.last_payload))
+            self._subscribers.add(events)
+            if not self._started:
+                for source in self._sources:
+                    threading.Thread(target=self._poll, args=(source,), name=f"live-{source.event}", daemon=True).start()
+                self._started = True
+            self._has_subscribers.notify_all()
+        return events
+
+    def subscribe_async(self):
+        """subscribe() for a coroutine on the running event loop; returns an AsyncSubscriber."""
+        return self.subscribe(AsyncSubscriber(asyncio.get_running_loop()))
+
+    def unsubscribe(self, events):
+        with self._lock:
+            self._subscribers.discard(events)
+
+    def subscriber_count(self):
+        with self._lock:
+            return len(self._subscribers)
+
+    def close(self):
+        """Ends every open stream, e.g. on shutdown, so workers don't wait for SSE clients."""
+        with self._lock:
+            self._closed = True
+            subscribers = list(self._subscribers)
+        for events in subscribers:
+            _offer(events, None)
+
+    def publish(self, event, payload):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for events in subscribers:
+            _offer(events, (event, payload))
+
+    def stream(self, events):
+        """Yields SSE-formatted messages from a subscriber queue until the client disconnects."""
+        try:
+            while True:
+                try:
+                    item = events.get(timeout=HEARTBEAT_SECONDS)
+                except queue.Empty:
+                    yield ": heartbeat\n\n"
+                    continue
+                if item is None:  # Hub closed
+                    return
+                yield _format_event(*item)
+        finally:
+            self.unsubscribe(events)
+
+    async def stream_async(self, subscriber):
+        """stream() for an AsyncSubscriber: an async generator that waits on the event loop, so an
+        open stream costs a queue, not a thread."""
+        try:
+            while True:
+                try:
+                    item = await asyncio.wait_for(subscriber.events.get(), HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": heartbeat\n\n"
+                    continue
+                if item is None:  # Hub closed
+                    return
+                yield _format_event(*item)
+        finally:
+            self.unsubscribe(subscriber)
+
+    def _poll(self, source):
+        while True:
+            with self._lock:
+                while not self._subscribers:
+                    self._has_subscribers.wait()
+            started = time.monotonic()
+            try:
+                payload = source.fetch()
+            except Exception as e:
+                log.warning("Live source '%s' failed: %s", source.event, e)
+                payload = None
+            if payload is not None and not (source.snapshot and payload == source.last_payload):
+                source.last_payload = payload
+                self.publish(source.event, payload)
+            time.sleep(max(0.0, source.interval_seconds - (time.monotonic() - started)))
+
+
+class ServerDataCursor:
+    """Incremental fetcher that returns only the server_data rows stored since the previous call."""
+
+    def __init__(self, fetch_since, latest_id):
+        self.fetch_since = fetch_since
+        self.latest_id = latest_id
+        self.last_id = None
+
+    def __call__(self):
+        if self.last_id is None:
+            # Clients load the current window themselves; only rows stored from now on are pushed.
+            self.last_id = self.latest_id()
+            return None
+        rows = self.fetch_since(self.last_id)
+        if rows:
+            self.last_id = rows['last_id']
+        return rows
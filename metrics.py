@@ -0,0 +1,265 @@
+"""In-process metrics and sampled request traces, exported in the Prometheus text format.
+
+Histograms and counters are plain Python objects updated under a lock: an observation costs a
+perf_counter() pair and a bisect, a few microseconds. Values kept elsewhere (cache hit
+rates, logging counters) are read at scrape time by collector callbacks.
+
+Tracing is off unless TRACE_SAMPLE_RATE > 0 or a request sends an X-Trace header. A sampled
+request gets a Trace in a context variable and every timed operation it runs (SQLite queries,
+upstream calls) adds a span to it; when no trace is active a timer only pays one context
+variable lookup for it.
+"""
+import bisect
+import contextvars
+import os
+import random
+import threading
+import time
+import uuid
+from collections import deque
+
+# --- Metrics Configuration ---
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+PROCESS_NAME = os.environ.get('METRICS_PROCESS', 'web')  # `process` label of this process's series
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', 0))  # Fraction of requests traced; 0 = off
+TRACE_BUFFER_SIZE = 100  # Most recent sampled traces kept for /traces
+TRACE_MAX_SPANS = 500  # Per trace, so a long-running request can't grow one without bound
+
+_registry = {}  # name -> Histogram | Counter
+_registry_lock = threading.Lock()
+_collectors = []  # callables returning [(name, type, help, [(labels dict, value)])]
+
+
+def _register(metric):
+    with _registry_lock:
+        return _registry.setdefault(metric.name, metric)
+
+
+class _Span:
+    """Times one operation into a histogram child and, when a trace is active, records a span."""
+    __slots__ = ('child', 'name', 'started', 'trace')
+
+    def __init__(self, child, name):
+        self.child = child
+        self.name = name
+
+    def __enter__(self):
+        self.trace = _current_trace.get()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self.started
+        if self.child is not None:
+            self.child.observe(duration)
+        if self.trace is not None and self.name is not None:
+            self.trace.add_span(self.name, self.started, duration, exc_type is not None)
+        return False
+
+
+class _HistogramChild:
+    __slots__ = ('counts', 'sum', 'count', '_buckets', '_lock')
+
+    def __init__(self, buckets):
+        self._buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self, span_name=None):
+        """Context manager observing the block's duration; `span_name` names its trace span."""
+        return _Span(self, span_name)
+
+    def snapshot(self):
+        with self._lock:
+            return {"counts": list(self.counts), "sum": self.sum, "count": self.count}
+
+
+class Histogram:
+    """Latency histogram with fixed buckets, one child per label combination."""
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels_names = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, _HistogramChild(self.buckets))
+        return child
+
+    def snapshot(self):
+        return {"type": self.kind, "help": self.help, "labels": self.labels_names, "buckets": self.buckets,
+                "samples": [[list(values), child.snapshot()] for values, child in list(self._children.items())]}
+
+
+class Counter:
+    """Monotonic counter, one value per label combination."""
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *values, amount=1):
+        with self._lock:
+            self._values[values] = self._values.get(values, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            samples = [[list(values), value] for values, value in self._values.items()]
+        return {"type": self.kind, "help": self.help, "labels": self.labels_names, "samples": samples}
+
+
+def histogram(name, help, labels=(), buckets=LATENCY_BUCKETS):
+    """The registered histogram `name`, created on first use."""
+    return _register(Histogram(name, help, labels, buckets))
+
+
+def counter(name, help, labels=()):
+    return _register(Counter(name, help, labels))
+
+
+def add_collector(callback):
+    """Registers a callback run at every scrape for values kept elsewhere; it returns
+    [(name, 'gauge' or 'counter', help, [(labels dict, value)])]."""
+    _collectors.append(callback)
+
+
+def snapshot():
+    """Every registered metric as JSON-serializable data, e.g. to hand it to another process."""
+    with _registry_lock:
+        metrics = list(_registry.values())
+    return {metric.name: metric.snapshot() for metric in metrics}
+
+
+# --- Prometheus text format ---
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _label_text(names, values, extra=None):
+    pairs = list(zip(names, values)) + list((extra or {}).items())
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(snapshots, collected=()):
+    """Prometheus exposition text of {process: snapshot()} plus collected families. Series of
+    the same metric from several processes are told apart by a `process` label; collected
+    families are always this process's."""
+    families = {}
+    for process, metrics in snapshots.items():
+        for name, data in metrics.items():
+            families.setdefault(name, (data, []))[1].append((process, data))
+    lines = []
+    for name, (first, parts) in sorted(families.items()):
+        lines.append(f"# HELP {name} {first['help']}")
+        lines.append(f"# TYPE {name} {first['type']}")
+        for process, data in parts:
+            extra = {'process': process}
+            for values, sample in data['samples']:
+                if data['type'] == 'histogram':
+                    cumulative = 0
+                    for bound, count in zip(list(data['buckets']) + [float('inf')], sample['counts']):
+                        cumulative += count
+                        labels = _label_text(data['labels'], values, {**extra, 'le': _number(bound)})
+                        lines.append(f"{name}_bucket{labels} {cumulative}")
+                    labels = _label_text(data['labels'], values, extra)
+                    lines.append(f"{name}_sum{labels} {_number(sample['sum'])}")
+                    lines.append(f"{name}_count{labels} {sample['count']}")
+                else:
+                    lines.append(f"{name}{_label_text(data['labels'], values, extra)} {_number(sample)}")
+    for name, kind, help, samples in collected:
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            if value is not None:
+                labels = _label_text(labels.keys(), labels.values(), {'process': PROCESS_NAME})
+                lines.append(f"{name}{labels} {_number(value)}")
+    return '\n'.join(lines) + '\n'
+
+
+def collected_families():
+    families = []
+    for callback in _collectors:
+        families.extend(callback())
+    return families
+
+
+# --- Tracing ---
+_current_trace = contextvars.ContextVar('trace', default=None)
+_traces = deque(maxlen=TRACE_BUFFER_SIZE)
+
+
+class Trace:
+    """Spans of one sampled request, as offsets from its start."""
+
+    def __init__(self, name):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        self.spans = []
+        self.attributes = {}
+        self._token = None
+
+    def add_span(self, name, started, duration, failed=False):
+        if len(self.spans) < TRACE_MAX_SPANS:  # list.append is atomic; spans may come from other threads
+            self.spans.append({"name": name, "offset_ms": round((started - self.started) * 1000, 3),
+                               "duration_ms": round(duration * 1000, 3), "failed": failed})
+
+    def to_dict(self):
+        return {"trace_id": self.trace_id, "name": self.name, "started_at": self.started_at,
+                "duration_ms": self.attributes.get("duration_ms"), "attributes": self.attributes,
+                "spans": sorted(self.spans, key=lambda span: span["offset_ms"])}
+
+
+def start_trace(name, force=False):
+    """Starts a trace for the current request if it is sampled (or forced); returns it or None."""
+    if not force and (TRACE_SAMPLE_RATE <= 0 or random.random() >= TRACE_SAMPLE_RATE):
+        return None
+    trace = Trace(name)
+    trace._token = _current_trace.set(trace)
+    return trace
+
+
+def finish_trace(trace, **attributes):
+    trace.attributes.update(attributes)
+    trace.attributes["duration_ms"] = round((time.perf_counter() - trace.started) * 1000, 3)
+    try:
+        _current_trace.reset(trace._token)
+    except ValueError:  # Finished from another context than the one that started it
+        _current_trace.set(None)
+    _traces.append(trace)
+
+
+def span(name):
+    """Times a block as a span of the current trace only (no histogram)."""
+    return _Span(None, name)
+
+
+def recent_traces():
+    return [trace.to_dict() for trace in reversed(_traces)]
@@ -0,0 +1,196 @@
+import logging
+
+import db
+
+log = logging.getLogger('migrations')
+
+# Migrations are frozen: they spell out their own SQL instead of importing the current schema, so
+# a fresh database replays exactly the history an upgraded one went through.
+_ROLLUP_TIERS = (('server_data_1m', 60), ('server_data_1h', 3600))
+_METRICS = (('cpu', 'cpu_percent'), ('memory', 'memory_percent'), ('disk', 'disk_percent'))
+
+
+def _real_rollup_statements():
+    """Migration 3: REAL min/avg/max rollup tiers backfilled from the raw rows."""
+    columns = ", ".join(f"{m}_min, {m}_avg, {m}_max" for m, _ in _METRICS)
+    aggregates = ", ".join(f"MIN({c}), AVG({c}), MAX({c})" for _, c in _METRICS)
+    definitions = ", ".join(f"{m}_min REAL, {m}_avg REAL, {m}_max REAL" for m, _ in _METRICS)
+    statements = []
+    for table, width in _ROLLUP_TIERS:
+        statements.append(f"CREATE TABLE IF NOT EXISTS {table} (bucket INTEGER PRIMARY KEY, samples INTEGER NOT NULL, {definitions})")
+        statements.append(f'''INSERT OR IGNORE INTO {table} (bucket, samples, {columns})
+            SELECT (CAST(strftime('%s', timestamp) AS INTEGER) / {width}) * {width} AS bucket, COUNT(*), {aggregates}
+            FROM server_data GROUP BY bucket''')
+    return statements
+
+
+def _compact_rollup_statements():
+    """Migration 4: rebuilds the rollup tiers with integer tenths of a percent and a running sum."""
+    definitions = ", ".join(f"{m}_min INTEGER, {m}_max INTEGER, {m}_sum INTEGER" for m, _ in _METRICS)
+    converted = ", ".join(
+        f"CAST(ROUND({m}_min * 10) AS INTEGER), CAST(ROUND({m}_max * 10) AS INTEGER), "
+        f"CAST(ROUND({m}_avg * samples * 10) AS INTEGER)"
+        for m, _ in _METRICS)
+    statements = []
+    for table, _ in _ROLLUP_TIERS:
+        statements += [
+            f"CREATE TABLE {table}_compact (bucket INTEGER PRIMARY KEY, samples INTEGER NOT NULL, {definitions})",
+            f"INSERT INTO {table}_compact SELECT bucket, samples, {converted} FROM {table}",
+            f"DROP TABLE {table}",
+            f"ALTER TABLE {table}_compact RENAME TO {table}",
+        ]
+    return statements
+
+def _generation_statements():
+    """Migration 7: a generation counter per table, bumped by triggers on every row change.
+
+    Counters start at the migration's epoch in milliseconds, so a recreated database doesn't hand
+    out generations (and ETags) that an older copy already used.
+    """
+    statements = ['''CREATE TABLE IF NOT EXISTS table_generations (
+        name TEXT PRIMARY KEY,
+        generation INTEGER NOT NULL
+    )''']
+    for table in ('electricity_prices', 'solar_data'):
+        statements.append(f"INSERT OR IGNORE INTO table_generations (name, generation) "
+                          f"VALUES ('{table}', CAST(strftime('%s', 'now') AS INTEGER) * 1000)")
+        for operation in ('INSERT', 'UPDATE', 'DELETE'):
+            statements.append(f'''CREATE TRIGGER IF NOT EXISTS {table}_generation_{operation.lower()}
+                AFTER {operation} ON {table}
+                BEGIN
+                    UPDATE table_generations SET generation = generation + 1 WHERE name = '{table}';
+                END''')
+    return statements
+
+# --- Schema Migrations ---
+# Each migration runs once, in order, inside a single transaction. PRAGMA user_version stores the
+# number of the last applied migration, so adding a schema change means appending an entry here.
+MIGRATIONS = [
+    (1, "Index the time columns used for ordering and range queries", [
+        "CREATE INDEX IF NOT EXISTS idx_server_data_timestamp ON server_data (timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_solar_data_time_local ON solar_data (time_local)",
+    ]),
+    (2, "Per-collector scheduler stats shared with the web server", [
+        '''CREATE TABLE IF NOT EXISTS collector_stats (
+            name TEXT PRIMARY KEY,
+            stats TEXT NOT NULL,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )''',
+    ]),
+    (3, "1 minute and 1 hour min/avg/max rollups of server_data, backfilled from raw rows",
+        _real_rollup_statements()),
+    (4, "Compact integer rollup tiers", _compact_rollup_statements()),
+    (5, "Battery controller state and charge-cycle ledger", [
+        '''CREATE TABLE IF NOT EXISTS battery_state (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            state TEXT NOT NULL,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )''',
+        '''CREATE TABLE IF NOT EXISTS charge_cycles (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            started_at INTEGER NOT NULL,
+            ended_at INTEGER NOT NULL,
+            start_percent REAL,
+            end_percent REAL,
+            energy_wh REAL NOT NULL,
+            reason TEXT NOT NULL
+        )''',
+    ]),
+    (6, "Charge plan computed by the collector for the battery controller", [
+        '''CREATE TABLE IF NOT EXISTS charge_plan (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            created_at INTEGER NOT NULL,
+            plan TEXT NOT NULL
+        )''',
+    ]),
+    (7, "Change generations of the price and solar tables, for cheap ETags", _generation_statements()),
+    (8, "Epoch time columns for prices and solar forecasts, and per-day energy statistics", [
+        "ALTER TABLE electricity_prices ADD COLUMN start_epoch INTEGER",
+        "ALTER TABLE electricity_prices ADD COLUMN end_epoch INTEGER",
+        # time_start carries its UTC offset; stored prices so far were hourly.
+        '''UPDATE electricity_prices SET start_epoch = CAST(strftime('%s', time_start) AS INTEGER),
+            end_epoch = CAST(strftime('%s', time_start) AS INTEGER) + 3600''',
+        "CREATE INDEX IF NOT EXISTS idx_electricity_prices_start_epoch ON electricity_prices (start_epoch)",
+        "ALTER TABLE solar_data ADD COLUMN time_epoch INTEGER",
+        # Despite its name time_utc holds the forecast's local wall time, and time_local that time
+        # shifted once more by the local offset, so the offset is their difference.
+        '''UPDATE solar_data SET time_epoch = 2 * CAST(strftime('%s', time_utc) AS INTEGER)
+            - CAST(strftime('%s', time_local) AS INTEGER)''',
+        "CREATE INDEX IF NOT EXISTS idx_solar_data_time_epoch ON solar_data (time_epoch)",
+        '''CREATE TABLE IF NOT EXISTS daily_energy_stats (
+            day TEXT PRIMARY KEY,
+            price_min REAL,
+            price_max REAL,
+            price_avg REAL,
+            cheapest_hour INTEGER,
+            priciest_hour INTEGER,
+            solar_peak_hour INTEGER,
+            solar_peak_w REAL,
+            solar_energy_wh REAL,
+            updated_at INTEGER NOT NULL
+        )''',
+    ]),
+    (9, "Metrics snapshots of processes without an HTTP server, for the web server's /metrics", [
+        '''CREATE TABLE IF NOT EXISTS metrics_snapshots (
+            process TEXT PRIMARY KEY,
+            snapshot TEXT NOT NULL,
+            updated_at INTEGER NOT NULL
+        )''',
+    ]),
+    (10, "Per-window system sampler aggregates alongside the server_data rows", [
+        '''CREATE TABLE IF NOT EXISTS system_samples (
+            sample_id INTEGER PRIMARY KEY,
+            time_epoch INTEGER NOT NULL,
+            samples INTEGER NOT NULL,
+            cpu_max_percent REAL,
+            load_1 REAL,
+            load_5 REAL,
+            load_15 REAL,
+            net_sent_bps REAL,
+            net_recv_bps REAL,
+            net_peak_bps REAL,
+            disk_read_bps REAL,
+            disk_write_bps REAL,
+            disk_peak_bps REAL,
+            details TEXT
+        )''',
+    ]),
+    (11, "Manual charger switches queued for the worker that runs the battery controller", [
+        '''CREATE TABLE IF NOT EXISTS battery_commands (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            turn_on INTEGER NOT NULL,
+            requested_at REAL NOT NULL,
+            done_at REAL,
+            result TEXT
+        )''',
+    ]),
+    (12, "Claim time of a queued charger switch, so a requester only cancels switches not yet started", [
+        "ALTER TABLE battery_commands ADD COLUMN claimed_at REAL",
+    ]),
+]
+
+
+def schema_version():
+    """Returns the number of the last migration applied to the database."""
+    return db.query_one("PRAGMA user_version")[0]
+
+
+def migrate():
+    """Applies every pending migration and returns the resulting schema version."""
+    current = schema_version()
+    for version, description, statements in MIGRATIONS:
+        if version <= current:
+            continue
+        with db.transaction() as conn:
+            # IMMEDIATE takes the write lock before re-reading the version, so when the web server
+            # and the collector start together only one of them applies the migration.
+            conn.execute("BEGIN IMMEDIATE")
+            if conn.execute("PRAGMA user_version").fetchone()[0] >= version:
+                current = version
+                continue
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {version}")
+        log.info("Applied schema migration %d: %s", version, description)
+        current = version
+    return current
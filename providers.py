@@ -0,0 +1,210 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+from urllib.parse import urlsplit, parse_qsl
+
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+log = logging.getLogger('providers')
+
+# --- Upstream Providers ---
+# Every external API the collector and the web server talk to, by name. The backend decides where
+# their requests actually go:
+#   live      the real APIs
+#   record    the real APIs, saving every response as a fixture
+#   fixtures  recorded responses served in-process, no network at all
+#   stub      a local stub server (stub_server.py) that serves the same fixtures over HTTP
+PROVIDER_BACKEND = os.environ.get('PROVIDER_BACKEND', 'live')
+FIXTURES_DIR = os.environ.get('PROVIDER_FIXTURES_DIR',
+                              os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures'))
+STUB_SERVER_URL = os.environ.get('PROVIDER_STUB_URL', 'http://127.0.0.1:8765')
+BACKENDS = ('live', 'record', 'fixtures', 'stub')
+
+PROVIDERS = {
+    'elprisetjustnu': 'https://www.elprisetjustnu.se',
+    'open-meteo': 'https://api.open-meteo.com',
+    'met-no': 'https://api.met.no',
+}  # Plus one "shelly-<name>" per Shelly device, registered by shelly_fleet
+
+
+def register(name, base_url):
+    """Adds or re-points a provider, e.g. a Shelly plug at its configured IP."""
+    PROVIDERS[name] = base_url.rstrip('/')
+
+
+def url(name, path):
+    """Full URL of `path` on a provider under the current backend."""
+    if PROVIDER_BACKEND == 'stub':
+        return f"{STUB_SERVER_URL}/{name}{path}"
+    return f"{PROVIDERS[name]}{path}"
+
+
+# --- Fixtures ---
+def fixture_key(path, query=''):
+    """File name for a request: path and sorted query, made filesystem safe."""
+    path = path[:-len('.json')] if path.endswith('.json') else path
+    params = '&'.join(f"{k}={v}" for k, v in sorted(parse_qsl(query)))
+    key = re.sub(r'[^A-Za-z0-9._-]+', '_', f"{path}?{params}" if params else path).strip('_')
+    if len(key) > 200:  # Such keys only match exactly, not by shape
+        key = f"{key[:150]}_{hashlib.sha256(key.encode()).hexdigest()[:16]}"
+    return key
+
+
+def _shape(key):
+    """A key with digits masked, so a fixture recorded for another date still answers."""
+    return re.sub(r'[0-9]', '#', key)
+
+
+def save_fixture(name, path, query, status, headers, body, directory=None):
+    directory = os.path.join(directory or FIXTURES_DIR, name)
+    os.makedirs(directory, exist_ok=True)
+    fixture = {'status': status, 'headers': {k: v for k, v in headers.items() if k.lower() in ('content-type', 'etag', 'last-modified')},
+               'body': body.decode('utf-8', errors='replace')}
+    with open(os.path.join(directory, fixture_key(path, query) + '.json'), 'w') as f:
+        json.dump(fixture, f, indent=1)
+
+
+class FixtureStore:
+    """Recorded responses of every provider, plus the state of devices that have some.
+
+    Lookup is by exact request first, then by the same request with digits masked (the newest
+    such fixture), so a price fixture recorded yesterday answers today's dated URL. Shelly
+    devices are emulated: /relay/N?turn=on/off changes the state later /relay/N and /status
+    reads return.
+    """
+    EMULATED_RELAYS = 4  # Relays reported by an emulated device's /status, as on a Shelly 4Pro
+
+    def __init__(self, directory=None):
+        self.directory = directory or FIXTURES_DIR
+        self._lock = threading.Lock()
+        self.relays = {}  # (provider, relay) -> on
+        self.requests = {}  # provider -> count, for tests and replay reports
+
+    def respond(self, name, path, query=''):
+        """Returns (status, headers, body bytes) for a request to provider `name`."""
+        with self._lock:
+            self.requests[name] = self.requests.get(name, 0) + 1
+            if name.startswith('shelly') and (path == '/status' or path.startswith('/relay/')):
+                return 200, {'Content-Type': 'application/json'}, self._shelly(name, path, query)
+        fixture = self._find(name, fixture_key(path, query))
+        if fixture is None:
+            return 404, {'Content-Type': 'text/plain'}, f"No fixture for {name}{path}".encode()
+        return fixture['status'], fixture['headers'], fixture['body'].encode()
+
+    def _shelly(self, name, path, query):
+        if path == '/status':
+            relays = [{'ison': self.relays.get((name, relay), False), 'has_timer': False, 'source': 'stub'}
+                      for relay in range(self.EMULATED_RELAYS)]
+            return json.dumps({'relays': relays, 'meters': [{'power': 0.0, 'is_valid': True}]}).encode()
+        relay = int(path[len('/relay/'):] or 0)
+        turn = dict(parse_qsl(query)).get('turn')
+        if turn in ('on', 'off'):
+            self.relays[name, relay] = turn == 'on'
+        elif turn == 'toggle':
+            self.relays[name, relay] = not self.relays.get((name, relay), False)
+        return json.dumps({'ison': self.relays.get((name, relay), False), 'has_timer': False, 'source': 'stub'}).encode()
+
+    def _find(self, name, key):
+        directory = os.path.join(self.directory, name)
+        exact = os.path.join(directory, key + '.json')
+        candidates = [exact] if os.path.exists(exact) else []
+        if not candidates and os.path.isdir(directory):
+            shape = _shape(key)
+            candidates = sorted(os.path.join(directory, f) for f in os.listdir(directory)
+                                if f.endswith('.json') and _shape(f[:-5]) == shape)
+        if not candidates:
+            return None
+        with open(candidates[-1]) as f:
+            return json.load(f)
+
+
+def name_of(request_url):
+    """Provider a URL belongs to under the current backend, or None; used to label metrics."""
+    if PROVIDER_BACKEND == 'stub' and request_url.startswith(STUB_SERVER_URL):
+        return request_url[len(STUB_SERVER_URL):].lstrip('/').split('/', 1)[0] or None
+    return provider_for(request_url)[0]
+
+
+def provider_for(request_url):
+    """(provider name, path, query) of a URL on one of the registered live base URLs."""
+    for name, base in PROVIDERS.items():
+        # Up to a path boundary: a device at 192.168.1.3 doesn't own http://192.168.1.31/...
+        if request_url.startswith(base) and request_url[len(base):len(base) + 1] in ('', '/', '?'):
+            parts = urlsplit(request_url[len(base):])
+            return name, parts.path or '/', parts.query
+    return None, None, None
+
+
+def _build_response(request, status, headers, body):
+    response = requests.Response()
+    response.status_code = status
+    response.headers = CaseInsensitiveDict(headers)
+    response._content = body
+    response.url = request.url
+    response.request = request
+    response.encoding = 'utf-8'
+    response.reason = 'OK' if status < 400 else 'Not Found'
+    return response
+
+
+class FixtureAdapter(BaseAdapter):
+    """requests transport that answers provider URLs from a FixtureStore without a socket."""
+
+    def __init__(self, store):
+        super().__init__()
+        self.store = store
+
+    def send(self, request, **kwargs):
+        name, path, query = provider_for(request.url)
+        if name is None:
+            # Mounted per base URL prefix, so e.g. 192.168.1.31 reaches the adapter of 192.168.1.3
+            return _build_response(request, 404, {'Content-Type': 'text/plain'}, f"No provider for {request.url}".encode())
+        status, headers, body = self.store.respond(name, path, query)
+        return _build_response(request, status, headers, body)
+
+    def close(self):
+        pass
+
+
+class RecordingAdapter(HTTPAdapter):
+    """The normal pooled transport, saving each successful provider response as a fixture."""
+
+    def send(self, request, **kwargs):
+        response = super().send(request, **kwargs)
+        name, path, query = provider_for(request.url)
+        if name is not None and response.status_code == 200:
+            try:
+                save_fixture(name, path, query, response.status_code, response.headers, response.content)
+            except OSError as e:
+                log.warning("Could not record fixture for %s: %s", request.url, e)
+        return response
+
+
+_store = None
+
+
+def fixture_store():
+    global _store
+    if _store is None:
+        _store = FixtureStore()
+    return _store
+
+
+def install(session, adapter):
+    """Mounts the current backend on a requests session; `adapter` is its normal transport."""
+    if PROVIDER_BACKEND not in BACKENDS:
+        raise ValueError(f"Unknown PROVIDER_BACKEND '{PROVIDER_BACKEND}', expected one of {BACKENDS}")
+    if PROVIDER_BACKEND == 'fixtures':
+        fixtures = FixtureAdapter(fixture_store())
+        for base in PROVIDERS.values():
+            session.mount(base, fixtures)
+    elif PROVIDER_BACKEND == 'record':
+        recording = RecordingAdapter(pool_connections=adapter._pool_connections, pool_maxsize=adapter._pool_maxsize,
+                                     max_retries=adapter.max_retries)
+        for base in PROVIDERS.values():
+            session.mount(base, recording)
@@ -0,0 +1,324 @@
+"""Offline replay of the collector and the battery controller at simulated time.
+
+A trace is a JSON-lines file of {"t": epoch, "kind": ..., "data": ...} events, where kind is
+server_info (a fetch_server_info() sample), battery ({"percent", "is_charging"}), prices (one
+elprisetjustnu day) or solar (an Open-Meteo forecast payload). `run` feeds a trace through the
+collector's store functions, retention and charge planning, and drives the BatteryController
+against a simulated battery and plug, all on a simulated clock:
+
+    python replay.py synthetic --days 7 trace.jsonl
+    python replay.py export --db server_data.db trace.jsonl
+    python replay.py record --minutes 10 trace.jsonl
+    python replay.py run trace.jsonl            # as fast as possible, into a scratch database
+    python replay.py run trace.jsonl --speed 3600 --verbose
+"""
+import argparse
+import heapq
+import json
+import logging
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import charge_planner
+import database_script
+import db
+import history
+import structured_log
+from battery_controller import BatteryController
+
+KINDS = ('server_info', 'battery', 'prices', 'solar')
+
+# --- Replay Defaults (mirroring small_server.py's battery configuration) ---
+LOW_BATTERY_THRESHOLD = 35
+HIGH_BATTERY_THRESHOLD = 80
+ENERGY_PER_CHARGE_CYCLE_WH = 27.47
+BATTERY_MIN_CHECK_INTERVAL_SECONDS = 10
+BATTERY_MAX_CHECK_INTERVAL_SECONDS = 300
+
+
+class SimClock:
+    """The replay's notion of time.time(); only the event loop moves it."""
+
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class SimulatedBattery:
+    """A battery that charges while the simulated plug is on and discharges otherwise.
+
+    battery events from the trace override the modelled level, so a recorded trace can pin the
+    battery to what really happened while the plug decisions still come from the controller.
+    """
+
+    def __init__(self, clock, level, charge_rate, discharge_rate):
+        self.clock = clock
+        self.level = level
+        self.charge_rate = charge_rate  # %/h
+        self.discharge_rate = discharge_rate  # %/h
+        self.plugged = False
+        self.switches = 0
+        self._updated = clock()
+
+    def _advance(self):
+        now = self.clock()
+        hours = (now - self._updated) / 3600
+        self._updated = now
+        rate = self.charge_rate if self.plugged else -self.discharge_rate
+        self.level = min(100.0, max(0.0, self.level + rate * hours))
+
+    def read(self):
+        self._advance()
+        return {"success": True, "percent": round(self.level, 1), "is_charging": self.plugged, "seconds_left": None}
+
+    def switch(self, turn_on):
+        self._advance()
+        if turn_on != self.plugged:
+            self.switches += 1
+        self.plugged = turn_on
+        return {"success": True}
+
+    def observe(self, percent, is_charging):
+        self._advance()
+        self.level = percent
+
+
+# --- Traces ---
+def read_trace(path):
+    with open(path) as f:
+        events = [json.loads(line) for line in f if line.strip()]
+    events.sort(key=lambda e: e['t'])
+    return events
+
+
+def write_trace(path, events):
+    with open(path, 'w') as f:
+        for event in sorted(events, key=lambda e: e['t']):
+            f.write(json.dumps(event, separators=(',', ':')) + '\n')
+    return len(events)
+
+
+def synthetic_trace(days, interval=10, seed=1, end=None):
+    """Server samples every `interval` s, tomorrow's prices at 13:00 and hourly solar forecasts."""
+    rng = random.Random(seed)
+    end = int(end or time.time())
+    end -= end % 3600
+    start = end - int(days * 86400)
+    events = []
+    for step, t in enumerate(range(start, end, interval)):
+        cpu = 15 + 10 * rng.random() + (40 if step % 360 < 30 else 0)
+        events.append({'t': t, 'kind': 'server_info', 'data': {
+            'cpu_percent': round(cpu, 1), 'memory_total': 8467419136, 'memory_available': 1699262464,
+            'memory_percent': round(60 + 20 * rng.random(), 1), 'disk_total': 95865159680,
+            'disk_used': 38014885888, 'disk_percent': 39.7}})
+    first_day = datetime.fromtimestamp(start).replace(hour=0, minute=0, second=0, microsecond=0)
+    for day in range(-1, int(math.ceil(days)) + 1):
+        published = first_day + timedelta(days=day, hours=13)
+        date = published + timedelta(days=1)
+        level = rng.uniform(0.3, 1.2)
+        prices = []
+        for hour in range(24):
+            moment = (date.replace(hour=hour)).astimezone(database_script.LOCAL_ZONE)
+            peaks = math.exp(-((hour - 8) / 2) ** 2) + math.exp(-((hour - 18) / 2.5) ** 2)
+            prices.append({'SEK_per_kWh': round(max(0.01, level * (0.4 + 0.8 * peaks) + rng.gauss(0, 0.05)), 5),
+                           'time_start': moment.isoformat(),
+                           'time_end': (moment + timedelta(hours=1)).isoformat()})
+        events.append({'t': max(start, int(published.timestamp())), 'kind': 'prices', 'data': prices})
+    for t in range(start, end, 3600):
+        times, ghi, temperature = [], [], []
+        clouds = rng.uniform(0.2, 1.0)
+        for h in range(72):
+            moment = datetime.utcfromtimestamp(t - t % 3600 + h * 3600)
+            hour = (moment.hour + 2) % 24
+            daylight = math.sin(math.pi * (hour - 5) / 16) if 5 < hour < 21 else 0.0
+            times.append(moment.strftime('%Y-%m-%dT%H:%M'))
+            ghi.append(round(max(0.0, 800 * daylight * clouds), 1))
+            temperature.append(round(8 + 6 * daylight, 1))
+        events.append({'t': t, 'kind': 'solar', 'data': {
+            'hourly': {'time': times, 'shortwave_radiation': ghi, 'temperature_2m': temperature}}})
+    return events
+
+
+def export_trace(database):
+    """Events from a database's own rows: server samples, price days and solar ingests."""
+    db.DATABASE_NAME = database
+    events = []
+    for row in db.query_all('''
+            SELECT CAST(strftime('%s', timestamp) AS INTEGER), cpu_percent, memory_total, memory_available,
+                   memory_percent, disk_total, disk_used, disk_percent
+            FROM server_data ORDER BY id'''):
+        events.append({'t': row[0], 'kind': 'server_info', 'data': dict(zip(
+            ('cpu_percent', 'memory_total', 'memory_available', 'memory_percent', 'disk_total', 'disk_used',
+             'disk_percent'), row[1:]))})
+    days = {}
+    for time_start, price in db.query_all('SELECT time_start, SEK_per_kWh FROM electricity_prices ORDER BY time_start'):
+        days.setdefault(time_start[:10], []).append({'time_start': time_start, 'SEK_per_kWh': price})
+    for day, prices in days.items():
+        published = datetime.fromisoformat(day) - timedelta(days=1) + timedelta(hours=13)
+        events.append({'t': int(published.timestamp()), 'kind': 'prices', 'data': prices})
+    ingests = {}
+    for stored, time_utc, ghi, temperature in db.query_all(
+            "SELECT CAST(strftime('%s', timestamp) AS INTEGER), time_utc, ghi, temperature FROM solar_data ORDER BY time_utc"):
+        hourly = ingests.setdefault(stored, {'time': [], 'shortwave_radiation': [], 'temperature_2m': []})
+        hourly['time'].append(time_utc)
+        hourly['shortwave_radiation'].append(ghi)
+        hourly['temperature_2m'].append(temperature)
+    for stored, hourly in ingests.items():
+        # time_utc holds the wall-clock times of a forecast requested for the local zone.
+        events.append({'t': stored, 'kind': 'solar', 'data': {'hourly': hourly, 'timezone': 'Europe/Stockholm'}})
+    return events
+
+
+def record_trace(minutes, interval=10):
+    """Samples the real sources: server info and battery every `interval` s, prices and solar once."""
+    import psutil
+    events = []
+    now = int(time.time())
+    prices = database_script.fetch_electricity_price()
+    if prices and prices is not database_script.UNCHANGED:
+        events.append({'t': now, 'kind': 'prices', 'data': prices})
+    solar = database_script.get_solar_and_temp_forecast(database_script.latitude, database_script.longitude, 72)
+    if solar and solar is not database_script.UNCHANGED:
+        events.append({'t': now, 'kind': 'solar', 'data': solar})
+    deadline = time.time() + minutes * 60
+    while time.time() < deadline:
+        now = int(time.time())
+        events.append({'t': now, 'kind': 'server_info', 'data': database_script.fetch_server_info()})
+        battery = psutil.sensors_battery()
+        if battery is not None:
+            events.append({'t': now, 'kind': 'battery',
+                           'data': {'percent': battery.percent, 'is_charging': battery.power_plugged}})
+        time.sleep(interval)
+    return events
+
+
+# --- Replay ---
+def replay(events, args):
+    """Runs the trace through the collector and the controller; returns the report dict."""
+    if not events:
+        raise ValueError("Empty trace")
+    clock = SimClock(events[0]['t'])
+    battery = SimulatedBattery(clock, args.start_level, args.charge_rate, args.discharge_rate)
+    controller = BatteryController(
+        battery.read, battery.switch, LOW_BATTERY_THRESHOLD, HIGH_BATTERY_THRESHOLD, ENERGY_PER_CHARGE_CYCLE_WH,
+        BATTERY_MIN_CHECK_INTERVAL_SECONDS, BATTERY_MAX_CHECK_INTERVAL_SECONDS,
+        plan_provider=charge_planner.get_charge_plan if args.plan else None, clock=clock)
+
+    counts = {kind: 0 for kind in KINDS}
+    ingest_seconds = {kind: 0.0 for kind in KINDS}
+    checks = 0
+    queue = [(event['t'], i, 'event', event) for i, event in enumerate(events)]
+    start, end = events[0]['t'], events[-1]['t']
+    queue.append((start, -3, 'check', None))
+    queue.append((start + database_script.RETENTION_INTERVAL_SECONDS, -2, 'retention', None))
+    queue.append((start, -1, 'plan', None))
+    heapq.heapify(queue)
+    sequence = len(events)
+    wall_started = time.perf_counter()
+
+    def plan():
+        if args.plan:
+            charge_planner.update_charge_plan(args.mode, now=clock.now, level=battery.read()['percent'])
+
+    while queue:
+        t, _, action, event = heapq.heappop(queue)
+        if t > end:
+            break
+        if args.speed:
+            delay = (t - clock.now) / args.speed
+            if delay > 0:
+                time.sleep(delay)
+        clock.now = t
+        sequence += 1
+        if action == 'event':
+            kind, data = event['kind'], event['data']
+            started = time.perf_counter()
+            if kind == 'server_info':
+                database_script.store_server_data(data, now=t)
+            elif kind == 'battery':
+                battery.observe(data['percent'], data['is_charging'])
+            elif kind == 'prices':
+                database_script.store_electricity_data(data, now=datetime.fromtimestamp(t))
+            elif kind == 'solar':
+                database_script.store_solar_data(data, now=datetime.fromtimestamp(t))
+            ingest_seconds[kind] += time.perf_counter() - started
+            counts[kind] += 1
+            if kind in ('prices', 'solar'):
+                plan()
+        elif action == 'check':
+            checks += 1
+            heapq.heappush(queue, (t + controller.check(), sequence, 'check', None))
+        elif action == 'retention':
+            history.apply_retention(t)
+            heapq.heappush(queue, (t + database_script.RETENTION_INTERVAL_SECONDS, sequence, 'retention', None))
+        elif action == 'plan':
+            plan()
+            heapq.heappush(queue, (t + database_script.CHARGE_PLAN_INTERVAL_SECONDS, sequence, 'plan', None))
+
+    wall = time.perf_counter() - wall_started
+    cycles = db.query_one('SELECT COUNT(*), COALESCE(SUM(energy_wh), 0) FROM charge_cycles')
+    return {
+        'simulated_seconds': end - start, 'wall_seconds': round(wall, 3),
+        'speedup': round((end - start) / wall) if wall else None,
+        'events': counts,
+        'ingest_per_second': {kind: round(counts[kind] / ingest_seconds[kind]) for kind in KINDS if ingest_seconds[kind]},
+        'controller': {'checks': checks, 'mean_check_interval': round((end - start) / checks, 1) if checks else None,
+                       'plug_switches': battery.switches, 'charge_cycles': cycles[0], 'energy_wh': round(cycles[1], 2),
+                       'final_level': round(battery.level, 1)},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+    synthetic = commands.add_parser('synthetic', help='generate a synthetic trace')
+    synthetic.add_argument('--days', type=float, default=7)
+    synthetic.add_argument('--interval', type=int, default=10)
+    synthetic.add_argument('trace')
+    export = commands.add_parser('export', help='build a trace from a database')
+    export.add_argument('--db', default=db.DATABASE_NAME)
+    export.add_argument('trace')
+    record = commands.add_parser('record', help='sample the real sources into a trace')
+    record.add_argument('--minutes', type=float, default=10)
+    record.add_argument('--interval', type=int, default=10)
+    record.add_argument('trace')
+    run = commands.add_parser('run', help='replay a trace')
+    run.add_argument('trace')
+    run.add_argument('--db', help='database to replay into (default: a scratch database)')
+    run.add_argument('--speed', type=float, default=0, help='simulated seconds per wall second, 0 = as fast as possible')
+    run.add_argument('--no-plan', dest='plan', action='store_false', help='thresholds only, no charge planner')
+    run.add_argument('--mode', choices=charge_planner.PLAN_MODES, default='cost')
+    run.add_argument('--start-level', type=float, default=60)
+    run.add_argument('--charge-rate', type=float, default=charge_planner.DEFAULT_CHARGE_RATE_PERCENT_PER_HOUR)
+    run.add_argument('--discharge-rate', type=float, default=charge_planner.DEFAULT_DISCHARGE_RATE_PERCENT_PER_HOUR)
+    run.add_argument('--verbose', action='store_true', help='show collector and controller output')
+    args = parser.parse_args()
+
+    if args.command == 'synthetic':
+        print(f"Wrote {write_trace(args.trace, synthetic_trace(args.days, args.interval))} events to {args.trace}")
+    elif args.command == 'export':
+        print(f"Wrote {write_trace(args.trace, export_trace(args.db))} events to {args.trace}")
+    elif args.command == 'record':
+        print(f"Wrote {write_trace(args.trace, record_trace(args.minutes, args.interval))} events to {args.trace}")
+    else:
+        events = read_trace(args.trace)
+        with tempfile.TemporaryDirectory() as tmp:
+            db.DATABASE_NAME = args.db or os.path.join(tmp, 'replay.db')
+            if args.verbose:
+                structured_log.configure('replay', level='DEBUG', console_level='DEBUG', log_file=False)
+            else:
+                logging.getLogger().addHandler(logging.NullHandler())  # Keeps collector and controller logs quiet
+            database_script.init_database()
+            report = replay(events, args)
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
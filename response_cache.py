@@ -0,0 +1,129 @@
+import gzip
+import hashlib
+import json
+import threading
+
+try:
+    import brotli
+except ImportError:  # Optional; gzip is always available
+    brotli = None
+
+from cache import CACHES
+
+# --- Response Compression ---
+COMPRESS_MIN_BYTES = 1024  # Smaller bodies aren't worth the CPU or the header overhead
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5  # Close to gzip's speed at a noticeably better ratio for JSON
+COMPRESSIBLE_TYPES = ('application/json', 'text/html', 'text/css', 'application/javascript', 'image/svg+xml')
+
+
+def compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def choose_encoding(accept_encoding, size):
+    """Best encoding the client accepts for a body of `size` bytes, or None to send it as is."""
+    if size < COMPRESS_MIN_BYTES or not accept_encoding:
+        return None
+    accepted = set()
+    for part in accept_encoding.split(','):
+        name, _, params = part.strip().partition(';')
+        if params.strip().replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            accepted.add(name.strip().lower())
+    if brotli is not None and 'br' in accepted:
+        return 'br'
+    if 'gzip' in accepted or '*' in accepted:
+        return 'gzip'
+    return None
+
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    # Compare weakly: proxies may turn "x" into W/"x" when they re-encode.
+    candidates = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+    return etag.removeprefix('W/') in candidates
+
+
+class Payload:
+    """A serialized response body with its ETag and lazily built compressed variants."""
+
+    def __init__(self, body, etag, content_type='application/json'):
+        self.body = body
+        self.etag = etag
+        self.content_type = content_type
+        self._encoded = {}
+        self._lock = threading.Lock()
+
+    def encoded(self, encoding):
+        with self._lock:
+            if encoding not in self._encoded:
+                self._encoded[encoding] = compress(self.body, encoding)
+            return self._encoded[encoding]
+
+    def respond(self, if_none_match=None, accept_encoding=None):
+        """(status, headers, body) for a GET with these request headers: 304 when the client's copy
+        is current, else the body, compressed when the client accepts it and it is large enough."""
+        headers = {'ETag': self.etag, 'Cache-Control': 'no-cache', 'Vary': 'Accept-Encoding'}
+        if etag_matches(if_none_match, self.etag):
+            return 304, headers, b''
+        encoding = choose_encoding(accept_encoding, len(self.body))
+        body = self.body
+        if encoding:
+            body = self.encoded(encoding)
+            headers['Content-Encoding'] = encoding
+        headers['Content-Type'] = self.content_type
+        return 200, headers, body
+
+
+class VersionedJSONCache:
+    """Serialized JSON of a table-backed endpoint, rebuilt only when the table's version changes.
+
+    `version()` must be cheap (one indexed read, e.g. the table's change generation); `load()`
+    returns the data to serialize, or a falsy value when there is none, which is not cached.
+    A request then costs the version read plus, at most, a compression of a new version; the
+    ETag is derived from the version, so a 304 never touches the table.
+    """
+
+    def __init__(self, name, version, load):
+        self.name = name
+        self.version = version
+        self.load = load
+        self._payload = None
+        self._payload_version = None
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "rebuilds": 0}
+        CACHES[name] = self
+
+    def get(self):
+        """The current Payload, or None when load() found no data."""
+        version = self.version()
+        with self._lock:
+            if self._payload is not None and self._payload_version == version:
+                self._stats["hits"] += 1
+                return self._payload
+        data = self.load()
+        if not data:
+            return None
+        body = json.dumps(data, separators=(',', ':')).encode()
+        # Unversioned payloads are tagged by content, so a 304 is still only sent for identical data.
+        tag = hashlib.sha256(f"{self.name}:{version}".encode() if version is not None else body).hexdigest()[:16]
+        payload = Payload(body, f'"{tag}"')
+        with self._lock:
+            if version is not None:  # No version (table not migrated yet) means never cached
+                self._payload, self._payload_version = payload, version
+            self._stats["rebuilds"] += 1
+        return payload
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["version"] = self._payload_version
+            stats["size"] = len(self._payload.body) if self._payload else 0
+        lookups = stats["hits"] + stats["rebuilds"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 3) if lookups else None
+        return stats
@@ -0,0 +1,204 @@
+import functools
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+
+# --- Shared Sample Ring ---
+# The collector appends every server sample to a fixed-size ring of packed records in a
+# memory-mapped file; the web server maps the same file and reads the newest samples straight
+# from shared memory instead of querying SQLite. SQLite still receives every sample, in batches,
+# for history and rollups. A sample's sequence number is also its server_data id, so ids (and the
+# `last_id` of live clients) are the same whichever store answers.
+RING_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None  # tmpfs: the ring never touches the SD card
+RING_CAPACITY = 4096  # Samples kept: about 11 hours at 10 s
+RING_STALE_SECONDS = 60  # Readers fall back to SQLite when the collector hasn't appended for this long
+READER_RETRY_SECONDS = 5  # How often a reader looks for a ring that is missing or stale
+
+MAGIC = b'LSRING01'
+HEADER = struct.Struct('<8sIIQd')  # magic, record size, capacity, last sequence number, last append (epoch)
+HEADER_SIZE = 64
+# seq, timestamp, cpu %, memory %, disk %, memory total/available, disk total/used, seq again.
+# The leading copy of the sequence number is zeroed while a slot is rewritten, so a reader can tell
+# a slot that is being overwritten from a complete one.
+RECORD = struct.Struct('<QddddQQQQQ')
+SAMPLE_FIELDS = ('cpu_percent', 'memory_percent', 'disk_percent',
+                 'memory_total', 'memory_available', 'disk_total', 'disk_used')
+
+
+@functools.lru_cache(maxsize=16)
+def ring_path(database):
+    """Ring file of a database: in RING_DIR named after the database's absolute path, else next to it."""
+    if RING_DIR is None:
+        return f"{database}.ring"
+    digest = hashlib.sha256(os.path.abspath(database).encode()).hexdigest()[:16]
+    return os.path.join(RING_DIR, f"localserver-{digest}.ring")
+
+
+@functools.lru_cache(maxsize=RING_CAPACITY)
+def timestamp_text(epoch):
+    """server_data.timestamp format: UTC, seconds. Cached, as every read of the recent samples
+    formats the same ones again."""
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(epoch))
+
+
+class SampleRing:
+    """A memory-mapped ring of server samples with one writer process and any number of readers."""
+
+    def __init__(self, path, capacity=RING_CAPACITY, writable=False):
+        self.path = path
+        self.writable = writable
+        if writable:
+            self._file = self._open_for_writing(path, capacity)
+        else:
+            self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+        magic, record_size, self.capacity, _, _ = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or record_size != RECORD.size or len(self._map) < HEADER_SIZE + self.capacity * RECORD.size:
+            self.close()
+            raise ValueError(f"{path} is not a sample ring of this version")
+        self._inode = os.fstat(self._file.fileno()).st_ino
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _open_for_writing(path, capacity):
+        """Opens an existing compatible ring, or atomically replaces the file with an empty one so
+        readers never map a half-initialized ring."""
+        try:
+            f = open(path, 'r+b')
+            header = f.read(HEADER.size)
+            if len(header) == HEADER.size:
+                magic, record_size, existing, _, _ = HEADER.unpack(header)
+                if magic == MAGIC and record_size == RECORD.size and existing == capacity:
+                    return f
+            f.close()
+        except FileNotFoundError:
+            pass
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.truncate(HEADER_SIZE + capacity * RECORD.size)
+            f.write(HEADER.pack(MAGIC, RECORD.size, capacity, 0, 0.0))
+        os.replace(tmp, path)
+        return open(path, 'r+b')
+
+    def close(self):
+        if getattr(self, '_map', None) is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+    # --- Header ---
+    @property
+    def last_seq(self):
+        return HEADER.unpack_from(self._map, 0)[3]
+
+    @property
+    def updated_at(self):
+        return HEADER.unpack_from(self._map, 0)[4]
+
+    def is_fresh(self, now=None):
+        return (now if now is not None else time.time()) - self.updated_at < RING_STALE_SECONDS
+
+    def replaced(self):
+        """True when the path now holds another file (the writer recreated the ring)."""
+        try:
+            return os.stat(self.path).st_ino != self._inode
+        except FileNotFoundError:
+            return True
+
+    # --- Writer ---
+    def _offset(self, seq):
+        return HEADER_SIZE + (seq % self.capacity) * RECORD.size
+
+    def continue_after(self, seq):
+        """Makes the next sample's sequence number follow `seq` (e.g. SQLite's highest id) if the
+        ring is behind it, as after a reboot emptied RING_DIR."""
+        with self._lock:
+            if seq > self.last_seq:
+                struct.pack_into('<Q', self._map, HEADER.size - 16, seq)
+
+    def append(self, sample, now=None):
+        """Stores a fetch_server_info() sample and returns its sequence number."""
+        now = now if now is not None else time.time()
+        with self._lock:
+            seq = self.last_seq + 1
+            offset = self._offset(seq)
+            self._map[offset:offset + 8] = bytes(8)
+            RECORD.pack_into(self._map, offset, 0, now, *(sample[field] for field in SAMPLE_FIELDS), seq)
+            self._map[offset:offset + 8] = seq.to_bytes(8, 'little')
+            struct.pack_into('<Qd', self._map, HEADER.size - 16, seq, now)
+        return seq
+
+    # --- Readers ---
+    def _record(self, seq):
+        record = RECORD.unpack_from(self._map, self._offset(seq))
+        return record if record[0] == seq and record[-1] == seq else None
+
+    def latest(self):
+        """(seq, epoch, *SAMPLE_FIELDS) of the newest sample, or None."""
+        seq = self.last_seq
+        return self._record(seq) if seq else None
+
+    def records_after(self, after_seq, limit):
+        """The newest `limit` samples with a sequence number above after_seq, oldest first, and
+        the lowest sequence number the ring still had (older ones must come from SQLite)."""
+        newest = self.last_seq
+        seq = max(after_seq + 1, newest - self.capacity + 1, newest - limit + 1, 1)
+        records = []
+        with memoryview(self._map) as view:
+            while seq <= newest:  # At most two contiguous runs of slots, unpacked in place
+                slot = seq % self.capacity
+                count = min(newest - seq + 1, self.capacity - slot)
+                offset = HEADER_SIZE + slot * RECORD.size
+                records.extend(RECORD.iter_unpack(view[offset:offset + count * RECORD.size]))
+                seq += count
+        # Keep the newest unbroken run: older slots may be overwritten meanwhile or left from
+        # before the ring was reset.
+        expected = newest
+        for index in range(len(records) - 1, -1, -1):
+            if records[index][0] != expected or records[index][-1] != expected:
+                records = records[index + 1:]
+                break
+            expected -= 1
+        return records, newest - len(records) + 1
+
+
+# --- Shared instances ---
+_writers = {}
+_readers = {}  # path -> (SampleRing or None, next retry time)
+_instances_lock = threading.Lock()
+
+
+def writer(database):
+    """The collector's ring for a database, created on first use."""
+    path = ring_path(database)
+    with _instances_lock:
+        if path not in _writers:
+            _writers[path] = SampleRing(path, writable=True)
+        return _writers[path]
+
+
+def reader(database, now=None):
+    """A fresh ring to read the database's newest samples from, or None when the collector isn't
+    writing one; then callers read SQLite. Missing or stale rings are looked for again every
+    READER_RETRY_SECONDS, so a restarted collector is picked up."""
+    path = ring_path(database)
+    now = now if now is not None else time.time()
+    ring, retry_at = _readers.get(path, (None, 0))
+    if ring is not None and ring.is_fresh(now):
+        return ring
+    if now < retry_at:
+        return None
+    with _instances_lock:
+        if ring is not None and ring.replaced():
+            ring.close()
+            ring = None
+        if ring is None:
+            try:
+                ring = SampleRing(path)
+            except (OSError, ValueError):
+                ring = None
+        _readers[path] = (ring, now + READER_RETRY_SECONDS)
+    return ring if ring is not None and ring.is_fresh(now) else None
@@ -0,0 +1,158 @@
+import logging
+import random
+import threading
+import time
+from datetime import datetime
+
+import metrics
+
+log = logging.getLogger('scheduler')
+RUN_SECONDS = metrics.histogram('collector_run_duration_seconds', 'Collector cycle durations', ('job', 'outcome'))
+
+
+class Job:
+    """One periodic collector with its own interval, jitter, timeout and failure backoff."""
+
+    def __init__(self, name, func, interval_seconds, jitter_seconds=0, timeout_seconds=None,
+                 max_backoff_seconds=None, next_delay=None, extra_stats=None):
+        self.name = name
+        self.func = func
+        self.interval_seconds = interval_seconds
+        self.jitter_seconds = jitter_seconds
+        self.timeout_seconds = timeout_seconds
+        self.max_backoff_seconds = max_backoff_seconds or interval_seconds * 8
+        self.next_delay = next_delay  # Optional callable returning seconds until the next run
+        self.extra_stats = extra_stats  # Optional callable returning collector-specific counters
+        self.consecutive_failures = 0
+        self.next_run = None  # time.monotonic() of the next planned run
+        self.stats = {"runs": 0, "failures": 0, "timeouts": 0, "skipped_overlaps": 0,
+                      "last_run": None, "last_success": None, "last_error": None,
+                      "last_duration": None, "max_duration": None, "total_duration": 0.0}
+        self.in_flight = None  # Thread of a run that outlived its timeout
+
+    def delay_after(self, succeeded):
+        """Seconds until the next run: the schedule on success, exponential backoff on failure."""
+        if not succeeded and self.consecutive_failures:
+            delay = min(self.interval_seconds * 2 ** (self.consecutive_failures - 1), self.max_backoff_seconds)
+        elif self.next_delay is not None:
+            delay = self.next_delay()
+        else:
+            delay = self.interval_seconds
+        return delay + random.uniform(0, self.jitter_seconds)
+
+    def snapshot(self):
+        stats = dict(self.stats)
+        stats["total_duration"] = round(stats["total_duration"], 4)
+        stats["interval_seconds"] = self.interval_seconds
+        stats["consecutive_failures"] = self.consecutive_failures
+        stats["avg_duration"] = round(self.stats["total_duration"] / stats["runs"], 4) if stats["runs"] else None
+        stats["next_run_in"] = round(self.next_run - time.monotonic(), 1) if self.next_run is not None else None
+        if self.extra_stats is not None:
+            stats.update(self.extra_stats())
+        return stats
+
+
+class Scheduler:
+    """Runs every Job on its own thread so a slow or failing collector never delays the others.
+
+    Runs are anchored to the schedule rather than to the end of the previous run, so a slow run
+    does not make the loop drift. A run that exceeds its timeout is counted as a failure and the
+    next run is skipped while it is still in flight, instead of piling up threads.
+    """
+
+    def __init__(self, on_run=None):
+        self.jobs = {}
+        self.on_run = on_run  # Optional callback(job) after every run, e.g. to persist stats
+        self._stop = threading.Event()
+        self._threads = []
+
+    def add(self, name, func, interval_seconds, **kwargs):
+        self.jobs[name] = Job(name, func, interval_seconds, **kwargs)
+        return self.jobs[name]
+
+    def start(self):
+        for job in self.jobs.values():
+            thread = threading.Thread(target=self._job_loop, args=(job,), name=f"collector-{job.name}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=5):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def run_forever(self):
+        self.start()
+        try:
+            while not self._stop.wait(1):
+                pass
+        finally:
+            self.stop()
+
+    def stats(self):
+        return {name: job.snapshot() for name, job in self.jobs.items()}
+
+    def _job_loop(self, job):
+        job.next_run = time.monotonic()
+        while not self._stop.is_set():
+            wait = job.next_run - time.monotonic()
+            if wait > 0 and self._stop.wait(wait):
+                return
+            scheduled = job.next_run
+            succeeded = self._run_once(job)
+            next_run = scheduled + job.delay_after(succeeded)
+            # Skip, rather than replay, runs missed while this one was slow.
+            job.next_run = max(next_run, time.monotonic())
+            if self.on_run is not None:
+                try:
+                    self.on_run(job)
+                except Exception as e:
+                    log.warning("Could not record stats for collector '%s': %s", job.name, e)
+
+    def _run_once(self, job):
+        if job.in_flight is not None and job.in_flight.is_alive():
+            job.stats["skipped_overlaps"] += 1
+            return False
+        outcome = {}
+
+        def target():
+            try:
+                job.func()
+                outcome["ok"] = True
+            except Exception as e:
+                outcome["error"] = e
+
+        started = time.monotonic()
+        job.stats["last_run"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        thread = threading.Thread(target=target, name=f"collector-{job.name}-run", daemon=True)
+        thread.start()
+        thread.join(job.timeout_seconds)
+        duration = time.monotonic() - started
+
+        job.stats["runs"] += 1
+        job.stats["last_duration"] = round(duration, 4)
+        job.stats["max_duration"] = round(max(duration, job.stats["max_duration"] or 0), 4)
+        job.stats["total_duration"] += duration
+        if thread.is_alive():
+            job.in_flight = thread
+            job.stats["timeouts"] += 1
+            error = f"timed out after {job.timeout_seconds}s"
+            RUN_SECONDS.labels(job.name, "timeout").observe(duration)
+        elif outcome.get("ok"):
+            job.in_flight = None
+            error = None
+            RUN_SECONDS.labels(job.name, "ok").observe(duration)
+        else:
+            job.in_flight = None
+            error = str(outcome.get("error"))
+            RUN_SECONDS.labels(job.name, "failed").observe(duration)
+
+        if error is None:
+            job.consecutive_failures = 0
+            job.stats["last_success"] = job.stats["last_run"]
+        else:
+            job.consecutive_failures += 1
+            job.stats["failures"] += 1
+            job.stats["last_error"] = error
+            log.warning("Collector '%s' failed (%d in a row): %s", job.name, job.consecutive_failures, error)
+        return error is None
@@ -0,0 +1,251 @@
+import ast
+import atexit
+import json
+import logging
+import os
+import socket
+import tempfile
+import threading
+import time
+
+from process_lock import ProcessLock
+
+log = logging.getLogger('settings')
+
+# --- Settings Store Configuration ---
+SETTINGS_FILE = 'settings.json'
+LEGACY_CONSTANTS_FILE = 'dynamic_constants.py'  # Only read once, to seed SETTINGS_FILE
+DEFAULT_SETTINGS = {'current_temperature': 20}
+WRITE_BEHIND_SECONDS = 0.5  # Writes within this window are persisted together
+NOTIFY_ADDRESS = ('127.0.0.1', 47631)  # UDP address the collector listens on for changes
+
+
+def read_legacy_constants(path=LEGACY_CONSTANTS_FILE):
+    """Values of the old hot-reloaded constants module, parsed without executing it."""
+    try:
+        with open(path) as f:
+            tree = ast.parse(f.read())
+    except (OSError, SyntaxError):
+        return {}
+    values = {}
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name):
+            try:
+                values[node.targets[0].id] = ast.literal_eval(node.value)
+            except ValueError:
+                pass
+    return values
+
+
+def write_atomically(path, values):
+    """Writes JSON to a temporary file next to path and renames it over path, so readers only
+    ever see the old or the new file, never a partial one."""
+    fd, tmp_path = tempfile.mkstemp(prefix='.settings-', suffix='.tmp', dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(values, f, indent=2, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+class SettingsStore:
+    """Settings served from memory and persisted with write-behind.
+
+    set() updates the in-memory values under a lock and returns; a writer thread persists them
+    atomically shortly after, coalescing bursts of writes, and then announces the new values in
+    one UDP datagram on localhost. A process that called listen() applies that datagram to its
+    own store, so the collector sees changes without polling the file. Every other process (e.g.
+    each web server worker) notices the file was rewritten from its modification time on the next
+    read. A flush merges only this process's changed settings into the file's current contents,
+    under a file lock, so workers writing different settings don't undo each other's changes.
+    """
+
+    def __init__(self, path=SETTINGS_FILE, notify_address=NOTIFY_ADDRESS):
+        self.path = path
+        self.notify_address = notify_address
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._dirty = threading.Event()
+        self._file_lock = ProcessLock(path + '.lock')
+        self._file_signature = None  # (mtime, size, inode) of the file when last read or written
+        self._pending = {}  # Settings changed here that are not in the file yet
+        self._values = {**DEFAULT_SETTINGS, **self._read()}
+        self._callbacks = []
+        self._writer = None
+        self._listener = None
+
+    def _signature(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def _read(self):
+        self._file_signature = self._signature()
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return read_legacy_constants()
+        except (OSError, ValueError) as e:
+            log.warning("Could not read settings from %s, using defaults: %s", self.path, e)
+            return {}
+
+    def get(self, name, default=None):
+        self.reload_if_changed()
+        with self._lock:
+            return self._values.get(name, default)
+
+    def all(self):
+        self.reload_if_changed()
+        with self._lock:
+            return dict(self._values)
+
+    def reload_if_changed(self):
+        """Applies the file's values if another process rewrote it since this one last read or
+        wrote it; one stat() otherwise. Settings changed here and not persisted yet are kept."""
+        if self._signature() == self._file_signature:
+            return
+        self._apply(self._read())
+
+    def _apply(self, values):
+        with self._lock:
+            changed = {name: value for name, value in values.items()
+                       if name not in self._pending and self._values.get(name) != value}
+            self._values.update(changed)
+        if changed:
+            self._changed(changed)
+
+    def set(self, name, value):
+        self.update({name: value})
+
+    def update(self, values):
+        """Changes several settings at once; persisted and announced by the writer thread."""
+        with self._lock:
+            changed = {name: value for name, value in values.items() if self._values.get(name) != value}
+            if not changed:
+                return
+            self._values.update(changed)
+            self._pending.update(changed)
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_behind, name="settings-writer", daemon=True)
+                self._writer.start()
+                atexit.register(self.flush)
+        self._dirty.set()
+        self._changed(changed)
+
+    def on_change(self, callback):
+        """Registers callback(changed_values), called after local and remote changes."""
+        self._callbacks.append(callback)
+
+    def flush(self):
+        """Merges the settings changed here into the file now and notifies listening processes."""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return True
+            try:
+                self._file_lock.acquire(blocking=True)
+                try:
+                    # Re-read under the lock: other processes' changes since our last read are kept.
+                    values = {**DEFAULT_SETTINGS, **self._read(), **pending}
+                    write_atomically(self.path, values)
+                    self._file_signature = self._signature()
+                finally:
+                    self._file_lock.release()
+            except OSError as e:
+                log.error("Could not persist settings to %s: %s", self.path, e)
+                with self._lock:
+                    self._pending = {**pending, **self._pending}  # Retried by the next flush
+                return False
+            self._apply(values)
+            self._notify(values)
+            return True
+
+    def flush_pending(self):
+        """Flushes only if a write-behind is still waiting, e.g. on shutdown."""
+        if not self._dirty.is_set():
+            return True
+        self._dirty.clear()
+        return self.flush()
+
+    def listen(self):
+        """Starts applying changes announced by other processes. Returns False if another process
+        on this machine is already listening."""
+        if self._listener is not None:
+            return True
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.bind(self.notify_address)
+        except OSError as e:
+            sock.close()
+            log.warning("Settings change notifications unavailable on %s: %s", self.notify_address, e)
+            return False
+        self._listener = threading.Thread(target=self._receive, args=(sock,), name="settings-listener", daemon=True)
+        self._listener.start()
+        return True
+
+    def _write_behind(self):
+        while True:
+            self._dirty.wait()
+            time.sleep(WRITE_BEHIND_SECONDS)
+            self._dirty.clear()  # Cleared before the snapshot, so a later set() triggers another flush
+            self.flush()
+
+    def _notify(self, values):
+        message = json.dumps({'pid': os.getpid(), 'settings': values}).encode()
+        try:
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+                sock.sendto(message, self.notify_address)
+        except OSError:
+            pass  # Nobody listening is fine; the file is the source of truth on startup
+
+    def _receive(self, sock):
+        while True:
+            try:
+                message = json.loads(sock.recv(65536))
+            except (OSError, ValueError) as e:
+                log.warning("Ignoring malformed settings notification: %s", e)
+                continue
+            if message.get('pid') == os.getpid():
+                continue
+            self._file_signature = self._signature()  # The announced values are the file's
+            self._apply(message.get('settings', {}))
+
+    def _changed(self, changed):
+        for callback in self._callbacks:
+            try:
+                callback(changed)
+            except Exception as e:
+                log.warning("Settings change callback failed: %s", e)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """Returns the process-wide settings store, loading it on first use."""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = SettingsStore()
+    return _store
+
+
+def get(name, default=None):
+    return get_store().get(name, default)
+
+
+def set_value(name, value):
+    get_store().set(name, value)
@@ -0,0 +1,303 @@
+"""Registry of the Shelly plugs and relays, polled concurrently into one cached fleet snapshot.
+
+Devices come from SHELLY_DEVICES_FILE, a JSON list such as
+
+    [{"name": "heater", "host": "192.168.1.31", "relays": [0, 1], "timeout": 1.5}]
+
+plus the charger plug from key.py, which the battery controller switches. Each device is its own
+provider ("shelly-<name>"), so fixtures, the stub server and the upstream metrics tell them apart.
+
+Readers get the last snapshot without touching the network; when it is older than
+SNAPSHOT_TTL_SECONDS one background poll refreshes every device at once. A device that fails
+BREAKER_FAILURES polls or commands in a row is skipped for BREAKER_RESET_SECONDS (its last known
+state is kept and marked offline), so one unplugged plug doesn't slow down every poll.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import requests
+
+import http_client
+import metrics
+import providers
+
+log = logging.getLogger('shelly_fleet')
+
+# --- Fleet Configuration ---
+SHELLY_DEVICES_FILE = os.environ.get('SHELLY_DEVICES_FILE', 'shelly_devices.json')
+CHARGER_DEVICE = 'charger'  # The plug from key.py, switched by the battery controller
+DEVICE_TIMEOUT_SECONDS = 2  # Per device, unless its entry sets "timeout"; plugs answer in milliseconds on the LAN
+FLEET_WORKERS = 8  # Devices polled or commanded at the same time
+SNAPSHOT_TTL_SECONDS = 15  # Age at which a read triggers a background poll
+BREAKER_FAILURES = 3  # Consecutive failures that open a device's circuit
+BREAKER_RESET_SECONDS = 60  # How long an open circuit skips the device before one trial call
+
+
+class CircuitBreaker:
+    """closed: calls go through. open: calls are refused for reset_seconds after `failures`
+    consecutive failures. half-open: one trial call is let through; its outcome closes or
+    re-opens the circuit."""
+
+    def __init__(self, name, failures=BREAKER_FAILURES, reset_seconds=BREAKER_RESET_SECONDS, clock=time.monotonic):
+        self.name = name
+        self.failures = failures
+        self.reset_seconds = reset_seconds
+        self.clock = clock
+        self.state = 'closed'
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and self.clock() - self.opened_at >= self.reset_seconds:
+                self.state = 'half-open'
+                return True
+            return False  # Open, or half-open with the trial call still running
+
+    def record(self, ok):
+        with self._lock:
+            if ok:
+                self.state, self.consecutive_failures, self.opened_at = 'closed', 0, None
+                return
+            self.consecutive_failures += 1
+            if self.state == 'half-open' or self.consecutive_failures >= self.failures:
+                if self.state != 'open':
+                    log.warning("Shelly '%s' circuit opened after %d failures, retrying in %ss.",
+                                self.name, self.consecutive_failures, self.reset_seconds)
+                self.state, self.opened_at = 'open', self.clock()
+
+
+class ShellyDevice:
+    """One Shelly (Gen1 HTTP API) with its relays, its circuit breaker and its last known state."""
+
+    def __init__(self, name, host, relays=(0,), timeout=DEVICE_TIMEOUT_SECONDS):
+        self.name = name
+        self.host = host
+        self.relays = tuple(relays)
+        self.timeout = timeout
+        self.provider = f"shelly-{name}"
+        self.breaker = CircuitBreaker(name)
+        self.state = {"online": None, "relays": {str(relay): None for relay in self.relays}, "power": None,
+                      "updated_at": None, "error": None}
+        providers.register(self.provider, f"http://{host}")
+
+    def get(self, session, path):
+        response = http_client.get(providers.url(self.provider, path), timeout=self.timeout, session=session)
+        response.raise_for_status()
+        return response.json()
+
+
+def parse_status(device, data):
+    """Gen1 /status response -> relay states and meter power of the device's relays."""
+    relays = data.get("relays") or []
+    meters = data.get("meters") or []
+    return {
+        "relays": {str(relay): relays[relay].get("ison") if relay < len(relays) else None for relay in device.relays},
+        "power": [meter.get("power") for meter in meters] or None,
+    }
+
+
+def read_devices(path, charger_host=None):
+    """Devices listed in the JSON file at `path` (missing file: none), plus the charger plug at
+    charger_host unless the file defines it."""
+    try:
+        with open(path) as f:
+            entries = json.load(f)
+    except FileNotFoundError:
+        entries = []
+    devices = [ShellyDevice(entry["name"], entry["host"], entry.get("relays", (0,)),
+                            entry.get("timeout", DEVICE_TIMEOUT_SECONDS)) for entry in entries]
+    if charger_host and all(device.name != CHARGER_DEVICE for device in devices):
+        devices.insert(0, ShellyDevice(CHARGER_DEVICE, charger_host))
+    return devices
+
+
+class ShellyFleet:
+    """The registered devices, their cached snapshot and batched relay commands."""
+
+    def __init__(self, devices, snapshot_ttl_seconds=SNAPSHOT_TTL_SECONDS, workers=FLEET_WORKERS):
+        self.devices = {device.name: device for device in devices}
+        self.snapshot_ttl_seconds = snapshot_ttl_seconds
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="shelly")
+        # Breakers replace retries: a failed call is retried by the next poll, not within this one.
+        self._session = http_client.create_session(retries=0)
+        self._lock = threading.Lock()
+        self._poll_lock = threading.Lock()
+        self._polled_at = None
+        self._refreshing = False
+        self._snapshot = self._build_snapshot()
+        self._stats = {"polls": 0, "skipped": 0, "failures": 0, "commands": 0}
+
+    # --- Snapshot ---
+    def _build_snapshot(self):
+        devices = {name: {**device.state, "relays": dict(device.state["relays"]), "breaker": device.breaker.state}
+                   for name, device in self.devices.items()}
+        return {"devices": devices, "online": sum(1 for d in devices.values() if d["online"]),
+                "total": len(devices), "updated_at": time.time()}
+
+    def snapshot(self):
+        """The fleet's last known state. Polls synchronously only the first time; afterwards an
+        expired snapshot is returned as is while a background poll refreshes it."""
+        if self._polled_at is None:
+            with self._poll_lock:
+                if self._polled_at is None:
+                    self._poll()
+        with self._lock:
+            if time.monotonic() - self._polled_at >= self.snapshot_ttl_seconds and not self._refreshing:
+                self._refreshing = True
+                threading.Thread(target=self._refresh, name="shelly-refresh", daemon=True).start()
+            return self._snapshot
+
+    def _refresh(self):
+        try:
+            self.poll()
+        finally:
+            self._refreshing = False
+
+    def relay_status(self, device=CHARGER_DEVICE, relay=0):
+        """{"ison", "success"} of one relay from the snapshot, the shape of the single-plug API."""
+        state = self.snapshot()["devices"].get(device)
+        if state is None:
+            return {"ison": None, "success": False, "error": f"Unknown Shelly device '{device}'"}
+        ison = state["relays"].get(str(relay))
+        if not state["online"]:
+            return {"ison": ison, "success": False, "error": state["error"] or "Device offline"}
+        return {"ison": ison, "success": True}
+
+    # --- Polling ---
+    def poll(self):
+        """Fetches every device's status concurrently and returns the new snapshot."""
+        with self._poll_lock:
+            return self._poll()
+
+    def _poll(self):
+        self._run({name: [("status", None)] for name in self.devices})
+        with self._lock:
+            self._polled_at = time.monotonic()
+            self._stats["polls"] += 1
+            self._snapshot = self._build_snapshot()
+            return self._snapshot
+
+    # --- Commands ---
+    def command(self, commands):
+        """Switches relays in one batch: `commands` is a list of (device, relay, turn_on). Devices
+        are commanded concurrently, each device's relays in order; the snapshot takes the states the
+        devices report back. Returns one {"device", "relay", "success", ...} result per command."""
+        batches = {}
+        results = []
+        for device, relay, turn_on in commands:
+            if device not in self.devices:
+                results.append({"device": device, "relay": relay, "success": False,
+                                "error": f"Unknown Shelly device '{device}'"})
+            elif relay not in self.devices[device].relays:
+                results.append({"device": device, "relay": relay, "success": False,
+                                "error": f"Device '{device}' has no relay {relay}"})
+            else:
+                batches.setdefault(device, []).append(("relay", (relay, turn_on)))
+        for name, outcomes in self._run(batches).items():
+            results.extend(outcomes)
+        with self._lock:
+            self._stats["commands"] += sum(len(batch) for batch in batches.values())
+            self._snapshot = self._build_snapshot()
+        return results
+
+    def set_relay(self, turn_on, device=CHARGER_DEVICE, relay=0):
+        """One relay, the shape of the single-plug API: {"success", ["error"]}."""
+        result = self.command([(device, relay, turn_on)])[0]
+        return {"success": True} if result["success"] else {"success": False, "error": result["error"]}
+
+    # --- Calls ---
+    def _run(self, batches):
+        """Runs {device: [(kind, args)]} with one task per device and waits at most for the
+        slowest device's timeout; a device still busy then counts as failed."""
+        futures = {}
+        outcomes = {}
+        for name, calls in batches.items():
+            device = self.devices[name]
+            if not device.breaker.allow():
+                with self._lock:
+                    self._stats["skipped"] += 1
+                    device.state = {**device.state, "online": False}
+                outcomes[name] = [self._outcome(device, kind, args, False, "Circuit open") for kind, args in calls]
+                continue
+            futures[name] = self._executor.submit(self._call_device, device, calls)
+        if futures:
+            # requests' timeout applies per socket operation; bound the whole call as well.
+            deadline = 2 * max(self.devices[name].timeout for name in futures) + 1
+            wait(futures.values(), timeout=deadline)
+        for name, future in futures.items():
+            if future.done():
+                outcomes[name] = future.result()
+            else:
+                device = self.devices[name]
+                self._record(device, False, "Timed out")
+                outcomes[name] = [self._outcome(device, kind, args, False, "Timed out") for kind, args in batches[name]]
+        return outcomes
+
+    def _call_device(self, device, calls):
+        outcomes = []
+        for kind, args in calls:
+            try:
+                if kind == "status":
+                    update = parse_status(device, device.get(self._session, "/status"))
+                else:
+                    relay, turn_on = args
+                    data = device.get(self._session, f"/relay/{relay}?turn={'on' if turn_on else 'off'}")
+                    update = {"relays": {**device.state["relays"], str(relay): data.get("ison")}}
+            except (requests.exceptions.RequestException, ValueError) as e:
+                log.warning("Shelly '%s' %s failed: %s", device.name, kind, e)
+                self._record(device, False, str(e))
+                outcomes.append(self._outcome(device, kind, args, False, str(e)))
+                continue
+            self._record(device, True, None, update)
+            outcomes.append(self._outcome(device, kind, args, True, None))
+        return outcomes
+
+    def _record(self, device, ok, error, update=None):
+        device.breaker.record(ok)
+        with self._lock:
+            if not ok:
+                self._stats["failures"] += 1
+            device.state = {**device.state, **(update or {}), "online": ok, "error": error,
+                            "updated_at": time.time() if ok else device.state["updated_at"]}
+
+    @staticmethod
+    def _outcome(device, kind, args, ok, error):
+        outcome = {"device": device.name, "success": ok}
+        if kind == "relay":
+            outcome["relay"] = args[0]
+            outcome["ison"] = device.state["relays"].get(str(args[0])) if ok else None
+        if error:
+            outcome["error"] = error
+        return outcome
+
+    # --- Stats ---
+    def stats(self):
+        with self._lock:
+            return {**self._stats, "devices": len(self.devices),
+                    "open_circuits": [name for name, device in self.devices.items() if device.breaker.state != 'closed']}
+
+    def metric_families(self):
+        with self._lock:
+            devices = list(self.devices.values())
+        return [
+            ('shelly_device_up', 'gauge', 'Whether the last call to the Shelly device succeeded',
+             [({'device': device.name}, 1 if device.state["online"] else 0) for device in devices]),
+            ('shelly_circuit_open', 'gauge', 'Whether calls to the Shelly device are skipped by its circuit breaker',
+             [({'device': device.name}, 0 if device.breaker.state == 'closed' else 1) for device in devices]),
+        ]
+
+
+def load_fleet(charger_host, path=SHELLY_DEVICES_FILE):
+    """The fleet of the devices file plus the charger, with its metrics registered."""
+    fleet = ShellyFleet(read_devices(path, charger_host))
+    metrics.add_collector(fleet.metric_families)
+    log.info("Shelly fleet: %s", ", ".join(f"{d.name} ({d.host}, relays {list(d.relays)})" for d in fleet.devices.values()))
+    return fleet
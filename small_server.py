@@ -1,4 +1,5 @@
-from flask import Flask, request, redirect, url_for, render_template, jsonify
+from flask import Flask, Response, request, redirect, url_for, render_template, jsonify, g
+import logging
 import os
 import time
 import threading
@@ -7,9 +8,29 @@ from datetime import *
 # --- Configuration for Battery Control ---
 LOW_BATTERY_THRESHOLD = 35
 HIGH_BATTERY_THRESHOLD = 80
-BATTERY_CHECK_INTERVAL_SECONDS = 30  # Check battery status every 2 seconds
+BATTERY_MIN_CHECK_INTERVAL_SECONDS = 10  # Near the threshold the battery is moving towards
+BATTERY_MAX_CHECK_INTERVAL_SECONDS = 300  # Far from both thresholds
+BATTERY_THRESHOLD_MARGIN_PERCENT = 3  # "Near" a threshold means within this many percent
 AUTOMATIC_CHARGING_ENABLED = True  # Enable/disable automatic charging control
 
+# --- Dashboard Source Deadlines (seconds) ---
+# Sources are fetched concurrently; one that misses its deadline is rendered as stale/unavailable.
+HTTP_SOURCE_DEADLINE_SECONDS = 2.0
+DB_SOURCE_DEADLINE_SECONDS = 1.0
+BATTERY_SOURCE_DEADLINE_SECONDS = 0.5
+
+# --- Live Updates (Server-Sent Events) ---
+LIVE_SERVER_DATA_INTERVAL_SECONDS = 2  # Checks for new collector rows; one cheap rowid query for all tabs
+LIVE_PLUG_INTERVAL_SECONDS = 5  # Served from the Shelly cache, so upstream calls stay at its TTL
+LIVE_BATTERY_INTERVAL_SECONDS = 10
+
+# --- Background Services ---
+# Under a multi-worker server every worker imports this module; the worker holding this lock runs
+# the battery controller, the others stand by and take over if it exits.
+BACKGROUND_LOCK_FILE = 'background_services.lock'
+BACKGROUND_LOCK_RETRY_SECONDS = 30  # How often a standby worker tries to take the lock
+SHUTDOWN_TIMEOUT_SECONDS = 10  # Wait for a battery check in progress before exiting
+
 # --- Charger Information ---
 ENERGY_PER_CHARGE_CYCLE_WH = 27.47  # Measured energy per full charge cycle 35-80
 
@@ -20,60 +41,88 @@ fernet = Fernet(ENCRYPTION_KEY)
 
 # --- Helper Functions for Dynamic Constants, assume that all non defined methods comes from here
 from helper_server import *
+from live_updates import LiveHub, ServerDataCursor
+from battery_controller import BatteryController
+from process_lock import ProcessLock
+from response_cache import COMPRESSIBLE_TYPES, choose_encoding, compress
+import charge_planner
+import history
+import http_client
+import metrics
+import settings
+import solar_model
+import structured_log
+
+log = logging.getLogger('small_server')
+REQUEST_SECONDS = metrics.histogram('http_request_duration_seconds', 'Web server requests by route',
+                                    ('route', 'method', 'status'))
 
 app = Flask(__name__)
 app.secret_key = os.urandom(24)  # Replace with a persistent key for production
 logged_in = False  # For demo purposes only
 app.start_time = time.time()  # Start time for uptime
-last_plug_state = None  # Track the last commanded state of the plug
-charging_start_time = None
-total_energy_charged_wh = 0  # To accumulate energy over charging cycles
-last_battery_percent = None
-last_check_time = None
+battery_controller = BatteryController(
+    get_battery_status, toggle_shelly_relay, LOW_BATTERY_THRESHOLD, HIGH_BATTERY_THRESHOLD,
+    ENERGY_PER_CHARGE_CYCLE_WH, BATTERY_MIN_CHECK_INTERVAL_SECONDS, BATTERY_MAX_CHECK_INTERVAL_SECONDS,
+    margin_percent=BATTERY_THRESHOLD_MARGIN_PERCENT, automatic=AUTOMATIC_CHARGING_ENABLED,
+    plan_provider=charge_planner.get_charge_plan)
 
 def check_and_control_battery_charging():
-        """Checks battery level and controls the charger plug if automatic charging is enabled."""
-        global last_plug_state, charging_start_time, total_energy_charged_wh, last_battery_percent, last_check_time
-        battery_info = get_battery_status()
-        if battery_info["success"]:
-            percent = battery_info["percent"]
-            is_charging = battery_info["is_charging"]
-            current_time = time.time()
-            if percent < LOW_BATTERY_THRESHOLD and not is_charging and last_plug_state != "on":
-                print(f"Battery low ({percent}%), turning charger ON.")
-                toggle_shelly_relay(True)
-                last_plug_state = "on"
-                charging_start_time = current_time
-                last_battery_percent = percent
-            elif percent > HIGH_BATTERY_THRESHOLD and is_charging  and last_battery_percent < HIGH_BATTERY_THRESHOLD:
-                print(f"Battery high ({percent}%), turning charger OFF. Adding {ENERGY_PER_CHARGE_CYCLE_WH:.2f} Wh.")
-                toggle_shelly_relay(False)
-                last_plug_state = "off"
-                total_energy_charged_wh += ENERGY_PER_CHARGE_CYCLE_WH
-                charging_start_time = None
-                last_battery_percent = None
-            elif is_charging and charging_start_time is None:
-                charging_start_time = current_time
-                last_battery_percent = percent
-            elif not is_charging:
-                charging_start_time = None
-                last_battery_percent = None
-            last_check_time = current_time
-            print(f"Battery: {percent}%, Charging: {is_charging}, Plug state: {last_plug_state}, Energy charged (approx): {total_energy_charged_wh:.2f} Wh")
-        else:
-            print(f"Error getting battery status for automatic charging: {battery_info.get('error')}")
+    """Checks battery level and controls the charger plug; returns seconds until the next check."""
+    return battery_controller.check()
 
 def battery_monitor_loop():
     """Runs the battery monitoring and control loop in the background."""
-    global last_check_time
-    last_check_time = time.time() # Initialize last check time
-    while True:
-        check_and_control_battery_charging()
-        time.sleep(BATTERY_CHECK_INTERVAL_SECONDS)
+    battery_controller.run()
+
+_background_lock = ProcessLock(BACKGROUND_LOCK_FILE)
+_background_stop = threading.Event()
+_background_thread = None
+
+def _run_background_services():
+    """Waits for the background lock, then starts the battery controller in this process."""
+    while not _background_stop.is_set():
+        if _background_lock.acquire():
+            log.info("Process %d runs the battery controller.", os.getpid())
+            battery_controller.start()
+            return
+        _background_stop.wait(BACKGROUND_LOCK_RETRY_SECONDS)
+
+def start_background_services():
+    """Called once per server process (each worker); the controller runs in exactly one of them."""
+    global _background_thread
+    if _background_thread is not None:
+        return
+    init_database()  # The battery controller's tables come from the schema migrations
+    _background_thread = threading.Thread(target=_run_background_services, name="background-services", daemon=True)
+    _background_thread.start()
+
+def stop_background_services():
+    """Graceful shutdown: finish the battery check in progress, end live streams, save settings."""
+    _background_stop.set()
+    battery_controller.stop(SHUTDOWN_TIMEOUT_SECONDS)
+    live_hub.close()
+    settings.get_store().flush_pending()
+    http_client.close()
+    _background_lock.release()
 
 def get_uptime():
     return int(time.time() - app.start_time)
 
+def get_battery_update():
+    """Battery payload pushed to live dashboards when it changes."""
+    battery_status = get_battery_status()
+    if not battery_status["success"]:
+        return {"success": False, "error": battery_status.get("error")}
+    return {"success": True, "percent": battery_status["percent"], "is_charging": battery_status["is_charging"],
+            "energy_charged": f"{battery_controller.snapshot()['total_energy_wh']:.2f}"}
+
+live_hub = LiveHub()
+live_hub.add_source("server_data", ServerDataCursor(get_server_data_since, get_latest_server_data_id),
+                    LIVE_SERVER_DATA_INTERVAL_SECONDS, snapshot=False)
+live_hub.add_source("plug", lambda: {"ison": get_shelly_status().get("ison")}, LIVE_PLUG_INTERVAL_SECONDS)
+live_hub.add_source("battery", get_battery_update, LIVE_BATTERY_INTERVAL_SECONDS)
+
 # --- Routes ---
 @app.route('/')
 def index():
@@ -94,49 +143,63 @@ def login():
     else:
         return render_template('login_failed.html')
 
+DASHBOARD_UNAVAILABLE = {"success": False, "stale": True, "error": "Source unavailable"}
+
 @app.route('/dashboard')
 def dashboard():
     if logged_in:
-        current_temperature = load_constants()
-        latest_server_info = get_latest_server_data()
-        shelly_status = get_shelly_status()
-        weather_data = get_weather_linkoping()
-        recent_server_data = get_recent_server_data()
-        uptime = get_uptime()
-        current_time = get_time()
-        battery_status = get_battery_status()
-        electricity_price = fetch_electricity_data_from_database()
-        solar_data = fetch_solar_data_from_database()
-        battery_percent = None
-        battery_charging = None
-        battery_time_left = None
-
-        if battery_status["success"]:
-            battery_percent = battery_status["percent"]
-            battery_charging = battery_status["is_charging"]
-            if not battery_charging:
-                battery_time_left = "Charging"
-
-        return render_template(
-            'dashboard.html',
-            current_temperature=current_temperature,
-            server_info=latest_server_info,
-            shelly_status=shelly_status,
-            weather=weather_data,
-            electricity_price=electricity_price,
-            recent_server_data=recent_server_data,
-            
-            uptime=format_uptime(uptime),
-            current_time=current_time,
-            battery_percent=battery_percent,
-            battery_charging=battery_charging,
-            battery_time_left=battery_time_left,
-            battery_error=battery_status.get("error") if not battery_status["success"] else None,
-            energy_charged=f"{total_energy_charged_wh:.2f}" # Pass the energy to the template
-        )
+        sources, stale_sources = gather_sources({
+            'latest_server_info': (get_latest_server_data, DB_SOURCE_DEADLINE_SECONDS, None),
+            'shelly_status': (get_shelly_status, HTTP_SOURCE_DEADLINE_SECONDS, {"ison": None, **DASHBOARD_UNAVAILABLE}),
+            'weather_data': (get_weather_linkoping, HTTP_SOURCE_DEADLINE_SECONDS, DASHBOARD_UNAVAILABLE),
+            'recent_server_data': (get_recent_server_data, DB_SOURCE_DEADLINE_SECONDS, None),
+            'battery_status': (get_battery_status, BATTERY_SOURCE_DEADLINE_SECONDS, DASHBOARD_UNAVAILABLE),
+            'electricity_price': (fetch_electricity_data_from_database, DB_SOURCE_DEADLINE_SECONDS, []),
+        })
+        return render_dashboard(sources, stale_sources)
     else:
         return redirect(url_for('login_form'))
 
+def render_dashboard(sources, stale_sources):
+    """Renders the dashboard from the gathered sources; shared with the asyncio server."""
+    current_temperature = load_constants()
+    latest_server_info = sources['latest_server_info']
+    shelly_status = sources['shelly_status']
+    weather_data = sources['weather_data']
+    recent_server_data = sources['recent_server_data']
+    battery_status = sources['battery_status']
+    electricity_price = sources['electricity_price']
+    uptime = get_uptime()
+    current_time = get_time()
+    battery_percent = None
+    battery_charging = None
+    battery_time_left = None
+
+    if battery_status["success"]:
+        battery_percent = battery_status["percent"]
+        battery_charging = battery_status["is_charging"]
+        if not battery_charging:
+            battery_time_left = "Charging"
+
+    return render_template(
+        'dashboard.html',
+        current_temperature=current_temperature,
+        server_info=latest_server_info,
+        shelly_status=shelly_status,
+        weather=weather_data,
+        electricity_price=electricity_price,
+        recent_server_data=recent_server_data,
+        
+        uptime=format_uptime(uptime),
+        current_time=current_time,
+        battery_percent=battery_percent,
+        battery_charging=battery_charging,
+        battery_time_left=battery_time_left,
+        battery_error=battery_status.get("error") if not battery_status["success"] else None,
+        stale_sources=stale_sources,
+        energy_charged=f"{battery_controller.snapshot()['total_energy_wh']:.2f}" # Pass the energy to the template
+    )
+
 @app.route('/submit', methods=['POST'])
 def submit():
     if not logged_in:
@@ -144,41 +207,125 @@ def submit():
     answer = request.form.get('answer')
     if answer:
         encrypted_answer = fernet.encrypt(answer.encode())
-        print("\n--- Received Encrypted Answer ---")
-        print("Encrypted:", encrypted_answer.decode())
+        log.info("Received encrypted answer: %s", encrypted_answer.decode())
         try:
             decrypted_answer = fernet.decrypt(encrypted_answer).decode()
-            print("Decrypted:", decrypted_answer)
+            log.debug("Decrypted answer: %s", decrypted_answer)
         except Exception as e:
-            print("Decryption Error:", e)
+            log.error("Decryption Error: %s", e)
         return render_template('submission_successful.html')
     else:
         return "Error: Missing or empty 'answer' field.", 400
 
 
+# --- Request metrics and traces ---
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    # Sampled at TRACE_SAMPLE_RATE; a request sending X-Trace is always traced.
+    g.trace = metrics.start_trace(f"{request.method} {request.path}", force='X-Trace' in request.headers)
+
+@app.after_request
+def record_request_metrics(response):
+    """Registered before compress_response, so it runs after it and the timing includes compression."""
+    route = request.url_rule.rule if request.url_rule else 'unmatched'  # Not the path: bounded label values
+    started = g.get('request_started')
+    if started is not None:
+        REQUEST_SECONDS.labels(route, request.method, str(response.status_code)).observe(time.perf_counter() - started)
+    trace = g.get('trace')
+    if trace is not None:
+        metrics.finish_trace(trace, route=route, status=response.status_code)
+        response.headers['X-Trace-Id'] = trace.trace_id
+    return response
+
+def cached_json_response(payload):
+    """Answers from a VersionedJSONCache payload: 304 for a current If-None-Match, else the
+    serialized body, compressed if the client accepts it."""
+    status, headers, body = payload.respond(request.headers.get('If-None-Match'),
+                                            request.headers.get('Accept-Encoding'))
+    return Response(body, status=status, headers=headers)
+
+@app.after_request
+def compress_response(response):
+    """Compresses other large text responses (JSON, the dashboard) the client accepts compressed."""
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers or response.mimetype not in COMPRESSIBLE_TYPES):
+        return response
+    encoding = choose_encoding(request.headers.get('Accept-Encoding'), response.content_length or 0)
+    if encoding:
+        response.set_data(compress(response.get_data(), encoding))
+        response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+    return response
+
+def time_window_args():
+    """Optional ?from=&to= (epoch or ISO) of the windowed endpoints; (None, None) when absent."""
+    start, end = request.args.get('from'), request.args.get('to')
+    return (history.to_epoch(start) if start is not None else None,
+            history.to_epoch(end) if end is not None else None)
+
 @app.route('/electricity_price')
 def server_electricity_priceinfo():
-    latest_data = fetch_electricity_data_from_database()
-    if latest_data:
-        return jsonify(latest_data)
+    """Prices in ?from=&to=; without a window, the last hours and everything ahead (cached)."""
+    try:
+        start, end = time_window_args()
+    except ValueError:
+        return jsonify({'error': 'Invalid from/to'}), 400
+    if start is not None or end is not None:
+        return jsonify(fetch_electricity_data_from_database(start if start is not None else 0, end))
+    payload = electricity_price_payload.get()
+    if payload:
+        return cached_json_response(payload)
     else:
         return jsonify({'error': '500'}), 500
 
 @app.route('/shelly_plug_data')
 def server_shelly_status():
-    latest_data = get_shelly_status()
+    latest_data = get_shelly_plug_data()
     if latest_data:
         return jsonify(latest_data)
     else:
         return jsonify({'error': '500'}), 500
 
+@app.route('/shelly_relays', methods=['POST'])
+def switch_relays():
+    """Batched relay commands: {"commands": [{"device": "heater", "relay": 1, "turn": "on"}, ...]}."""
+    if not logged_in:
+        return jsonify({'success': False, 'error': 'Not logged in'}), 401
+    try:
+        commands = []
+        for item in (request.get_json(silent=True) or {})['commands']:
+            if item['turn'] not in ('on', 'off'):
+                raise ValueError(f"turn must be 'on' or 'off', not {item['turn']!r}")
+            commands.append((item['device'], int(item.get('relay', 0)), item['turn'] == 'on'))
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({'success': False, 'error': f'Invalid commands: {e}'}), 400
+    results = switch_shelly_relays(commands)
+    return jsonify({'success': all(result['success'] for result in results), 'results': results})
+
 
 
 @app.route('/solar_data')
 def server_solar_data():
-    latest_data = fetch_solar_data_from_database()
-    if latest_data:
-        return jsonify(latest_data)
+    """Forecast hours in ?from=&to=; without a window, the last hours and everything ahead (cached)."""
+    try:
+        start, end = time_window_args()
+    except ValueError:
+        return jsonify({'error': 'Invalid from/to'}), 400
+    if start is not None or end is not None:
+        return jsonify(fetch_solar_data_from_database(start if start is not None else 0, end))
+    payload = solar_data_payload.get()
+    if payload:
+        return cached_json_response(payload)
+    else:
+        return jsonify({'error': '500'}), 500
+
+@app.route('/energy_summary')
+def server_energy_summary():
+    """Current price plus today's and tomorrow's price and solar statistics, precomputed at ingest."""
+    summary = get_energy_summary()
+    if summary:
+        return jsonify(summary)
     else:
         return jsonify({'error': '500'}), 500
 
@@ -200,14 +347,98 @@ def server_info():
     else:
         return jsonify({'cpu': 'N/A', 'memory_percent': 'N/A', 'disk_percent': 'N/A'}), 500
 
+@app.route('/system_sample')
+def system_sample():
+    data = get_latest_system_sample()
+    if data:
+        return jsonify(data)
+    return jsonify({'error': 'No system samples stored yet'}), 404
+
 @app.route('/recent_server_data')
 def recent_server_data():
+    since = request.args.get('since', type=int)
+    if since is not None:
+        # Delta mode: only samples stored after the client's last id, as columns.
+        data = get_server_data_since(since)
+        return jsonify(data or {**{column: [] for column in SERVER_DATA_COLUMNS}, 'last_id': since})
     data = get_recent_server_data()
     if data:
         return jsonify(data)
     else:
         return jsonify({'error': 'Could not retrieve recent server data'}), 500
 
+@app.route('/cache_stats')
+def server_cache_stats():
+    return jsonify(cache_stats())
+
+@app.route('/collector_stats')
+def server_collector_stats():
+    return jsonify(get_collector_stats())
+
+@app.route('/metrics')
+def server_metrics():
+    """Prometheus text format: this process's metrics plus the collector's last snapshot."""
+    snapshots = {metrics.PROCESS_NAME: metrics.snapshot(), **get_metrics_snapshots()}
+    return Response(metrics.render(snapshots, metrics.collected_families()), mimetype='text/plain; version=0.0.4')
+
+@app.route('/traces')
+def server_traces():
+    """The most recent sampled request traces, newest first."""
+    return jsonify(metrics.recent_traces())
+
+@app.route('/stream')
+def live_stream():
+    """Server-Sent Events stream of new server samples, plug state changes and battery updates."""
+    events = live_hub.subscribe()
+    return Response(live_hub.stream(events), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/server_history')
+def server_history():
+    """Downsampled server metrics for a time range: ?start=&end= (epoch or ISO, default last 24 h),
+    &points= (target point count) and &mode=minmax (buckets) or lttb."""
+    try:
+        end = history.to_epoch(request.args.get('end', time.time()))
+        start = history.to_epoch(request.args.get('start', end - 24 * 3600))
+        points = request.args.get('points', 200, type=int)
+    except ValueError:
+        return jsonify({'error': 'Invalid start/end'}), 400
+    if start >= end:
+        return jsonify({'error': 'start must be before end'}), 400
+    if request.args.get('mode', 'minmax') == 'lttb':
+        return jsonify(history.get_lttb_history(start, end, points))
+    return jsonify(history.get_bucketed_history(start, end, points))
+
+@app.route('/battery_controller')
+def battery_controller_state():
+    return jsonify({**battery_controller.snapshot(), 'recent_cycles': battery_controller.recent_cycles()})
+
+@app.route('/charge_plan')
+def server_charge_plan():
+    """The collector's current charge plan: windows to charge in and the predicted level per hour."""
+    plan = charge_planner.get_charge_plan()
+    if plan:
+        return jsonify(plan)
+    else:
+        return jsonify({'error': 'No charge plan yet'}), 404
+
+@app.route('/solar_arrays')
+def server_solar_arrays():
+    return jsonify([array.to_dict() for array in solar_arrays()])
+
+@app.route('/solar_arrays', methods=['POST'])
+def update_solar_arrays():
+    """Replaces the panel arrays and recomputes every stored prediction with them; the collector
+    follows the setting for later forecasts."""
+    if not logged_in:
+        return jsonify({'success': False, 'error': 'Not logged in'}), 401
+    try:
+        arrays = solar_model.parse_arrays(request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    settings.set_value('solar_arrays', [array.to_dict() for array in arrays])
+    return jsonify({'success': True, 'recomputed': recompute_solar_predictions(arrays)})
+
 @app.route('/uptime')
 def get_uptime_route():
     return jsonify({'uptime': get_uptime()})
@@ -223,28 +454,19 @@ def floor_plan():
 def toggle_charger(action):
     if not logged_in:
         return redirect(url_for('login_form'))  # Or handle unauthorized access differently
-    global last_plug_state, charging_start_time, total_energy_charged_wh, last_battery_percent
-    if action == "on":
-        result = toggle_shelly_relay(True)
-        if result["success"]:
-            last_plug_state = "on"
-            if charging_start_time is None and not get_battery_status()["is_charging"]:
-                charging_start_time = time.time()
-    elif action == "off":
-        result = toggle_shelly_relay(False)
-        if result["success"]:
-            last_plug_state = "off"
-            battery_status = get_battery_status()
-            if charging_start_time is not None and battery_status["success"] and battery_status["percent"] >= HIGH_BATTERY_THRESHOLD and last_battery_percent is not None and last_battery_percent < HIGH_BATTERY_THRESHOLD:
-                print(f"Manual turn off at {battery_status['percent']}%. Adding {ENERGY_PER_CHARGE_CYCLE_WH:.2f} Wh.")
-                charging_start_time = None
+    if action in ("on", "off"):
+        # Applied by whichever worker runs the battery controller
+        result = battery_controller.request_plug(action == "on")
+        if not result["success"]:
+            log.warning("Could not turn the charger %s: %s", action, result.get("error"))
     else:
         return "Invalid action", 400
     return redirect(url_for('dashboard'))
 
 if __name__ == '__main__':
-    battery_thread = threading.Thread(target=battery_monitor_loop, daemon=True)
-    battery_thread.start()
-
+    # Development server; use wsgi.py for production. With the reloader only the child process serves.
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        structured_log.configure(metrics.PROCESS_NAME)
+        start_background_services()
     app.run(host="0.0.0.0", port=80, debug=True)
     
\ No newline at end of file
@@ -0,0 +1,174 @@
+"""Solar production model: panel arrays with tilt and azimuth, evaluated with NumPy.
+
+For every forecast hour the sun's position gives the angle of incidence on each array. Open-Meteo's
+global horizontal irradiance (GHI) is split into direct and diffuse parts with the Erbs
+correlation, and the plane-of-array irradiance adds the direct beam, the sky diffuse (isotropic)
+and the ground-reflected part:
+
+    POA = DNI * max(cos AOI, 0) + DHI * (1 + cos tilt) / 2 + GHI * albedo * (1 - cos tilt) / 2
+
+An array produces area * efficiency * POA * (1 + temperature_coefficient * (T_cell - T_ref)).
+T_cell is the air temperature, or with `noct` set the NOCT estimate T_air + POA * (NOCT - 20) / 800.
+A horizontal array without noct is exactly the original GHI model.
+
+Every function takes arrays of hours and evaluates all of them (and all panel arrays) at once,
+so a multi-day forecast or a bulk recompute of the stored rows is a handful of NumPy operations.
+NumPy is imported on the first call (see _np) rather than here: the web server imports this module
+for the panel array settings, and NumPy would double its cold start.
+"""
+
+# --- Model Configuration ---
+SOLAR_CONSTANT = 1367.0  # W/m² at one astronomical unit
+ALBEDO = 0.2  # Ground reflectance; about 0.6-0.8 with snow cover
+MAX_ZENITH_DEGREES = 87.0  # Closer to the horizon the beam is treated as diffuse
+HOURLY_MEAN_OFFSET_SECONDS = -1800  # Open-Meteo radiation is the mean of the preceding hour
+# The model of the original single-panel setup: 50 m² of 15 % panels, flat.
+DEFAULT_ARRAYS = [{"name": "roof", "area": 50, "efficiency": 0.15, "tilt": 0, "azimuth": 180,
+                   "temperature_coefficient": -0.004, "reference_temperature": 25}]
+
+_numpy = None
+
+
+def _np():
+    """The numpy module, imported on first use."""
+    global _numpy
+    if _numpy is None:
+        import numpy
+        _numpy = numpy
+    return _numpy
+
+
+class PanelArray:
+    """One group of identically oriented panels. tilt is degrees from horizontal, azimuth degrees
+    clockwise from north (180 = facing south)."""
+
+    FIELDS = ('name', 'area', 'efficiency', 'tilt', 'azimuth', 'temperature_coefficient',
+              'reference_temperature', 'noct')
+
+    def __init__(self, name, area, efficiency, tilt=0.0, azimuth=180.0, temperature_coefficient=-0.004,
+                 reference_temperature=25.0, noct=None):
+        if area <= 0 or not 0 < efficiency <= 1:
+            raise ValueError(f"Panel array '{name}': area must be positive and efficiency in (0, 1]")
+        if not 0 <= tilt <= 90:
+            raise ValueError(f"Panel array '{name}': tilt must be between 0 and 90 degrees")
+        self.name = name
+        self.area = float(area)
+        self.efficiency = float(efficiency)
+        self.tilt = float(tilt)
+        self.azimuth = float(azimuth) % 360
+        self.temperature_coefficient = float(temperature_coefficient)
+        self.reference_temperature = float(reference_temperature)
+        self.noct = float(noct) if noct is not None else None
+
+    @classmethod
+    def from_dict(cls, entry):
+        unknown = set(entry) - set(cls.FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown panel array fields: {', '.join(sorted(unknown))}")
+        return cls(**entry)
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+
+def parse_arrays(entries):
+    """PanelArray objects from a list of dicts (e.g. the solar_arrays setting); raises ValueError."""
+    if not isinstance(entries, list) or not entries:
+        raise ValueError("Expected a non-empty list of panel arrays")
+    try:
+        return [PanelArray.from_dict(entry) for entry in entries]
+    except TypeError as e:
+        raise ValueError(f"Invalid panel array: {e}") from None
+
+
+# --- Sun position ---
+def sun_position(epochs, latitude, longitude):
+    """Solar zenith and azimuth (degrees, azimuth clockwise from north) at UTC epoch seconds,
+    from Spencer's series for the declination and the equation of time (within about 0.5°)."""
+    np = _np()
+    epochs = np.asarray(epochs, dtype=float)
+    gamma = 2 * np.pi * (days_into_year(epochs) - 0.5) / 365.0  # Fractional year, noon of 1 January = 0
+    declination = (0.006918 - 0.399912 * np.cos(gamma) + 0.070257 * np.sin(gamma)
+                   - 0.006758 * np.cos(2 * gamma) + 0.000907 * np.sin(2 * gamma)
+                   - 0.002697 * np.cos(3 * gamma) + 0.00148 * np.sin(3 * gamma))
+    equation_of_time = 229.18 * (0.000075 + 0.001868 * np.cos(gamma) - 0.032077 * np.sin(gamma)
+                                 - 0.014615 * np.cos(2 * gamma) - 0.040849 * np.sin(2 * gamma))  # Minutes
+    solar_minutes = (epochs % 86400) / 60.0 + equation_of_time + 4 * longitude
+    hour_angle = np.radians(solar_minutes / 4.0 - 180.0)
+    lat = np.radians(latitude)
+    cos_zenith = np.clip(np.sin(lat) * np.sin(declination)
+                         + np.cos(lat) * np.cos(declination) * np.cos(hour_angle), -1.0, 1.0)
+    zenith = np.arccos(cos_zenith)
+    azimuth = np.arctan2(np.sin(hour_angle),
+                         np.cos(hour_angle) * np.sin(lat) - np.tan(declination) * np.cos(lat))
+    return np.degrees(zenith), (np.degrees(azimuth) + 180.0) % 360.0
+
+
+def days_into_year(epochs):
+    """Fractional days since 1 January 00:00 UTC of each epoch's year."""
+    np = _np()
+    seconds = np.asarray(epochs, dtype=float).astype('int64').astype('datetime64[s]')
+    return (seconds - seconds.astype('datetime64[Y]')).astype('float64') / 86400.0
+
+
+def extraterrestrial_irradiance(epochs):
+    np = _np()
+    return SOLAR_CONSTANT * (1 + 0.033 * np.cos(2 * np.pi * days_into_year(epochs) / 365.0))
+
+
+# --- Irradiance ---
+def decompose(ghi, zenith, epochs):
+    """(DNI, DHI) from GHI with the Erbs diffuse fraction correlation."""
+    np = _np()
+    ghi = np.maximum(np.asarray(ghi, dtype=float), 0.0)
+    cos_zenith = np.cos(np.radians(zenith))
+    up = zenith < MAX_ZENITH_DEGREES
+    with np.errstate(divide='ignore', invalid='ignore'):
+        clearness = np.where(up, ghi / (extraterrestrial_irradiance(epochs) * cos_zenith), 0.0)
+    clearness = np.clip(clearness, 0.0, 1.0)
+    diffuse_fraction = np.select(
+        [clearness <= 0.22, clearness <= 0.8],
+        [1.0 - 0.09 * clearness,
+         0.9511 - 0.1604 * clearness + 4.388 * clearness ** 2 - 16.638 * clearness ** 3 + 12.336 * clearness ** 4],
+        0.165)
+    dhi = np.where(up, ghi * diffuse_fraction, ghi)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dni = np.where(up, (ghi - dhi) / cos_zenith, 0.0)
+    return dni, dhi
+
+
+def plane_of_array(ghi, dni, dhi, zenith, sun_azimuth, tilt, azimuth, albedo=ALBEDO):
+    """Irradiance on planes of the given tilt and azimuth (degrees). tilt and azimuth may be
+    column vectors, one row per array, to evaluate several arrays at once."""
+    np = _np()
+    zenith, sun_azimuth = np.radians(zenith), np.radians(sun_azimuth)
+    tilt, azimuth = np.radians(tilt), np.radians(azimuth)
+    cos_incidence = (np.cos(zenith) * np.cos(tilt)
+                     + np.sin(zenith) * np.sin(tilt) * np.cos(sun_azimuth - azimuth))
+    beam = dni * np.maximum(cos_incidence, 0.0)
+    sky = dhi * (1 + np.cos(tilt)) / 2
+    ground = np.maximum(ghi, 0.0) * albedo * (1 - np.cos(tilt)) / 2
+    return beam + sky + ground
+
+
+def predict_power(epochs, ghi, temperature, arrays, latitude, longitude, per_array=False):
+    """Predicted power (W) of all `arrays` together for each hour, or one row per array with
+    per_array. `epochs` are Open-Meteo's hourly timestamps as UTC epoch seconds; missing GHI or
+    temperature values (None) give NaN."""
+    np = _np()
+    epochs = np.asarray(epochs, dtype=float)
+    ghi = np.asarray(ghi, dtype=float)
+    temperature = np.asarray(temperature, dtype=float)
+    zenith, sun_azimuth = sun_position(epochs + HOURLY_MEAN_OFFSET_SECONDS, latitude, longitude)
+    dni, dhi = decompose(ghi, zenith, epochs)
+
+    def column(field):
+        return np.array([[getattr(array, field)] for array in arrays], dtype=float)
+
+    poa = plane_of_array(ghi, dni, dhi, zenith, sun_azimuth, column('tilt'), column('azimuth'))
+    noct = column('noct')  # NaN where unset
+    cell_temperature = np.where(np.isnan(noct), temperature, temperature + poa * (noct - 20) / 800)
+    power = (column('area') * column('efficiency') * poa
+             * (1 + column('temperature_coefficient') * (cell_temperature - column('reference_temperature'))))
+    power = np.where(ghi > 0, np.maximum(power, 0.0), np.where(np.isnan(ghi), np.nan, 0.0))
+    return power if per_array else power.sum(axis=0)
@@ -0,0 +1,233 @@
+"""Non-blocking structured logging for the web server, the battery controller and the collector.
+
+Modules log through the standard library (`log = logging.getLogger('helper_server')`). configure()
+puts a bounded queue between them and the handlers: a log call formats its message and enqueues
+it, and one writer thread does the file and console I/O. When the queue is full the record is
+dropped and counted instead of waited for, so request threads and the battery loop never block on
+a slow SD card or journal.
+
+    LOG_LEVEL=INFO LOG_LEVELS="database_script=DEBUG,cache=WARNING" python wsgi.py
+
+Records go to LOG_DIR/<process>.log as JSON lines, rotated by size; warnings and errors are also
+written to stderr. Repeated warnings (same logger and message format) are rate limited.
+
+The logging module can't rotate one file from several processes, so a process forked after
+configure() (a gunicorn worker) writes to its own LOG_DIR/<process>-<pid>.log instead; the files
+of workers that have exited are removed when a new worker opens its file.
+"""
+import glob
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+import metrics
+
+# --- Logging Configuration ---
+LOG_DIR = os.environ.get('LOG_DIR', 'logs')
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+LOG_LEVELS = os.environ.get('LOG_LEVELS', '')  # Per-module overrides: "module=LEVEL,module=LEVEL"
+LOG_CONSOLE_LEVEL = os.environ.get('LOG_CONSOLE_LEVEL', 'WARNING')  # Also written to stderr / the journal
+LOG_MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES', 1024 * 1024))  # Size at which a log file is rotated
+LOG_BACKUP_COUNT = int(os.environ.get('LOG_BACKUP_COUNT', 3))  # Disk use is bounded by (count + 1) * max bytes
+LOG_QUEUE_SIZE = 10000  # Records waiting for the writer thread; more are dropped, never waited for
+RATE_LIMIT_WINDOW_SECONDS = 60
+RATE_LIMIT_BURST = 5  # Identical warnings or errors logged per window; the rest are counted
+RATE_LIMIT_MAX_KEYS = 1024
+
+CONSOLE_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+# Attributes every LogRecord has; anything else was passed with extra={...} and is logged as a field.
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+_lock = threading.Lock()
+_handler = None
+_listener = None
+_file_options = None  # (process, directory, max_bytes, backup_count) of the log file, reopened after a fork
+_stats = {"dropped": 0, "suppressed": 0}
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, message, thread and any extra fields."""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'thread': record.threadName,
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """Lets at most `burst` warnings or errors with the same logger and format string through per
+    window, e.g. one unreachable Shelly plug polled every few seconds. The first record after a
+    window with suppressed ones carries their count as `suppressed`."""
+
+    def __init__(self, window_seconds=RATE_LIMIT_WINDOW_SECONDS, burst=RATE_LIMIT_BURST, max_keys=RATE_LIMIT_MAX_KEYS):
+        super().__init__()
+        self.window_seconds = window_seconds
+        self.burst = burst
+        self.max_keys = max_keys
+        self._windows = {}  # key -> [window start, records logged, records suppressed]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno < logging.WARNING:
+            return True
+        key = (record.name, record.levelno, record.msg if isinstance(record.msg, str) else type(record.msg))
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.window_seconds:
+                if window is None and len(self._windows) >= self.max_keys:
+                    self._windows.clear()
+                suppressed = window[2] if window else 0
+                self._windows[key] = [now, 1, 0]
+                if suppressed:
+                    record.suppressed = suppressed
+                return True
+            if window[1] < self.burst:
+                window[1] += 1
+                return True
+            window[2] += 1
+            _stats["suppressed"] += 1
+            return False
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops a record when the queue is full rather than blocking the caller."""
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _stats["dropped"] += 1
+
+
+def parse_levels(spec):
+    """"module=LEVEL,module=LEVEL" -> {module: level}."""
+    levels = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        name, _, level = item.partition('=')
+        levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def _file_handler(process, directory, max_bytes, backup_count, name=None):
+    os.makedirs(directory, exist_ok=True)
+    handler = logging.handlers.RotatingFileHandler(os.path.join(directory, f"{name or process}.log"),
+                                                   maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8')
+    handler.setFormatter(JSONFormatter())
+    return handler
+
+
+def _remove_exited_worker_logs(process, directory):
+    """Deletes <process>-<pid>.log and its backups for processes that no longer run, so restarted
+    workers don't grow disk use past the per-file bound."""
+    for path in glob.glob(os.path.join(glob.escape(directory), f"{glob.escape(process)}-*.log*")):
+        pid = os.path.basename(path)[len(process) + 1:].split('.', 1)[0]
+        if not pid.isdigit() or int(pid) == os.getpid():
+            continue
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        except OSError:
+            pass  # Runs under another user
+
+
+def configure(process, level=LOG_LEVEL, levels=LOG_LEVELS, console_level=LOG_CONSOLE_LEVEL, log_file=True,
+              directory=LOG_DIR, max_bytes=LOG_MAX_BYTES, backup_count=LOG_BACKUP_COUNT):
+    """Routes every logger through the queue to LOG_DIR/<process>.log and stderr. Idempotent;
+    `levels` is a {module: level} dict or a "module=LEVEL,..." string."""
+    global _handler, _listener, _file_options
+    with _lock:
+        if _handler is not None:
+            return
+        handlers = []
+        if log_file:
+            _file_options = (process, directory, max_bytes, backup_count)
+            handlers.append(_file_handler(process, directory, max_bytes, backup_count))
+        if console_level:
+            console = logging.StreamHandler(sys.stderr)
+            console.setLevel(console_level)
+            console.setFormatter(logging.Formatter(CONSOLE_FORMAT))
+            handlers.append(console)
+        root = logging.getLogger()
+        root.setLevel(level)
+        for name, module_level in (parse_levels(levels) if isinstance(levels, str) else levels).items():
+            logging.getLogger(name).setLevel(module_level)
+        _handler = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+        _handler.addFilter(RateLimitFilter())
+        root.addHandler(_handler)
+        _listener = logging.handlers.QueueListener(_handler.queue, *handlers, respect_handler_level=True)
+        _listener.start()
+    atexit.register(shutdown)
+
+
+def shutdown():
+    """Writes out the queued records and stops the writer thread."""
+    global _listener
+    with _lock:
+        listener, _listener = _listener, None
+    if listener is not None:
+        listener.stop()
+
+
+def _restart_after_fork():
+    # The writer thread does not survive a fork (pre-fork servers); records queued by a worker
+    # would otherwise never be written. The worker also gets its own log file: processes sharing a
+    # RotatingFileHandler rotate the file under each other and keep writing to the renamed one.
+    if _listener is not None:
+        _handler.queue = _listener.queue = queue.Queue(LOG_QUEUE_SIZE)  # Its lock may be held by the gone thread
+        _listener._thread = None
+        if _file_options is not None:
+            process, directory = _file_options[:2]
+            handlers = []
+            for handler in _listener.handlers:
+                if isinstance(handler, logging.handlers.RotatingFileHandler):
+                    handler.close()  # Only this process's copy of the descriptor
+                    _remove_exited_worker_logs(process, directory)
+                    handler = _file_handler(*_file_options, name=f"{process}-{os.getpid()}")
+                handlers.append(handler)
+            _listener.handlers = tuple(handlers)
+        _listener.start()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_restart_after_fork)
+
+
+def stats():
+    """Queue length and the records dropped (queue full) or suppressed (rate limit) so far."""
+    return {"queued": _handler.queue.qsize() if _handler is not None else 0, **_stats}
+
+
+def _log_metrics():
+    current = stats()
+    return [
+        ('log_queue_length', 'gauge', 'Log records waiting for the writer thread', [({}, current["queued"])]),
+        ('log_records_dropped_total', 'counter', 'Log records dropped because the queue was full',
+         [({}, current["dropped"])]),
+        ('log_records_suppressed_total', 'counter', 'Repeated warnings suppressed by the rate limit',
+         [({}, current["suppressed"])]),
+    ]
+
+
+metrics.add_collector(_log_metrics)
@@ -0,0 +1,82 @@
+"""Local stand-in for every upstream provider, serving recorded fixtures over HTTP.
+
+Requests to /<provider>/<path> are answered from the fixture directory the same way the in-process
+"fixtures" backend answers them, so running the web server or the collector with
+PROVIDER_BACKEND=stub exercises the real HTTP path (pooling, retries, conditional requests)
+without network access:
+
+    python stub_server.py --port 8765 --delay-ms 50
+    PROVIDER_BACKEND=stub python database_script.py
+"""
+import argparse
+import hashlib
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+import providers
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep-alive, like the real APIs
+
+    def do_GET(self):
+        server = self.server
+        if server.delay_seconds:
+            time.sleep(server.delay_seconds)
+        parts = urlsplit(self.path)
+        name, _, path = parts.path.lstrip('/').partition('/')
+        if server.fail_rate and random.random() < server.fail_rate:
+            status, headers, body = 503, {'Content-Type': 'text/plain'}, b'Injected failure'
+        else:
+            status, headers, body = server.store.respond(name, '/' + path, parts.query)
+        etag = '"%s"' % hashlib.sha256(body).hexdigest()[:16]
+        if status == 200 and self.headers.get('If-None-Match') == etag:
+            status, body = 304, b''
+        self.send_response(status)
+        for key, value in headers.items():
+            if key.lower() not in ('etag', 'content-length'):
+                self.send_header(key, value)
+        if status in (200, 304):
+            self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+def start_stub_server(port=0, fixtures_dir=None, delay_ms=0, fail_rate=0.0, verbose=False):
+    """Starts the stub server on a background thread and returns it; server.server_port is the port."""
+    server = ThreadingHTTPServer(('127.0.0.1', port), StubHandler)
+    server.daemon_threads = True
+    server.store = providers.FixtureStore(fixtures_dir)
+    server.delay_seconds = delay_ms / 1000
+    server.fail_rate = fail_rate
+    server.verbose = verbose
+    threading.Thread(target=server.serve_forever, name='stub-server', daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=int(providers.STUB_SERVER_URL.rsplit(':', 1)[-1]))
+    parser.add_argument('--fixtures', default=providers.FIXTURES_DIR)
+    parser.add_argument('--delay-ms', type=float, default=0, help='added latency per request')
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='share of requests answered with 503')
+    args = parser.parse_args()
+    server = start_stub_server(args.port, args.fixtures, args.delay_ms, args.fail_rate, verbose=True)
+    print(f"Stub providers on http://127.0.0.1:{server.server_port} serving {args.fixtures}. Press Ctrl+C to stop.")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+import logging
+import os
+import threading
+import time
+
+import psutil
+
+log = logging.getLogger('system_sampler')
+
+# --- System Sampler ---
+# A background thread samples the cheap kernel counters (CPU times, network and disk I/O) every
+# SAMPLE_INTERVAL_SECONDS and folds each sample into the current window as it goes. The collector
+# takes one aggregated sample per window (mean and peak CPU, per-core load, I/O rates, ...), so a
+# higher sampling rate never means more database writes. Expensive readings (the process table,
+# temperature sensors) are taken once per window, at most every few seconds.
+SAMPLE_INTERVAL_SECONDS = float(os.environ.get('SAMPLER_INTERVAL_SECONDS', 1.0))
+ALL_COMPONENTS = ('cpu', 'load', 'memory', 'disk', 'net', 'disk_io', 'temperatures', 'processes')
+REQUIRED_COMPONENTS = ('cpu', 'memory', 'disk')  # The server_data columns; read even when not listed
+SAMPLER_COMPONENTS = tuple(part.strip() for part in os.environ.get('SAMPLER_COMPONENTS', ','.join(ALL_COMPONENTS)).split(',')
+                           if part.strip())
+DISK_PATH = '/'
+TOP_PROCESSES = 5  # Processes listed by CPU and by resident memory
+PROCESS_INTERVAL_SECONDS = 10  # Scanning every process is the most expensive reading
+TEMPERATURE_INTERVAL_SECONDS = 30  # Sensors are slow to read and change slowly
+MIN_SAMPLE_SECONDS = 0.05  # CPU times advance in 10 ms ticks; shorter intervals would be mostly rounding
+
+
+def _busy_fraction(previous, current):
+    """Busy share of the CPU time between two psutil cpu_times() readings, like psutil.cpu_percent()."""
+    idle = (current.idle + getattr(current, 'iowait', 0)) - (previous.idle + getattr(previous, 'iowait', 0))
+    total = sum(current) - sum(previous)
+    return max(0.0, min(1.0, 1 - idle / total)) if total > 0 else 0.0
+
+
+class SystemSampler:
+    """Samples system counters at a high rate and hands out one aggregate per window.
+
+    collect() closes the current window and returns it as a fetch_server_info() dict; without
+    the background thread (start()), each collect() still samples once, against the previous
+    collect(). Counter readings are kept between samples, so every rate is a delta of two
+    readings and no psutil call blocks for an interval.
+    """
+
+    def __init__(self, interval_seconds=SAMPLE_INTERVAL_SECONDS, components=SAMPLER_COMPONENTS,
+                 top_processes=TOP_PROCESSES, disk_path=DISK_PATH, clock=time.monotonic):
+        unknown = set(components) - set(ALL_COMPONENTS)
+        if unknown:
+            raise ValueError(f"Unknown sampler components: {', '.join(sorted(unknown))}")
+        self.interval_seconds = interval_seconds
+        self.components = frozenset(components) | frozenset(REQUIRED_COMPONENTS)
+        self.top_processes = top_processes
+        self.disk_path = disk_path
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._last = None  # (time, cpu times per core, net counters, disk counters) of the last sample
+        self._window_start = None  # Same, at the start of the window
+        self._window = self._empty_window()
+        self._temperatures = None
+        self._temperatures_at = None
+        self._processes = None
+        self._processes_at = None
+
+    @staticmethod
+    def _empty_window():
+        return {"samples": 0, "cpu_sum": 0.0, "cpu_max": 0.0, "core_sums": None,
+                "net_peak_bps": 0.0, "disk_peak_bps": 0.0}
+
+    # --- Counters ---
+    def _read_counters(self):
+        cores = psutil.cpu_times(percpu=True) if 'cpu' in self.components else None
+        net = psutil.net_io_counters() if 'net' in self.components else None
+        disk = psutil.disk_io_counters() if 'disk_io' in self.components else None
+        return self.clock(), cores, net, disk
+
+    def sample(self):
+        """Takes one sample and folds it into the current window."""
+        last = self._last
+        if last is not None and self.clock() - last[0] < MIN_SAMPLE_SECONDS:
+            return
+        reading = self._read_counters()
+        with self._lock:
+            previous, self._last = self._last, reading
+            if previous is None:
+                self._window_start = reading
+                return
+            now, cores, net, disk = reading
+            elapsed = now - previous[0]
+            window = self._window
+            if cores is not None:
+                busy = [_busy_fraction(before, after) * 100 for before, after in zip(previous[1], cores)]
+                cpu = sum(busy) / len(busy)
+                window["cpu_sum"] += cpu
+                window["cpu_max"] = max(window["cpu_max"], cpu)
+                window["core_sums"] = busy if window["core_sums"] is None else [
+                    total + value for total, value in zip(window["core_sums"], busy)]
+            if elapsed > 0 and net is not None and previous[2] is not None:
+                rate = (net.bytes_sent + net.bytes_recv - previous[2].bytes_sent - previous[2].bytes_recv) / elapsed
+                window["net_peak_bps"] = max(window["net_peak_bps"], rate)
+            if elapsed > 0 and disk is not None and previous[3] is not None:
+                rate = (disk.read_bytes + disk.write_bytes - previous[3].read_bytes - previous[3].write_bytes) / elapsed
+                window["disk_peak_bps"] = max(window["disk_peak_bps"], rate)
+            window["samples"] += 1
+
+    # --- Slow readings ---
+    def _read_temperatures(self, now):
+        if self._temperatures_at is not None and now - self._temperatures_at < TEMPERATURE_INTERVAL_SECONDS:
+            return self._temperatures
+        self._temperatures_at = now
+        readers = getattr(psutil, 'sensors_temperatures', None)  # Not on Windows and macOS
+        try:
+            sensors = readers() if readers is not None else {}
+        except (OSError, RuntimeError) as e:
+            log.debug("Could not read temperature sensors: %s", e)
+            sensors = {}
+        self._temperatures = {name: max(entry.current for entry in entries)
+                              for name, entries in sensors.items() if entries} or None
+        return self._temperatures
+
+    def _read_processes(self, now):
+        """Top processes by CPU and by RSS. psutil.process_iter() keeps its Process objects between
+        calls, so cpu_percent is each process's share since the previous scan."""
+        if self._processes_at is not None and now - self._processes_at < PROCESS_INTERVAL_SECONDS:
+            return self._processes
+        self._processes_at = now
+        processes = []
+        for process in psutil.process_iter(['pid', 'name', 'cpu_percent', 'memory_info']):
+            info = process.info
+            if info['memory_info'] is not None:
+                processes.append({'pid': info['pid'], 'name': info['name'],
+                                  'cpu_percent': info['cpu_percent'] or 0.0, 'rss': info['memory_info'].rss})
+        self._processes = {
+            'cpu': sorted(processes, key=lambda p: p['cpu_percent'], reverse=True)[:self.top_processes],
+            'memory': sorted(processes, key=lambda p: p['rss'], reverse=True)[:self.top_processes],
+        }
+        return self._processes
+
+    # --- Windows ---
+    def collect(self):
+        """Closes the current window and returns its aggregate: the fetch_server_info() fields
+        (cpu_percent is the window's mean) plus the sampler's own."""
+        if self._thread is None or not self._thread.is_alive():
+            self.sample()
+        with self._lock:
+            window, self._window = self._window, self._empty_window()
+            start, end = self._window_start, self._last
+            self._window_start = end
+        data = {'samples': window['samples']}
+        elapsed = end[0] - start[0] if start is not None and end is not None else 0
+        data['window_seconds'] = round(elapsed, 3)
+        if 'cpu' in self.components:
+            samples = window['samples']
+            data['cpu_percent'] = round(window['cpu_sum'] / samples, 1) if samples else psutil.cpu_percent()
+            data['cpu_max_percent'] = round(window['cpu_max'], 1) if samples else data['cpu_percent']
+            data['cpu_per_core'] = [round(total / samples, 1) for total in window['core_sums']] if samples else None
+        if 'load' in self.components:
+            data['load_average'] = [round(value, 2) for value in psutil.getloadavg()]
+        if 'memory' in self.components:
+            mem = psutil.virtual_memory()
+            data.update(memory_total=mem.total, memory_available=mem.available, memory_percent=mem.percent)
+        if 'disk' in self.components:
+            disk = psutil.disk_usage(self.disk_path)
+            data.update(disk_total=disk.total, disk_used=disk.used, disk_percent=disk.percent)
+        if 'net' in self.components and elapsed > 0 and start[2] is not None:
+            data['net_sent_bps'] = round((end[2].bytes_sent - start[2].bytes_sent) / elapsed, 1)
+            data['net_recv_bps'] = round((end[2].bytes_recv - start[2].bytes_recv) / elapsed, 1)
+            data['net_peak_bps'] = round(window['net_peak_bps'], 1)
+        if 'disk_io' in self.components and elapsed > 0 and start[3] is not None:
+            data['disk_read_bps'] = round((end[3].read_bytes - start[3].read_bytes) / elapsed, 1)
+            data['disk_write_bps'] = round((end[3].write_bytes - start[3].write_bytes) / elapsed, 1)
+            data['disk_peak_bps'] = round(window['disk_peak_bps'], 1)
+        now = self.clock()
+        if 'temperatures' in self.components:
+            data['temperatures'] = self._read_temperatures(now)
+        if 'processes' in self.components:
+            data['top_processes'] = self._read_processes(now)
+        return data
+
+    # --- Thread ---
+    def run(self):
+        next_sample = self.clock()
+        while not self._stop.is_set():
+            try:
+                self.sample()
+            except Exception as e:
+                log.warning("System sample failed: %s", e)
+            # Anchored to the schedule, so the rate doesn't drift by the sampling cost.
+            next_sample = max(next_sample + self.interval_seconds, self.clock())
+            self._stop.wait(next_sample - self.clock())
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run, name="system-sampler", daemon=True)
+            self._thread.start()
+        return self._thread
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
@@ -0,0 +1,144 @@
+"""Production entry point for the web server.
+
+`application` is the WSGI app for any server. Run it with the best server installed:
+
+    python wsgi.py                       # gunicorn, else waitress, else werkzeug's threaded server
+    python wsgi.py --server gunicorn --workers 4 --threads 8 --bind 0.0.0.0:80
+    gunicorn -c wsgi.py wsgi:application # gunicorn picks up the settings and hooks below
+
+Every worker calls small_server.start_background_services(); a file lock makes sure the battery
+controller runs in exactly one of them. On SIGTERM/SIGINT the servers stop accepting connections,
+let running requests finish and call stop_background_services().
+"""
+import argparse
+import os
+import signal
+import sys
+import threading
+
+import metrics
+import structured_log
+from small_server import app, start_background_services, stop_background_services
+
+application = app
+structured_log.configure(metrics.PROCESS_NAME)
+
+# --- Server Configuration ---
+# Overridable from the environment or the command line.
+WSGI_BIND = os.environ.get('WSGI_BIND', '0.0.0.0:80')
+WSGI_WORKERS = int(os.environ.get('WSGI_WORKERS', 2))  # Processes (gunicorn only)
+WSGI_THREADS = int(os.environ.get('WSGI_THREADS', 8))  # Request threads per process; SSE clients hold one each
+WSGI_GRACEFUL_TIMEOUT_SECONDS = 30  # Time running requests get to finish on shutdown
+SERVERS = ('gunicorn', 'waitress', 'werkzeug')
+
+# --- gunicorn settings and hooks (used by `gunicorn -c wsgi.py` and by run_gunicorn) ---
+bind = WSGI_BIND
+workers = WSGI_WORKERS
+threads = WSGI_THREADS
+worker_class = 'gthread'
+graceful_timeout = WSGI_GRACEFUL_TIMEOUT_SECONDS
+
+
+def post_worker_init(worker):
+    start_background_services()
+
+
+def worker_exit(server, worker):
+    stop_background_services()
+
+
+def available_server():
+    for name in SERVERS[:-1]:
+        try:
+            __import__(name)
+            return name
+        except ImportError:
+            continue
+    return 'werkzeug'
+
+
+def run_gunicorn(host, port, workers, threads):
+    from gunicorn.app.base import BaseApplication
+
+    class Application(BaseApplication):
+        def load_config(self):
+            options = {'bind': f"{host}:{port}", 'workers': workers, 'threads': threads,
+                       'worker_class': worker_class, 'graceful_timeout': graceful_timeout,
+                       'post_worker_init': post_worker_init, 'worker_exit': worker_exit}
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return application
+
+    Application().run()
+
+
+def _exit_on_signals():
+    """Turns SIGTERM into the same clean exit as Ctrl+C."""
+    def handle(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, handle)
+
+
+def run_waitress(host, port, threads):
+    from waitress import create_server
+
+    server = create_server(application, host=host, port=port, threads=threads)
+    _exit_on_signals()
+    start_background_services()
+    try:
+        server.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        stop_background_services()
+
+
+def run_werkzeug(host, port, threads):
+    """Werkzeug's threaded server without debugger or reloader: one thread per request, so
+    `threads` is not a limit. For machines where neither gunicorn nor waitress is installed."""
+    from werkzeug.serving import make_server
+
+    server = make_server(host, port, application, threaded=True)
+    server.daemon_threads = True
+
+    def handle(signum, frame):
+        # shutdown() waits for serve_forever to return, so it must not run on the serving thread.
+        threading.Thread(target=server.shutdown, daemon=True).start()
+    signal.signal(signal.SIGTERM, handle)
+    signal.signal(signal.SIGINT, handle)
+    start_background_services()
+    try:
+        server.serve_forever()
+    finally:
+        stop_background_services()
+        server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs the web server under a production WSGI server.")
+    parser.add_argument('--server', choices=SERVERS, default=None, help='default: the best one installed')
+    parser.add_argument('--bind', default=WSGI_BIND, help='host:port')
+    parser.add_argument('--workers', type=int, default=None, help=f'processes (gunicorn only, default {WSGI_WORKERS})')
+    parser.add_argument('--threads', type=int, default=WSGI_THREADS, help='request threads per process')
+    args = parser.parse_args()
+
+    server = args.server or available_server()
+    host, _, port = args.bind.rpartition(':')
+    host, port = host or '0.0.0.0', int(port)
+    if server != 'gunicorn' and args.workers:
+        print(f"{server} runs a single process; --workers is ignored.")
+    print(f"Serving on http://{host}:{port} with {server} (pid {os.getpid()}).")
+    if server == 'gunicorn':
+        run_gunicorn(host, port, args.workers or WSGI_WORKERS, args.threads)
+    elif server == 'waitress':
+        run_waitress(host, port, args.threads)
+    else:
+        run_werkzeug(host, port, args.threads)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())